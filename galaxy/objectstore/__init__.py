@@ -12,6 +12,7 @@ import threading
 from xml.etree import ElementTree
 
 from galaxy.util.files import umask_fix_perms, force_symlink
+from galaxy.util.transfer import transfer_file, AUTO
 from galaxy.exceptions import ObjectInvalid, ObjectNotFound
 from galaxy.util.sleeper import Sleeper
 from galaxy.util.directory_hash import directory_hash_id
@@ -187,6 +188,26 @@ class ObjectStore(object):
         """
         raise NotImplementedError()
 
+    def pin(self, obj, lease=None):
+        """
+        Keep the local copy of the object from being evicted from the cache,
+        while a job is using it, for at most `lease` seconds if it is given.
+        Does nothing for stores without a cache.
+        """
+        pass
+
+    def unpin(self, obj):
+        """
+        Undo one call to `pin`
+        """
+        pass
+
+    def cache_stats(self):
+        """
+        Counters of the local cache, or None for stores without a cache
+        """
+        return None
+
 
 
 class DiskObjectStore(ObjectStore):
@@ -220,6 +241,29 @@ class DiskObjectStore(ObjectStore):
                     self.extra_dirs[e.tag] = e.get('path')
         if extra_dirs is not None:
             self.extra_dirs.update( extra_dirs )
+        self.layout = (1, 2)
+        self.legacy_layouts = []
+        # see galaxy.util.transfer
+        self.transfer_strategy = AUTO
+
+    def set_layout(self, layout, legacy_layouts=None):
+        """
+        Set the (depth, width) of the hashed directories for UUID ids. While
+        objects are being moved to a new layout, the ones not moved yet are
+        still found under the `legacy_layouts`.
+        """
+        self.layout = tuple(layout)
+        self.legacy_layouts = list( tuple(a) for a in (legacy_layouts or []) )
+
+    def _legacy_path(self, obj, **kwargs):
+        """
+        The path of an object stored under one of the legacy layouts, or None
+        """
+        for layout in self.legacy_layouts:
+            path = self._construct_path(obj, layout=layout, **kwargs)
+            if os.path.exists(path):
+                return path
+        return None
 
     def _get_filename(self, obj, base_dir=None, dir_only=False, extra_dir=None, extra_dir_at_root=False, alt_name=None, obj_dir=False):
         """Class method that returns the absolute path for the file corresponding
@@ -232,7 +276,7 @@ class DiskObjectStore(ObjectStore):
             return self._construct_path(obj, base_dir=base_dir, dir_only=dir_only, extra_dir=extra_dir, extra_dir_at_root=extra_dir_at_root, alt_name=alt_name)
 
     # TODO: rename to _disk_path or something like that to avoid conflicts with children that'll use the local_extra_dirs decorator, e.g. S3
-    def _construct_path(self, obj, old_style=False, base_dir=None, dir_only=False, extra_dir=None, extra_dir_at_root=False, alt_name=None, obj_dir=False, **kwargs):
+    def _construct_path(self, obj, old_style=False, base_dir=None, dir_only=False, extra_dir=None, extra_dir_at_root=False, alt_name=None, obj_dir=False, layout=None, **kwargs):
         """ Construct the expected absolute path for accessing the object
             identified by `obj`.id.
 
@@ -260,6 +304,10 @@ class DiskObjectStore(ObjectStore):
         param old_style: This option is used for backward compatibility. If True
                          the composed directory structure does not include a hash id
                          (e.g., /files/dataset_10.dat (old) vs. /files/000/dataset_10.dat (new))
+
+        :type layout: tuple
+        :param layout: The (depth, width) of the hashed directories, the
+                       store's current layout if None.
         """
         base = self.extra_dirs.get(base_dir, self.file_path)
         if old_style:
@@ -269,7 +317,7 @@ class DiskObjectStore(ObjectStore):
                 path = base
         else:
             # Construct hashed path
-            rel_path = os.path.join(*directory_hash_id(obj.id))
+            rel_path = os.path.join(*directory_hash_id(obj.id, *(layout or self.layout)))
             # Create a subdirectory for the object ID
             if obj_dir:
                 rel_path = os.path.join(rel_path, str(obj.id))
@@ -291,7 +339,9 @@ class DiskObjectStore(ObjectStore):
             # and check hashed path
             if os.path.exists(path):
                 return True
-        return os.path.exists(self._construct_path(obj, **kwargs))
+        if os.path.exists(self._construct_path(obj, **kwargs)):
+            return True
+        return len(self.legacy_layouts) > 0 and self._legacy_path(obj, **kwargs) is not None
 
     def create(self, obj, **kwargs):
         if not self.exists(obj, **kwargs):
@@ -347,11 +397,15 @@ class DiskObjectStore(ObjectStore):
             # and return hashed path
             if os.path.exists(path):
                 return path
-        return self._construct_path(obj, **kwargs)
+        path = self._construct_path(obj, **kwargs)
+        if len(self.legacy_layouts) and not os.path.exists(path):
+            return self._legacy_path(obj, **kwargs) or path
+        return path
 
     def update_from_file(self, obj, file_name=None, create=False, **kwargs):
         """ `create` parameter is not used in this implementation """
         preserve_symlinks = kwargs.pop( 'preserve_symlinks', False )
+        strategy = kwargs.pop( 'transfer', self.transfer_strategy )
         # FIXME: symlinks and the object store model may not play well together
         # these should be handled better, e.g. registering the symlink'd file as an object
         if create:
@@ -361,7 +415,7 @@ class DiskObjectStore(ObjectStore):
                 if preserve_symlinks and os.path.islink( file_name ):
                     force_symlink( os.readlink( file_name ), self.get_filename( obj, **kwargs ) )
                 else:
-                    shutil.copy( file_name, self.get_filename( obj, **kwargs ) )
+                    transfer_file( file_name, self.get_filename( obj, **kwargs ), strategy )
             except IOError, ex:
                 log.critical('Error copying %s to %s: %s' % (file_name, self._get_filename(obj, **kwargs), ex))
                 raise ex
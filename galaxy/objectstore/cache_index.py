@@ -0,0 +1,390 @@
+"""
+Access index of a local object cache, for size bounded LRU eviction
+
+The index keeps the cached files (by path relative to the cache directory)
+in least recently used order with their sizes, so the cache can be kept
+under a byte budget without ever walking it. It is persisted as a journal
+in the cache directory, of
+
+    + <size> <path>     added or accessed
+    - <path>            removed
+
+lines, appended under a flock. Every process using the cache replays the
+lines the others have appended since it last looked, so they share one
+LRU order and one total. The journal is rewritten as a snapshot of the
+current entries once it holds more than COMPACT_FACTOR lines per entry.
+A hit on a file that is already among the most recently used 1/HIT_WINDOW
+of the entries isn't written to the journal, as moving it up wouldn't
+change what is evicted.
+Files added to or removed from the cache without going through the index
+are only picked up by `reconcile`, which walks the cache once.
+
+Files are pinned (while a job is using them, say) with a count per
+process, and a shared flock on <path>.pin held while the count is above
+zero. Eviction takes an exclusive flock on that file, without waiting,
+before removing a file, so it skips the files pinned by any process. A pin
+can be given a lease, after which `evict` and `reconcile` drop it, so a
+caller that never unpins doesn't hold the file forever.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import logging
+import threading
+from collections import OrderedDict
+
+INDEX_NAME = ".cache_index"
+COMPACT_FACTOR = 4
+COMPACT_MIN_LINES = 1000
+PIN_SUFFIX = ".pin"
+HIT_WINDOW = 4
+
+
+def _lock_pin(pin_path, flags):
+    """
+    An fd of `pin_path` locked with `flags`, or None if LOCK_NB was given
+    and it is held. Like fill_lock, a lock taken on a file that has been
+    removed in the meantime is tried again with the new one.
+    """
+    while True:
+        fd = os.open(pin_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, flags)
+        except IOError, e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        try:
+            if os.stat(pin_path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                os.close(fd)
+                raise
+        os.close(fd)
+
+
+class CacheIndex(object):
+
+    def __init__(self, cache_path, max_bytes=None):
+        self.cache_path = cache_path
+        self.path = os.path.join(cache_path, INDEX_NAME)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total = 0
+        self.pins = {}
+        self.counters = {"hits" : 0, "misses" : 0, "evictions" : 0, "evicted_bytes" : 0}
+        self.lock = threading.RLock()
+        self.fd = None
+        self._open()
+        self._catch_up()
+
+    def _open(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self.inode = os.fstat(self.fd).st_ino
+        self.offset = 0
+        self.lines = 0
+        self.entries = OrderedDict()
+        self.total = 0
+        # number of the journal line each entry was last moved up by
+        self.seq = 0
+        self.touched = {}
+
+    def _apply(self, line):
+        self.seq += 1
+        if line.startswith("+ "):
+            size, path = line[2:].split(" ", 1)
+            self.total -= self.entries.pop(path, 0)
+            self.entries[path] = int(size)
+            self.total += int(size)
+            self.touched[path] = self.seq
+        elif line.startswith("- "):
+            self.total -= self.entries.pop(line[2:], 0)
+            self.touched.pop(line[2:], None)
+
+    def _catch_up(self):
+        """
+        Apply the journal lines written since the last look, starting over
+        if the journal has been compacted in the meantime
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            st = None
+        if st is None or st.st_ino != self.inode:
+            self._open()
+            st = os.fstat(self.fd)
+        if st.st_size <= self.offset:
+            return
+        data = self._read(st.st_size)
+        end = data.rfind("\n") + 1
+        for line in data[:end].splitlines():
+            self._apply(line)
+            self.lines += 1
+        self.offset += end
+
+    def _read(self, end):
+        os.lseek(self.fd, self.offset, os.SEEK_SET)
+        chunks = []
+        remaining = end - self.offset
+        while remaining > 0:
+            chunk = os.read(self.fd, remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return "".join(chunks)
+
+    def _append(self, lines):
+        while True:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                # a journal compacted while waiting for the lock has been
+                # replaced, and lines written to it would be lost
+                if os.stat(self.path).st_ino == self.inode:
+                    os.write(self.fd, "".join(lines))
+                    break
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self._open()
+        self._catch_up()
+        if self.lines > max(COMPACT_MIN_LINES, COMPACT_FACTOR * len(self.entries)):
+            self.compact()
+
+    def hit(self, path, file_path=None):
+        """
+        Record an access to a cached file. Files cached before the index
+        existed are added with the size of `file_path`.
+        """
+        with self.lock:
+            self._catch_up()
+            self.counters["hits"] += 1
+            size = self.entries.get(path, None)
+            if size is not None and self.seq - self.touched[path] < max(1, len(self.entries) / HIT_WINDOW):
+                return
+            if size is None and file_path is not None:
+                size = os.path.getsize(file_path)
+            if size is not None:
+                self._append(["+ %d %s\n" % (size, path)])
+
+    def miss(self):
+        with self.lock:
+            self.counters["misses"] += 1
+
+    def add(self, path, size):
+        """
+        Record a newly cached file, and evict others to get back under
+        the budget
+        """
+        with self.lock:
+            self._append(["+ %d %s\n" % (size, path)])
+            self.evict(keep=path)
+
+    def remove(self, path):
+        with self.lock:
+            self._catch_up()
+            if path in self.entries:
+                self._append(["- %s\n" % (path)])
+
+    def _pin_path(self, path):
+        return os.path.join(self.cache_path, path + PIN_SUFFIX)
+
+    def pin(self, path, lease=None):
+        """
+        Keep `path` from being evicted until it is unpinned as many times,
+        or if `lease` is given, for at most that many seconds
+        """
+        with self.lock:
+            expires = None
+            if lease is not None:
+                expires = time.time() + lease
+            if path in self.pins:
+                count, fd, old = self.pins[path]
+                if old is None or expires is None:
+                    expires = None
+                else:
+                    expires = max(old, expires)
+            else:
+                pin_path = self._pin_path(path)
+                try:
+                    os.makedirs(os.path.dirname(pin_path))
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                count, fd = 0, _lock_pin(pin_path, fcntl.LOCK_SH)
+            self.pins[path] = (count + 1, fd, expires)
+
+    def unpin(self, path):
+        with self.lock:
+            if path not in self.pins:
+                return
+            count, fd, expires = self.pins.pop(path)
+            if count > 1:
+                self.pins[path] = (count - 1, fd, expires)
+                return
+            self._release_pin(path, fd)
+
+    def expire_pins(self):
+        """
+        Drop the pins whose lease has run out, returns their paths
+        """
+        out = []
+        now = time.time()
+        with self.lock:
+            for path, (count, fd, expires) in self.pins.items():
+                if expires is not None and expires <= now:
+                    logging.warning("Pin of %s in the cache has expired" % (path))
+                    del self.pins[path]
+                    self._release_pin(path, fd)
+                    out.append(path)
+        return out
+
+    def _release_pin(self, path, fd):
+        try:
+            # the last pin of any process removes the file
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.unlink(self._pin_path(path))
+        except (IOError, OSError), e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES, errno.ENOENT):
+                raise
+        finally:
+            os.close(fd)
+
+    def _pinned(self, path):
+        """
+        Whether `path` is pinned by any process. If not, the fd of its pin
+        file is returned locked, for it to be removed while nothing can pin
+        it.
+        """
+        if path in self.pins:
+            return True, None
+        try:
+            fd = _lock_pin(self._pin_path(path), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # its directory is gone, and the file with it
+            return False, None
+        return fd is None, fd
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used files, skipping pinned ones and `keep`,
+        until the total is within max_bytes. Returns the paths removed.
+        """
+        out = []
+        if self.max_bytes is None:
+            return out
+        with self.lock:
+            self.expire_pins()
+            self._catch_up()
+            for path, size in list(self.entries.items()):
+                if self.total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                pinned, fd = self._pinned(path)
+                if pinned:
+                    continue
+                try:
+                    for name in [path, path + PIN_SUFFIX]:
+                        try:
+                            os.unlink(os.path.join(self.cache_path, name))
+                        except OSError, e:
+                            if e.errno != errno.ENOENT:
+                                raise
+                finally:
+                    if fd is not None:
+                        os.close(fd)
+                logging.info("Evicted %s from cache" % (path))
+                self._append(["- %s\n" % (path)])
+                self.counters["evictions"] += 1
+                self.counters["evicted_bytes"] += size
+                out.append(path)
+        return out
+
+    def compact(self, reorder=None):
+        """
+        Rewrite the journal as one line per entry, in LRU order, or in the
+        order of the (path, size) pairs `reorder` returns for the entries
+        """
+        with self.lock:
+            while True:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                try:
+                    if os.stat(self.path).st_ino == self.inode:
+                        self._catch_up()
+                        items = self.entries.items() if reorder is None else reorder(self.entries)
+                        tmp = "%s.tmp.%d" % (self.path, os.getpid())
+                        with open(tmp, "w") as handle:
+                            handle.write("".join("+ %d %s\n" % (size, path) for path, size in items))
+                        os.rename(tmp, self.path)
+                        break
+                finally:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+                # compacted by another process in the meantime
+                self._open()
+            self._open()
+            self._catch_up()
+
+    def reconcile(self):
+        """
+        Bring the index in line with the files in the cache, for files added
+        or removed behind its back, with one walk of the cache. Files it
+        didn't know about go at the least recently used end, oldest access
+        first. Hidden files, lock and pin files and temporary files are
+        skipped.
+        Returns the number of entries added and removed. Pins whose lease
+        has run out are dropped.
+        """
+        self.expire_pins()
+        found = {}
+        for dirpath, _, filenames in os.walk(self.cache_path):
+            for filename in filenames:
+                if filename.startswith(".") or filename.endswith((".lock", PIN_SUFFIX)) or ".tmp." in filename:
+                    continue
+                found[os.path.relpath(os.path.join(dirpath, filename), self.cache_path)] = None
+        changes = []
+
+        def reorder(entries):
+            unknown = []
+            for path in found:
+                if path not in entries:
+                    try:
+                        st = os.stat(os.path.join(self.cache_path, path))
+                    except OSError:
+                        continue
+                    unknown.append( (st.st_atime, path, st.st_size) )
+            unknown.sort()
+            # entries made since the walk are kept
+            known = list( (path, size) for path, size in entries.items()
+                if path in found or os.path.exists(os.path.join(self.cache_path, path)) )
+            changes.append(len(unknown) + len(entries) - len(known))
+            return list( (path, size) for atime, path, size in unknown ) + known
+
+        self.compact(reorder)
+        return changes[-1]
+
+    def stats(self):
+        with self.lock:
+            self._catch_up()
+            out = dict(self.counters)
+            out.update({
+                "entries" : len(self.entries),
+                "bytes" : self.total,
+                "max_bytes" : self.max_bytes,
+                "pinned" : len(self.pins)
+            })
+            return out
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -1,13 +1,91 @@
 
 import os
-import shutil
+import stat
+import time
+import errno
+import fcntl
 import logging
+from contextlib import contextmanager
 from galaxy.objectstore import ObjectStore, DiskObjectStore, directory_hash_id
+from galaxy.objectstore.cache_index import CacheIndex
 from galaxy.util.files import umask_fix_perms
+from galaxy.util.transfer import transfer_file, transfer_stats, is_read_only
+
+LOCK_SUFFIX = ".lock"
+# partial copies left behind by fills that died are removed once they
+# haven't been written to for this long
+STALE_FILL_TIMEOUT = 600
+
+
+@contextmanager
+def fill_lock(path):
+    """
+    Hold an exclusive flock on `path` + LOCK_SUFFIX, which works across
+    threads and processes. The lock file is removed on the way out, so a
+    waiter that gets a lock on a file that has been removed since it
+    opened it tries again with the new one.
+    """
+    lock_path = path + LOCK_SUFFIX
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            current = os.stat(lock_path).st_ino == os.fstat(fd).st_ino
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                os.close(fd)
+                raise
+            current = False
+        if current:
+            break
+        os.close(fd)
+    try:
+        yield
+    finally:
+        try:
+            os.unlink(lock_path)
+        finally:
+            os.close(fd)
+
+
+def remove_stale_fills(path, timeout=STALE_FILL_TIMEOUT):
+    """
+    Remove the temporary files of fills of `path` that have been left
+    alone for `timeout` seconds
+    """
+    now = time.time()
+    dir, name = os.path.split(path)
+    for tmp_name in os.listdir(dir):
+        if not tmp_name.startswith(name + ".tmp."):
+            continue
+        tmp = os.path.join(dir, tmp_name)
+        try:
+            if now - os.path.getmtime(tmp) > timeout:
+                logging.info("Removing stale cache fill %s" % (tmp))
+                os.unlink(tmp)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
 
 class CachedDiskObjectStore(ObjectStore):
+    """
+    DiskObjectStore with a local copy of every object read through
+    get_filename, kept in `cache_path` (a worker's local disk, say). With
+    `cache_size` set, least recently used copies are evicted to keep the
+    cache under that many bytes, apart from the ones pinned while in use.
+
+    Copies in either direction go through galaxy.util.transfer, so objects
+    that can't be written are hard linked into the cache, and the others
+    are cloned or copied in the kernel where the filesystems allow it.
+
+    A fill is made under a per object flock and appears with a rename, so
+    when several threads or processes ask for an object that isn't cached
+    one of them copies it while the others wait for it, and none of them
+    ever sees a partial copy.
+    """
 
-    def __init__(self, config, cache_path, open_perms=False, config_xml=None, file_path=None, extra_dirs=None):
+    def __init__(self, config, cache_path, open_perms=False, config_xml=None, file_path=None, extra_dirs=None, cache_size=None,
+        stale_fill_timeout=STALE_FILL_TIMEOUT):
         self.disk = DiskObjectStore(config=config, config_xml=config_xml, file_path=file_path, extra_dirs=extra_dirs)
         self.cache_path = os.path.abspath(cache_path)
         self.open_perms = open_perms
@@ -16,20 +94,30 @@ class CachedDiskObjectStore(ObjectStore):
         if self.open_perms:
             os.chmod(self.cache_path, 0o777)
         self._fix_permissions(self.cache_path)
+        self.index = CacheIndex(self.cache_path, max_bytes=cache_size)
+        self.stale_fill_timeout = stale_fill_timeout
+
+    def set_layout(self, layout, legacy_layouts=None):
+        self.disk.set_layout(layout, legacy_layouts)
+
+    def _open_file_perms(self, path):
+        st = os.lstat(path)
+        # Ignore symlinks, and files that are read only or hard linked, as
+        # they may share their inode (and so their mode) with the stored
+        # object
+        if stat.S_ISLNK(st.st_mode) or st.st_nlink > 1 or is_read_only(path):
+            return
+        os.chmod(path, 0o777)
 
     def _fix_permissions(self, rel_path):
         if self.open_perms:
             if os.path.isfile(rel_path):
-                os.chmod(rel_path, 0o777)
+                self._open_file_perms(rel_path)
             else:
                 for basedir, _, files in os.walk(rel_path):
                     os.chmod(basedir, 0o777)
                     for filename in files:
-                        path = os.path.join(basedir, filename)
-                        # Ignore symlinks
-                        if os.path.islink(path):
-                            continue
-                        os.chmod(path, 0o777)
+                        self._open_file_perms(os.path.join(basedir, filename))
 
     def create(self, obj, base_dir=None, dir_only=False, extra_dir=None, extra_dir_at_root=False, alt_name=None, obj_dir=False):
         self.disk.create(obj,
@@ -43,10 +131,11 @@ class CachedDiskObjectStore(ObjectStore):
         else:
             if file_name is not None:
                 logging.info("Copying %s to object store" % (file_name))
-                shutil.copy( file_name, self.disk.get_filename(obj) )
+                transfer_file( file_name, self.disk.get_filename(obj), self.disk.transfer_strategy )
             else:
                 logging.info("Copying %s to object store" % (self._cache_path(obj)))
-                shutil.copy( self._cache_path(obj), self.disk.get_filename(obj) )
+                transfer_file( self._cache_path(obj), self.disk.get_filename(obj), self.disk.transfer_strategy )
+                self.index.add(self._cache_key(obj), os.path.getsize(self._cache_path(obj)))
 
     def exists(self, obj, **kwargs):
         return self.disk.exists(obj=obj, **kwargs)
@@ -54,24 +143,61 @@ class CachedDiskObjectStore(ObjectStore):
     def get_filename(self, obj, **kwargs):
         path_dir = self._cache_path_dir(obj)
         if not os.path.exists(path_dir):
-            os.mkdir(path_dir)
+            try:
+                os.makedirs(path_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
             self._fix_permissions(path_dir)
         local_path = self._cache_path(obj)
-        if not os.path.exists(local_path):
-            logging.info("Caching %s" % (obj.id))
-            shutil.copy( self.disk.get_filename(obj), local_path )
+        if os.path.exists(local_path):
+            self.index.hit(self._cache_key(obj), local_path)
+        else:
+            with fill_lock(local_path):
+                if os.path.exists(local_path):
+                    # filled while waiting for the lock
+                    self.index.hit(self._cache_key(obj), local_path)
+                else:
+                    logging.info("Caching %s" % (obj.id))
+                    self.index.miss()
+                    remove_stale_fills(local_path, self.stale_fill_timeout)
+                    used = transfer_file( self.disk.get_filename(obj), local_path, self.disk.transfer_strategy )
+                    logging.debug("Cached %s by %s" % (obj.id, used))
+                    self.index.add(self._cache_key(obj), os.path.getsize(local_path))
         self._fix_permissions(local_path)
         return local_path
 
+    def pin(self, obj, lease=None):
+        """
+        Keep the cached copy of an object from being evicted until unpin is
+        called as many times, or for at most `lease` seconds
+        """
+        self.index.pin(self._cache_key(obj), lease=lease)
+
+    def unpin(self, obj):
+        self.index.unpin(self._cache_key(obj))
+
+    def cache_stats(self):
+        """
+        Hit, miss and eviction counts of this process, the size of the
+        cache, and the transfers by strategy (see galaxy.util.transfer)
+        """
+        out = self.index.stats()
+        out["transfers"] = transfer_stats()
+        return out
+
     def size(self, obj, extra_dir=None, extra_dir_at_root=False, alt_name=None, obj_dir=False):
         return self.disk.size(obj=obj, extra_dir=extra_dir, extra_dir_at_root=extra_dir_at_root, alt_name=alt_name, obj_dir=obj_dir)
 
     def _cache_path_dir(self, obj):
-        return os.path.join(self.cache_path, *directory_hash_id(obj.id))
+        return os.path.join(self.cache_path, *directory_hash_id(obj.id, *self.disk.layout))
 
     def _cache_path(self, obj):
         return os.path.join(self._cache_path_dir(obj), "dataset_%s.dat" % obj.id)
 
+    def _cache_key(self, obj):
+        return os.path.relpath(self._cache_path(obj), self.cache_path)
+
     def _pull_into_cache(self, rel_path):
         # Ensure the cache directory structure exists (e.g., dataset_#_files/)
         rel_path_dir = os.path.dirname(rel_path)
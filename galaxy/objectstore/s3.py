@@ -3,26 +3,26 @@ Object Store plugin for the Amazon Simple Storage Service (S3)
 """
 
 import logging
-import multiprocessing
 import os
 import shutil
-import subprocess
 import threading
 import time
 
 from datetime import datetime
 
 from galaxy.exceptions import ObjectNotFound
-from galaxy.util import string_as_bool, umask_fix_perms
+from galaxy.util import string_as_bool
+from galaxy.util.files import umask_fix_perms
 from galaxy.util.directory_hash import directory_hash_id
 from galaxy.util.sleeper import Sleeper
-from .s3_multipart_upload import multipart_upload
+from .s3_multipart_upload import multipart_upload, UploadError
+from .s3_download import parallel_download, DownloadError, DEFAULT_PART_SIZE, DEFAULT_THREADS, DEFAULT_RETRIES
+from .cache_index import CacheIndex
 from ..objectstore import ObjectStore, convert_bytes
 
 try:
     # Imports are done this way to allow objectstore code to be used outside of Galaxy.
     import boto
-    from boto.s3.key import Key
     from boto.s3.connection import S3Connection
     from boto.exception import S3ResponseError
 except ImportError:
@@ -40,10 +40,14 @@ class S3ObjectStore(ObjectStore):
     Object store that stores objects as items in an AWS S3 bucket. A local
     cache exists that is used as an intermediate location for files between
     Galaxy and S3.
+
+    When the cache has a size, the files in it are tracked in a CacheIndex
+    as they are pulled, pushed and read, and the least recently used ones
+    are removed once it is over 90% of that size. The cache is only walked
+    (to pick up files changed behind the index's back) when the index is
+    new, and every `reconcile_interval` hours.
     """
     def __init__(self, config, config_xml):
-        if boto is None:
-            raise Exception(NO_BOTO_ERROR_MESSAGE)
         super(S3ObjectStore, self).__init__(config, config_xml)
         self.config = config
         self.staging_path = self.config.file_path
@@ -51,23 +55,22 @@ class S3ObjectStore(ObjectStore):
         self._parse_config_xml(config_xml)
         self._configure_connection()
         self.bucket = self._get_bucket(self.bucket)
+        self.cache_index = None
         # Clean cache only if value is set in galaxy.ini
         if self.cache_size != -1:
             # Convert GBs to bytes for comparison
             self.cache_size = self.cache_size * 1073741824
+            # Clean once within 10% of the defined cache size
+            self.cache_index = CacheIndex(self.staging_path, max_bytes=int(self.cache_size * 0.9))
             # Helper for interruptable sleep
             self.sleeper = Sleeper()
             self.cache_monitor_thread = threading.Thread(target=self.__cache_monitor)
             self.cache_monitor_thread.start()
             log.info("Cache cleaner manager started")
-        # Test if 'axel' is available for parallel download and pull the key into cache
-        try:
-            subprocess.call('axel')
-            self.use_axel = True
-        except OSError:
-            self.use_axel = False
 
     def _configure_connection(self):
+        if boto is None:
+            raise Exception(NO_BOTO_ERROR_MESSAGE)
         log.debug("Configuring S3 Connection")
         self.conn = S3Connection(self.access_key, self.secret_key)
 
@@ -92,6 +95,14 @@ class S3ObjectStore(ObjectStore):
             self.conn_path = cn_xml.get('conn_path', '/')
             c_xml = config_xml.findall('cache')[0]
             self.cache_size = float(c_xml.get('size', -1))
+            self.reconcile_interval = float(c_xml.get('reconcile_interval', 24)) * 3600
+            # keys of at least part_size (in MB) are downloaded in parts,
+            # `threads` at a time
+            d_xml = config_xml.findall('download')
+            d_xml = d_xml[0] if d_xml else {}
+            self.download_part_size = int(float(d_xml.get('part_size', DEFAULT_PART_SIZE / 1048576.0)) * 1048576)
+            self.download_threads = int(d_xml.get('threads', DEFAULT_THREADS))
+            self.download_retries = int(d_xml.get('retries', DEFAULT_RETRIES))
             # for multipart upload
             self.s3server = {'access_key': self.access_key,
                              'secret_key': self.secret_key,
@@ -108,67 +119,37 @@ class S3ObjectStore(ObjectStore):
 
     def __cache_monitor(self):
         time.sleep(2)  # Wait for things to load before starting the monitor
+        # a new index (or an old cache) has to be filled in from the disk
+        if not len(self.cache_index.entries):
+            self._reconcile_cache()
+        last_reconcile = time.time()
         while self.running:
-            total_size = 0
-            # Is this going to be too expensive of an operation to be done frequently?
-            file_list = []
-            for dirpath, _, filenames in os.walk(self.staging_path):
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    file_size = os.path.getsize(filepath)
-                    total_size += file_size
-                    # Get the time given file was last accessed
-                    last_access_time = time.localtime(os.stat(filepath)[7])
-                    # Compose a tuple of the access time and the file path
-                    file_tuple = last_access_time, filepath, file_size
-                    file_list.append(file_tuple)
-            # Sort the file list (based on access time)
-            file_list.sort()
-            # Initiate cleaning once within 10% of the defined cache size?
-            cache_limit = self.cache_size * 0.9
-            if total_size > cache_limit:
-                log.info("Initiating cache cleaning: current cache size: %s; clean until smaller than: %s",
-                         convert_bytes(total_size), convert_bytes(cache_limit))
-                # How much to delete? If simply deleting up to the cache-10% limit,
-                # is likely to be deleting frequently and may run the risk of hitting
-                # the limit - maybe delete additional #%?
-                # For now, delete enough to leave at least 10% of the total cache free
-                delete_this_much = total_size - cache_limit
-                self.__clean_cache(file_list, delete_this_much)
+            if time.time() - last_reconcile > self.reconcile_interval:
+                self._reconcile_cache()
+                last_reconcile = time.time()
+            # Files are evicted as they are added, this catches the ones
+            # that grew in the cache since
+            evicted = self.cache_index.evict()
+            if len(evicted):
+                log.debug("Cache cleaning done. Removed %d files", len(evicted))
             self.sleeper.sleep(30)  # Test cache size every 30 seconds?
 
-    def __clean_cache(self, file_list, delete_this_much):
-        """ Keep deleting files from the file_list until the size of the deleted
-        files is greater than the value in delete_this_much parameter.
+    def _reconcile_cache(self):
+        changed = self.cache_index.reconcile()
+        log.info("Reconciled cache index with %s: %d entries changed, current cache size: %s",
+                 self.staging_path, changed, convert_bytes(self.cache_index.total))
 
-        :type file_list: list
-        :param file_list: List of candidate files that can be deleted. This method
-            will start deleting files from the beginning of the list so the list
-            should be sorted accordingly. The list must contains 3-element tuples,
-            positioned as follows: position 0 holds file last accessed timestamp
-            (as time.struct_time), position 1 holds file path, and position 2 has
-            file size (e.g., (<access time>, /mnt/data/dataset_1.dat), 472394)
+    def _cache_updated(self, rel_path):
+        """ Record a file that has been written into the cache """
+        if self.cache_index is not None:
+            cache_path = self._get_cache_path(rel_path)
+            if os.path.exists(cache_path):
+                self.cache_index.add(rel_path, os.path.getsize(cache_path))
 
-        :type delete_this_much: int
-        :param delete_this_much: Total size of files, in bytes, that should be deleted.
-        """
-        # Keep deleting datasets from file_list until deleted_amount does not
-        # exceed delete_this_much; start deleting from the front of the file list,
-        # which assumes the oldest files come first on the list.
-        deleted_amount = 0
-        for entry in enumerate(file_list):
-            if deleted_amount < delete_this_much:
-                deleted_amount += entry[2]
-                os.remove(entry[1])
-                # Debugging code for printing deleted files' stats
-                # folder, file_name = os.path.split(f[1])
-                # file_date = time.strftime("%m/%d/%y %H:%M:%S", f[0])
-                # log.debug("%s. %-25s %s, size %s (deleted %s/%s)" \
-                #     % (i, file_name, convert_bytes(f[2]), file_date, \
-                #     convert_bytes(deleted_amount), convert_bytes(delete_this_much)))
-            else:
-                log.debug("Cache cleaning done. Total space freed: %s", convert_bytes(deleted_amount))
-                return
+    def shutdown(self):
+        super(S3ObjectStore, self).shutdown()
+        if self.cache_index is not None:
+            self.sleeper.wake()
 
     def _get_bucket(self, bucket_name):
         """ Sometimes a handle to a bucket is not established right away so try
@@ -240,7 +221,7 @@ class S3ObjectStore(ObjectStore):
                 else:
                     exists = False
             else:
-                key = Key(self.bucket, rel_path)
+                key = self.bucket.new_key(rel_path)
                 exists = key.exists()
         except S3ResponseError:
             log.exception("Trouble checking existence of S3 key '%s'", rel_path)
@@ -286,6 +267,8 @@ class S3ObjectStore(ObjectStore):
         # Now pull in the file
         file_ok = self._download(rel_path)
         self._fix_permissions(self._get_cache_path(rel_path_dir))
+        if file_ok:
+            self._cache_updated(rel_path)
         return file_ok
 
     def _transfer_cb(self, complete, total):
@@ -300,18 +283,18 @@ class S3ObjectStore(ObjectStore):
                 log.critical("File %s is larger (%s) than the cache size (%s). Cannot download.",
                              rel_path, key.size, self.cache_size)
                 return False
-            if self.use_axel:
+            if self.download_threads > 1 and key.size > self.download_part_size:
                 log.debug("Parallel pulled key '%s' into cache to %s", rel_path, self._get_cache_path(rel_path))
-                ncores = multiprocessing.cpu_count()
-                url = key.generate_url(7200)
-                ret_code = subprocess.call("axel -a -n %s '%s'" % (ncores, url))
-                if ret_code == 0:
-                    return True
+                parallel_download(key, self._get_cache_path(rel_path), part_size=self.download_part_size,
+                                  threads=self.download_threads, retries=self.download_retries)
+                return True
             else:
                 log.debug("Pulled key '%s' into cache to %s", rel_path, self._get_cache_path(rel_path))
                 self.transfer_progress = 0  # Reset transfer progress counter
                 key.get_contents_to_filename(self._get_cache_path(rel_path), cb=self._transfer_cb, num_cb=10)
                 return True
+        except DownloadError:
+            log.exception("Problem downloading key '%s' from S3 bucket '%s'", rel_path, self.bucket.name)
         except S3ResponseError:
             log.exception("Problem downloading key '%s' from S3 bucket '%s'", rel_path, self.bucket.name)
         return False
@@ -327,7 +310,7 @@ class S3ObjectStore(ObjectStore):
         try:
             source_file = source_file if source_file else self._get_cache_path(rel_path)
             if os.path.exists(source_file):
-                key = Key(self.bucket, rel_path)
+                key = self.bucket.new_key(rel_path)
                 if os.path.getsize(source_file) == 0 and key.exists():
                     log.debug("Wanted to push file '%s' to S3 key '%s' but its size is 0; skipping.", source_file, rel_path)
                     return True
@@ -349,10 +332,13 @@ class S3ObjectStore(ObjectStore):
                     end_time = datetime.now()
                     log.debug("Pushed cache file '%s' to key '%s' (%s bytes transfered in %s sec)",
                               source_file, rel_path, os.path.getsize(source_file), end_time - start_time)
+                self._cache_updated(rel_path)
                 return True
             else:
                 log.error("Tried updating key '%s' from source file '%s', but source file does not exist.",
                           rel_path, source_file)
+        except UploadError:
+            log.exception("Trouble pushing S3 key '%s' from file '%s'", rel_path, source_file)
         except S3ResponseError:
             log.exception("Trouble pushing S3 key '%s' from file '%s'", rel_path, source_file)
         return False
@@ -464,9 +450,11 @@ class S3ObjectStore(ObjectStore):
             else:
                 # Delete from cache first
                 os.unlink(self._get_cache_path(rel_path))
+                if self.cache_index is not None:
+                    self.cache_index.remove(rel_path)
                 # Delete from S3 as well
                 if self._key_exists(rel_path):
-                    key = Key(self.bucket, rel_path)
+                    key = self.bucket.new_key(rel_path)
                     log.debug("Deleting key %s", key.name)
                     key.delete()
                     return True
@@ -502,6 +490,8 @@ class S3ObjectStore(ObjectStore):
         #     return cache_path
         # Check if the file exists in the cache first
         if self._in_cache(rel_path):
+            if self.cache_index is not None and not dir_only:
+                self.cache_index.hit(rel_path, cache_path)
             return cache_path
         # Check if the file exists in persistent storage and, if it does, pull it into cache
         elif self.exists(obj, **kwargs):
@@ -547,7 +537,7 @@ class S3ObjectStore(ObjectStore):
         if self.exists(obj, **kwargs):
             rel_path = self._construct_path(obj, **kwargs)
             try:
-                key = Key(self.bucket, rel_path)
+                key = self.bucket.new_key(rel_path)
                 return key.generate_url(expires_in=86400)  # 24hrs
             except S3ResponseError:
                 log.exception("Trouble generating URL for dataset '%s'", rel_path)
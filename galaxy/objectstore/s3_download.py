@@ -0,0 +1,129 @@
+"""
+Parallel ranged downloads of large S3 keys.
+
+The key is split into parts of `part_size` bytes, each fetched with its own
+HTTP Range GET on a thread pool and written straight to its offset in a
+file preallocated to the size of the key. A part that fails, or comes back
+short, is fetched again (up to `retries` times) without touching the
+others. The file is written under a temporary name and renamed into place
+once every part is in.
+
+Every part is requested with If-Match on the ETag the key had when the
+download started, and only a 206 response with the Content-Range asked
+for is written, so a server that ignores the Range can't write over the
+other parts, and an object replaced halfway through fails the download
+(with ObjectChanged, which isn't retried) instead of mixing two versions.
+"""
+
+import os
+import time
+import logging
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PART_SIZE = 32 * 1024 * 1024
+DEFAULT_THREADS = 8
+DEFAULT_RETRIES = 3
+RETRY_DELAY = 1.0
+BLOCK_SIZE = 1024 * 1024
+PRECONDITION_FAILED = 412
+
+
+class DownloadError(Exception):
+    pass
+
+
+class ObjectChanged(DownloadError):
+    pass
+
+
+def part_ranges(size, part_size):
+    """
+    The (first, last) byte offsets of each part, last included as in a
+    Range header
+    """
+    return list( (start, min(start + part_size, size) - 1) for start in range(0, size, part_size) )
+
+
+def _read_part(key, path, start, end):
+    """
+    Fetch bytes `start` to `end` of `key` into the same range of `path`,
+    returning how many were written
+    """
+    # keys hold the state of their last response, so each request gets its
+    # own
+    part_key = key.bucket.new_key(key.name)
+    headers = {"Range" : "bytes=%d-%d" % (start, end)}
+    if key.etag:
+        headers["If-Match"] = key.etag
+    try:
+        part_key.open_read(headers=headers)
+    except Exception, e:
+        if getattr(e, "status", None) == PRECONDITION_FAILED:
+            raise ObjectChanged("%s changed during the download" % (key.name))
+        raise
+    resp = part_key.resp
+    content_range = "bytes %d-%d/%d" % (start, end, key.size)
+    if resp.status != 206 or resp.getheader("content-range") != content_range:
+        part_key.close(fast=True)
+        raise DownloadError("Expected %s in a 206 response, got %d with Content-Range %s" % (
+            content_range, resp.status, resp.getheader("content-range")))
+    etag = resp.getheader("etag")
+    if key.etag and etag and etag != key.etag:
+        part_key.close(fast=True)
+        raise ObjectChanged("%s changed during the download" % (key.name))
+    received = 0
+    try:
+        with open(path, "r+b") as handle:
+            handle.seek(start)
+            while received <= end - start:
+                block = part_key.read(min(BLOCK_SIZE, end - start + 1 - received))
+                if not block:
+                    break
+                handle.write(block)
+                received += len(block)
+    finally:
+        part_key.close(fast=True)
+    return received
+
+
+def _fetch_part(args):
+    key, path, start, end, retries = args
+    for attempt in range(retries + 1):
+        try:
+            received = _read_part(key, path, start, end)
+            if received != end - start + 1:
+                raise DownloadError("Got %d of %d bytes" % (received, end - start + 1))
+            return received
+        except ObjectChanged:
+            raise
+        except Exception, e:
+            if attempt == retries:
+                raise DownloadError("Failed to download bytes %d-%d of %s: %s" % (start, end, key.name, e))
+            log.warning("Retrying bytes %d-%d of %s after error: %s", start, end, key.name, e)
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+
+def parallel_download(key, path, part_size=DEFAULT_PART_SIZE, threads=DEFAULT_THREADS, retries=DEFAULT_RETRIES):
+    """
+    Download `key` to `path` with up to `threads` concurrent ranged GETs
+    """
+    size = key.size
+    tmp = "%s.tmp.%d" % (path, os.getpid())
+    with open(tmp, "wb") as handle:
+        handle.truncate(size)
+    tasks = list( (key, tmp, start, end, retries) for start, end in part_ranges(size, part_size) )
+    pool = ThreadPool(max(1, min(threads, len(tasks))))
+    try:
+        for _ in pool.imap_unordered(_fetch_part, tasks):
+            pass
+        pool.close()
+    except:
+        pool.terminate()
+        os.unlink(tmp)
+        raise
+    finally:
+        pool.join()
+    os.rename(tmp, path)
+    log.debug("Downloaded %s (%d bytes) in %d parts", key.name, size, len(tasks))
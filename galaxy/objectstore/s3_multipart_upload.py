@@ -1,115 +1,138 @@
 #!/usr/bin/env python
 """
-Split large file into multiple pieces for upload to S3.
-This parallelizes the task over available cores using multiprocessing.
-Code mostly taken form CloudBioLinux.
+Upload large files to S3 in parts, in parallel.
+
+Each part is read straight from its offset in the source file, so nothing
+is written next to it, and only the parts being sent (one per thread) are
+in flight at a time. A part that fails is sent again, up to `retries`
+times. Parts that still fail don't stop the others, and the upload is left
+open on S3 when any do: the next `multipart_upload` of the same key picks
+it up and only sends the parts that are missing or differ from the file.
+An open upload whose parts were cut differently (another part size, or a
+file of another size) is cancelled and started over instead, as parts it
+holds past the end of the new layout would end up in the object.
 """
 
-import contextlib
-import functools
-import glob
-import multiprocessing
 import os
-import subprocess
+import time
+import hashlib
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
 
-from multiprocessing.pool import IMapIterator
+MB = 1024 * 1024
+DEFAULT_RETRIES = 3
+RETRY_DELAY = 1.0
 
-try:
-    from galaxy import eggs
-    eggs.require('boto')
-except ImportError:
+
+class UploadError(Exception):
     pass
 
-try:
-    import boto
-    from boto.s3.connection import S3Connection
-except ImportError:
-    boto = None
 
+def part_size_for(mb_size, max_chunk, split_num):
+    """
+    Part size in bytes, so parts are 5MB < part < max_chunk MB
+    """
+    return int(max(min(mb_size / (split_num * 2.0), max_chunk), 5)) * MB
 
-def map_wrap(f):
-    @functools.wraps(f)
-    def wrapper(*args, **kwargs):
-        return apply(f, *args, **kwargs)
-    return wrapper
 
+def _part_md5(path, start, length):
+    md5 = hashlib.md5()
+    with open(path, "rb") as handle:
+        handle.seek(start)
+        while length > 0:
+            block = handle.read(min(length, MB))
+            if not block:
+                break
+            md5.update(block)
+            length -= len(block)
+    return md5.hexdigest()
 
-def mp_from_ids(s3server, mp_id, mp_keyname, mp_bucketname):
-    """Get the multipart upload from the bucket and multipart IDs.
 
-    This allows us to reconstitute a connection to the upload
-    from within multiprocessing functions.
+def find_upload(bucket, s3_key_name):
     """
-    if s3server['host']:
-        conn = boto.connect_s3(aws_access_key_id=s3server['access_key'],
-                                    aws_secret_access_key=s3server['secret_key'],
-                                    is_secure=s3server['is_secure'],
-                                    host=s3server['host'],
-                                    port=s3server['port'],
-                                    calling_format=boto.s3.connection.OrdinaryCallingFormat(),
-                                    path=s3server['conn_path'])
-    else:
-        conn = S3Connection(s3server['access_key'], s3server['secret_key'])
-
-    bucket = conn.lookup(mp_bucketname)
-    mp = boto.s3.multipart.MultiPartUpload(bucket)
-    mp.key_name = mp_keyname
-    mp.id = mp_id
-    return mp
-
-
-@map_wrap
-def transfer_part(s3server, mp_id, mp_keyname, mp_bucketname, i, part):
-    """Transfer a part of a multipart upload. Designed to be run in parallel.
+    The most recently started upload of `s3_key_name` that was never
+    completed, or None
     """
-    mp = mp_from_ids(s3server, mp_id, mp_keyname, mp_bucketname)
-    with open(part) as t_handle:
-        mp.upload_part_from_file(t_handle, i + 1)
-    os.remove(part)
+    uploads = list( mp for mp in bucket.get_all_multipart_uploads(prefix=s3_key_name)
+        if mp.key_name == s3_key_name )
+    if not uploads:
+        return None
+    return sorted(uploads, key=lambda mp: mp.initiated)[-1]
 
 
-def multipart_upload(s3server, bucket, s3_key_name, tarball, mb_size):
+def _uploaded_parts(mp, path, parts):
+    """
+    Numbers of the parts of `mp` already holding the matching range of
+    `path`, or None if any of its parts doesn't fit the layout of `parts`
+    """
+    out = set()
+    for part in mp:
+        if part.part_number not in parts or part.size != parts[part.part_number][1]:
+            return None
+        start, length = parts[part.part_number]
+        if part.etag.strip('"') == _part_md5(path, start, length):
+            out.add(part.part_number)
+    return out
+
+
+def _upload_part(args):
+    mp, path, part_num, start, length, retries = args
+    for attempt in range(retries + 1):
+        try:
+            with open(path, "rb") as handle:
+                handle.seek(start)
+                mp.upload_part_from_file(handle, part_num, size=length)
+            return None
+        except Exception, e:
+            if attempt == retries:
+                return "part %d: %s" % (part_num, e)
+            log.warning("Retrying part %d of %s after error: %s", part_num, mp.key_name, e)
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+
+def multipart_upload(s3server, bucket, s3_key_name, tarball, mb_size, part_size=None, threads=None, retries=DEFAULT_RETRIES):
     """Upload large files using Amazon's multipart upload functionality.
     """
-    cores = multiprocessing.cpu_count()
-
-    def split_file(in_file, mb_size, split_num=5):
-        prefix = os.path.join(os.path.dirname(in_file),
-                                "%sS3PART" % (os.path.basename(s3_key_name)))
-        max_chunk = s3server['max_chunk_size']
-        # Split chunks so they are 5MB < chunk < 250MB(max_chunk_size)
-        split_size = int(max(min(mb_size / (split_num * 2.0), max_chunk), 5))
-        if not os.path.exists("%saa" % prefix):
-            cl = ["split", "-b%sm" % split_size, in_file, prefix]
-            subprocess.check_call(cl)
-        return sorted(glob.glob("%s*" % prefix))
-
-    mp = bucket.initiate_multipart_upload(s3_key_name,
-                                          reduced_redundancy=s3server['use_rr'])
-
-    with multimap(cores) as pmap:
-        for _ in pmap(transfer_part, ((s3server, mp.id, mp.key_name, mp.bucket_name, i, part)
-                                      for (i, part) in
-                                      enumerate(split_file(tarball, mb_size, cores)))):
-            pass
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    if part_size is None:
+        part_size = part_size_for(mb_size, s3server['max_chunk_size'], threads)
+    size = os.path.getsize(tarball)
+    parts = dict( (i + 1, (start, min(part_size, size - start)))
+        for i, start in enumerate(range(0, size, part_size)) )
+
+    mp = find_upload(bucket, s3_key_name)
+    done = None
+    if mp is not None:
+        done = _uploaded_parts(mp, tarball, parts)
+        if done is None:
+            log.info("Cancelling the open upload of %s, its parts don't fit the current layout", s3_key_name)
+            mp.cancel_upload()
+        else:
+            log.debug("Resuming upload of %s, %d of %d parts already sent", s3_key_name, len(done), len(parts))
+    if done is None:
+        mp = bucket.initiate_multipart_upload(s3_key_name,
+                                              reduced_redundancy=s3server['use_rr'])
+        done = set()
+
+    tasks = list( (mp, tarball, part_num, start, length, retries)
+        for part_num, (start, length) in sorted(parts.items()) if part_num not in done )
+    errors = []
+    if tasks:
+        pool = ThreadPool(max(1, min(threads, len(tasks))))
+        try:
+            for error in pool.imap_unordered(_upload_part, tasks):
+                if error is not None:
+                    errors.append(error)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    if errors:
+        raise UploadError("Failed to upload %s, left open to resume: %s" % (s3_key_name, "; ".join(sorted(errors))))
     mp.complete_upload()
-
-
-@contextlib.contextmanager
-def multimap(cores=None):
-    """Provide multiprocessing imap like function.
-
-    The context manager handles setting up the pool, worked around interrupt issues
-    and terminating the pool on completion.
-    """
-    if cores is None:
-        cores = max(multiprocessing.cpu_count() - 1, 1)
-
-    def wrapper(func):
-        def wrap(self, timeout=None):
-            return func(self, timeout=timeout if timeout is not None else 1e100)
-        return wrap
-    IMapIterator.next = wrapper(IMapIterator.next)
-    pool = multiprocessing.Pool(cores)
-    yield pool.imap
-    pool.terminate()
@@ -0,0 +1,10 @@
+"""
+Utility functions used systemwide.
+"""
+
+
+def string_as_bool( string ):
+    if str( string ).lower() in ( 'true', 'yes', 'on', '1' ):
+        return True
+    else:
+        return False
@@ -1,7 +1,9 @@
 
 
-def directory_hash_id( id ):
+def directory_hash_id( id, depth=1, width=2 ):
     """
+    Directory levels for an object. UUIDs are split into `depth` levels
+    of `width` characters from the start of the id.
 
     >>> directory_hash_id( 100 )
     ['000']
@@ -9,6 +11,10 @@ def directory_hash_id( id ):
     ['090']
     >>> directory_hash_id("777777777")
     ['000', '777', '777']
+    >>> directory_hash_id("c39ded10-6073-11e4-9803-0800200c9a66")
+    ['c3']
+    >>> directory_hash_id("c39ded10-6073-11e4-9803-0800200c9a66", depth=2)
+    ['c3', '9d']
     """
     s = str( id )
     l = len( s )
@@ -24,4 +30,6 @@ def directory_hash_id( id ):
         return [ padded[ i * 3 : (i + 1 ) * 3 ] for i in range( len( padded ) // 3 ) ]
     else:
         #assume it is a UUID
-        return [ s[0:2] ]
+        if depth * width > 8:
+            raise ValueError("Directory fan-out deeper than the first UUID field")
+        return [ s[ i * width : (i + 1) * width ] for i in range( depth ) ]
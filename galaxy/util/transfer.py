@@ -0,0 +1,180 @@
+"""
+Moving file contents into a store without copying them where possible
+
+    link        a hard link, when source and destination share a filesystem
+    reflink     a copy-on-write clone (the FICLONE ioctl, btrfs/xfs), which
+                shares the blocks but not the inode
+    copy_range  an in-kernel copy with copy_file_range(2), which NFS and
+                some filesystems turn into a server side copy or a clone
+    sendfile    an in-kernel copy with sendfile(2)
+    copy        a plain buffered copy
+
+`transfer_file` tries the strategies from the one asked for down this list,
+falling back whenever one isn't possible between the two paths. With
+'auto', a source nobody can write to is hard linked, and any other source
+starts at reflink, so a file that can still be written is never shared
+with the copy. The destination is written under a temporary name and
+renamed over `dst`, so it never holds partial data, and an in-kernel copy
+that stops short of the size of the source (a file shrinking under it, or
+a filesystem that won't copy all of it) falls back to the next strategy.
+
+How many transfers (and bytes) went through each strategy is counted in
+`transfer_stats`.
+"""
+
+import os
+import stat
+import errno
+import fcntl
+import shutil
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+log = logging.getLogger( __name__ )
+
+STRATEGIES = [ "link", "reflink", "copy_range", "sendfile", "copy" ]
+AUTO = "auto"
+
+# _IOW(0x94, 9, int), from linux/fs.h
+FICLONE = 0x40049409
+
+# largest count sendfile(2) will move in one call
+MAX_CHUNK = 0x7ffff000
+
+# errors meaning a strategy can't be used between these two files, rather
+# than that something went wrong
+FALLBACK_ERRORS = set( [ errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP,
+    errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EACCES ] )
+
+try:
+    _libc = ctypes.CDLL( ctypes.util.find_library( "c" ), use_errno=True )
+except ( OSError, TypeError ):
+    _libc = None
+
+
+class ShortCopy( IOError ):
+    pass
+
+
+def _libc_function( name, argtypes ):
+    try:
+        func = getattr( _libc, name )
+    except ( AttributeError, TypeError ):
+        return None
+    func.argtypes = argtypes
+    func.restype = ctypes.c_ssize_t
+    return func
+
+_off_p = ctypes.POINTER( ctypes.c_int64 )
+_copy_file_range = _libc_function( "copy_file_range", [ ctypes.c_int, _off_p, ctypes.c_int, _off_p, ctypes.c_size_t, ctypes.c_uint ] )
+_sendfile = _libc_function( "sendfile", [ ctypes.c_int, ctypes.c_int, _off_p, ctypes.c_size_t ] )
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record( name, size ):
+    with _stats_lock:
+        entry = _stats.setdefault( name, { "count" : 0, "bytes" : 0 } )
+        entry[ "count" ] += 1
+        entry[ "bytes" ] += size
+
+
+def transfer_stats():
+    """
+    The number of transfers and of bytes moved by each strategy in this
+    process
+    """
+    with _stats_lock:
+        return dict( ( name, dict( entry ) ) for name, entry in _stats.items() )
+
+
+def _link( src, dst ):
+    os.link( src, dst )
+
+
+def _reflink( src, dst ):
+    with open( src, "rb" ) as src_handle:
+        with open( dst, "wb" ) as dst_handle:
+            fcntl.ioctl( dst_handle.fileno(), FICLONE, src_handle.fileno() )
+        shutil.copymode( src, dst )
+
+
+def _kernel_copy( src, dst, call ):
+    with open( src, "rb" ) as src_handle:
+        with open( dst, "wb" ) as dst_handle:
+            remaining = os.fstat( src_handle.fileno() ).st_size
+            while remaining > 0:
+                count = call( src_handle.fileno(), dst_handle.fileno(), min( remaining, MAX_CHUNK ) )
+                if count < 0:
+                    e = ctypes.get_errno()
+                    raise OSError( e, os.strerror( e ) )
+                if count == 0:
+                    raise ShortCopy( errno.EIO, "Copy of %s stopped %d bytes short" % ( src, remaining ) )
+                remaining -= count
+        shutil.copymode( src, dst )
+
+
+def _copy_range( src, dst ):
+    if _copy_file_range is None:
+        raise OSError( errno.ENOSYS, "copy_file_range is not available" )
+    _kernel_copy( src, dst, lambda fd_in, fd_out, count: _copy_file_range( fd_in, None, fd_out, None, count, 0 ) )
+
+
+def _send( src, dst ):
+    if _sendfile is None:
+        raise OSError( errno.ENOSYS, "sendfile is not available" )
+    _kernel_copy( src, dst, lambda fd_in, fd_out, count: _sendfile( fd_out, fd_in, None, count ) )
+
+
+def _copy( src, dst ):
+    shutil.copy( src, dst )
+
+
+_METHODS = {
+    "link" : _link,
+    "reflink" : _reflink,
+    "copy_range" : _copy_range,
+    "sendfile" : _send,
+    "copy" : _copy
+}
+
+
+def _remove( path ):
+    try:
+        os.unlink( path )
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def is_read_only( path ):
+    return not os.stat( path ).st_mode & ( stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH )
+
+
+def transfer_file( src, dst, strategy=AUTO ):
+    """
+    Put the content of `src` at `dst`, replacing whatever is there, and
+    return the name of the strategy that was used
+    """
+    if strategy == AUTO:
+        strategy = "link" if is_read_only( src ) else "reflink"
+    if strategy not in STRATEGIES:
+        raise ValueError( "Unknown transfer strategy %s" % ( strategy ) )
+    tmp = "%s.tmp.%d.%d" % ( dst, os.getpid(), threading.current_thread().ident )
+    for name in STRATEGIES[ STRATEGIES.index( strategy ): ]:
+        _remove( tmp )
+        try:
+            _METHODS[ name ]( src, tmp )
+        except ( OSError, IOError ), e:
+            if name == "copy" or ( e.errno not in FALLBACK_ERRORS and not isinstance( e, ShortCopy ) ):
+                _remove( tmp )
+                raise
+            log.debug( "Can't %s %s to %s: %s" % ( name, src, dst, e ) )
+            continue
+        size = os.path.getsize( tmp )
+        os.rename( tmp, dst )
+        _record( name, size )
+        return name
@@ -2,15 +2,42 @@
 import os
 import uuid
 import json
+import time
+import shutil
+import threading
+from collections import OrderedDict
 from glob import glob
 from urlparse import urlparse, ParseResult
+from nebula.target import Target
 from galaxy.objectstore import ObjectStore, DiskObjectStore
 from galaxy.objectstore.local_cache import CachedDiskObjectStore
+from nebula.docstore.index import IndexSet, INDEX_DIR
+from nebula.docstore.fileutil import write_temp, atomic_write, sync_batch
+from nebula.docstore.segment import SegmentStore, SEGMENT_DIR
+from nebula.docstore.scan import parallel_filter
+from nebula.docstore.project import load_fields, project, top_level, ALWAYS_FIELDS
+from nebula.docstore.cache import DocCache, DEFAULT_MAX_ENTRIES, DEFAULT_MAX_BYTES, copy_doc
+from nebula.docstore.changes import ChangeLog, CHANGES_DIR
+from nebula.docstore.query import Query, compile_query
+from nebula.docstore.aggregate import AggregateSet, AggregateSpec, AGGREGATE_DIR, compute
+from nebula.docstore.blobs import LazyDoc, FileBlobLoader, spill, stale_blobs, has_blobs, is_blob_ref, blob_path, BLOB_SUFFIX, BLOB_GRACE
+from nebula.docstore.codec import get_codec, DEFAULT_CODEC
+from nebula.docstore.lineage import LineageIndex, LINEAGE_DIR, PARENTS, CHILDREN, lineage_edges, traverse
+from nebula.docstore.bloom import BloomSet, BLOOM_DIR, BLOOM_NAMES, DEFAULT_ERROR_RATE
+from nebula.docstore import codec as doc_codec
+from nebula.docstore.layout import DEFAULT_LAYOUT, LAYOUT_VERSION, check_layout, config_layouts, \
+    shard_dir, shard_dirs, entry_id, move_entry, remove_empty_dirs
+
+# object sizes recorded by update_from_file, for documents not stored yet
+MAX_PENDING_SIZES = 10000
 
 def from_url(url, **kwds):
     p = urlparse(url)
     if p.scheme in ['', 'filedoc'] :
         return FileDocStore(file_path=p.path, **kwds)
+    if p.scheme == 'sqlite':
+        from nebula.docstore.sqlite import SQLiteDocStore
+        return SQLiteDocStore(file_path=p.path, **kwds)
 
     raise Exception("Unknown ObjectStore %s" % (url))
 
@@ -25,11 +52,24 @@ class DiskObjectStoreConfig:
 class DocStore(ObjectStore):
     """
     DocStore abstract interface
+
+    If `blob_threshold` is set, top level object or list fields that encode
+    to more than that many bytes are stored out of line, compressed, and
+    only loaded when they are accessed (see nebula.docstore.blobs)
+
+    Documents are written with the `codec` encoding (see
+    nebula.docstore.codec), and read back in whichever one they were
+    written with.
     """
-    def __init__(self, objectstore, **kwargs):
+    def __init__(self, objectstore, blob_threshold=None, codec=None, **kwargs):
         self.running = True
         self.objs = objectstore
         self.extra_dirs = {}
+        self.blob_threshold = blob_threshold
+        self.codec = get_codec(codec)
+        self.aggregates = None
+        self.pending_sizes = OrderedDict()
+        self.pending_lock = threading.Lock()
 
     def shutdown(self):
         self.running = False
@@ -40,18 +80,213 @@ class DocStore(ObjectStore):
     def put(self, id, doc):
         raise NotImplementedError()
 
+    def ids(self):
+        """
+        The ids of all of the stored documents, without decoding them
+        """
+        raise NotImplementedError()
+
+    def get_many(self, ids):
+        """
+        Fetch a batch of documents, returns a list in the same order as `ids`
+        with None for the ones that don't exist
+        """
+        return list(self.get(id) for id in ids)
+
+    def put_many(self, items):
+        """
+        Store a batch of (id, doc) pairs. Backends override this to amortize
+        the per document overhead over the whole batch
+        """
+        for id, doc in items:
+            self.put(id, doc)
+
+    # module level function, so it can be handed to scan worker processes
+    loads = staticmethod(doc_codec.loads)
+
     def loaddoc(self, data):
-        return json.loads(data)
+        return self.loads(data)
 
     def dumpdoc(self, doc):
-        return json.dumps(doc)
+        if isinstance(doc, LazyDoc):
+            # the C encoders only see the stored blob references
+            doc = doc.copy()
+        return self.codec.dumps(doc)
 
     def cleanid(self, id):
         return str(uuid.UUID(id))
 
+    def _spill(self, doc):
+        """
+        Returns the core document to store and a dict of
+        field -> (reference, compressed data) for the fields to store out of line
+        """
+        if not self.blob_threshold:
+            return doc, {}
+        return spill(doc, self.blob_threshold, self.dumpdoc)
+
+    def _blob_loader(self, id):
+        raise NotImplementedError()
+
+    def _lazy(self, id, doc):
+        """
+        Wrap a stored document so its spilled fields are loaded on access,
+        while it is matched against a query. It is resolved by TargetDict
+        before it is returned.
+        """
+        if doc is not None and not isinstance(doc, LazyDoc) and has_blobs(doc):
+            return LazyDoc(doc, self._blob_loader(id))
+        return doc
+
+    def create_index(self, field):
+        raise NotImplementedError()
+
+    def drop_index(self, field):
+        raise NotImplementedError()
+
+    def list_indexes(self):
+        return []
+
     def filter(self, *kwds):
         raise NotImplementedError()
 
+    def explain(self, query=None, **kwds):
+        raise NotImplementedError()
+
+    def create_aggregate(self, group_by=None, metrics=None):
+        """
+        Declare an aggregate (see nebula.docstore.aggregate). It is computed
+        once from a scan, after that put and delete keep it up to date.
+        """
+        if self.aggregates is None:
+            raise NotImplementedError()
+        spec = AggregateSpec(group_by, metrics)
+        self.aggregates.add(spec, (doc for id, doc in self.filter(fields=spec.fields())))
+
+    def drop_aggregate(self, group_by=None, metrics=None):
+        if self.aggregates is not None:
+            self.aggregates.remove(AggregateSpec(group_by, metrics))
+
+    def list_aggregates(self):
+        if self.aggregates is None:
+            return []
+        return list( (a.group_by, a.metrics) for a in self.aggregates.specs() )
+
+    def aggregate(self, group_by=None, metrics=None, query=None, processes=None, **kwds):
+        """
+        Group the documents by the `group_by` field(s) and compute the
+        `metrics` ('count', 'sum:<field>', 'hist:<field>') of every group,
+        returns {group : {metric : value}}. Without filter conditions a
+        declared aggregate that covers the request answers from its
+        maintained totals, otherwise the matching documents are scanned.
+        """
+        spec = AggregateSpec(group_by, metrics)
+        if not query and not kwds and self.aggregates is not None:
+            agg = self.aggregates.find(spec)
+            if agg is not None:
+                return agg.result(spec.metrics)
+        docs = self.filter(processes=processes, fields=spec.fields(), query=query, **kwds)
+        return spec.result(compute(spec, (doc for id, doc in docs)))
+
+    def _update_aggregates(self, changes):
+        if self.aggregates is not None and len(self.aggregates):
+            self.aggregates.update(changes)
+
+    def _with_size(self, id, doc):
+        """
+        Set the file_size of a document being stored to the size
+        update_from_file recorded for its object, if there is one
+        """
+        with self.pending_lock:
+            size = self.pending_sizes.pop(id, None)
+        if size is None or doc.get('file_size', None) == size:
+            return doc
+        return dict(doc.iteritems(), file_size=size)
+
+    def _record_size(self, id, size):
+        with self.pending_lock:
+            self.pending_sizes.pop(id, None)
+            self.pending_sizes[id] = size
+            while len(self.pending_sizes) > MAX_PENDING_SIZES:
+                self.pending_sizes.popitem(last=False)
+
+    def create_bloom(self, capacity=None, error_rate=DEFAULT_ERROR_RATE):
+        """
+        Build Bloom filters of the stored ids (see nebula.docstore.bloom),
+        returns their stats as bloom_stats. Stores that don't keep them
+        answer every lookup themselves, and return no stats.
+        """
+        return self.bloom_stats()
+
+    def drop_bloom(self):
+        pass
+
+    def bloom_stats(self):
+        return {}
+
+    def create_lineage(self):
+        """
+        Build the lineage index (see nebula.docstore.lineage) from a scan of
+        the stored provenance, after which writes keep it up to date
+        """
+        raise NotImplementedError()
+
+    def parents(self, id):
+        """
+        The (uuid, job id) pairs of the inputs of the job that made `id`
+        """
+        raise NotImplementedError()
+
+    def children(self, id):
+        """
+        The (uuid, job id) pairs of the datasets made by jobs using `id`
+        """
+        raise NotImplementedError()
+
+    def ancestors(self, id, max_depth=None):
+        """
+        The uuids of the datasets `id` was derived from, up to `max_depth`
+        jobs back, found from the lineage index without scanning the store
+        """
+        return traverse(self.parents, self.cleanid(id), max_depth)
+
+    def descendants(self, id, max_depth=None):
+        """
+        The uuids of the datasets derived from `id`, ie the ones to
+        recompute if it changes, up to `max_depth` jobs on
+        """
+        return traverse(self.children, self.cleanid(id), max_depth)
+
+    def last_seq(self):
+        """
+        Sequence number of the latest change recorded by the store
+        """
+        raise NotImplementedError()
+
+    def changes(self, since=0):
+        """
+        Yield (seq, op, id) for each put ('put') and delete ('delete') made
+        after change number `since`, oldest first
+        """
+        raise NotImplementedError()
+
+    def wait_for_changes(self, since, timeout=None, poll_interval=0.1):
+        """
+        Block until there are changes after `since`, and return them as a
+        list. Returns an empty list if `timeout` seconds pass first.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.last_seq() <= since:
+            wait = poll_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return []
+            time.sleep(wait)
+        return list(self.changes(since))
+
     """
     ObjectStore methods
     """
@@ -81,7 +316,22 @@ class DocStore(ObjectStore):
         return self.objs.get_filename(obj, **kwds)
 
     def update_from_file(self, obj, file_name=None, create=False, **kwds):
-        return self.objs.update_from_file(obj, file_name=file_name, create=create, **kwds)
+        """
+        Store the data of an object. Its size is the file_size of its
+        document, so reports don't have to stat every file: an existing
+        document is rewritten if its file_size doesn't match, otherwise the
+        size is kept (for the last MAX_PENDING_SIZES objects) until this
+        handle puts the document.
+        """
+        out = self.objs.update_from_file(obj, file_name=file_name, create=create, **kwds)
+        id = self.cleanid(obj.id)
+        size = self.objs.size(obj)
+        doc = self.get(id, fields=["file_size"])
+        if doc is None:
+            self._record_size(id, size)
+        elif doc.get('file_size', None) != size:
+            self.put(id, dict(self.get(id), file_size=size))
+        return out
 
     def get_object_url(self, obj, **kwds):
         return self.objs.get_object_url(obj, **kwds)
@@ -92,85 +342,760 @@ class DocStore(ObjectStore):
     def local_cache_base(self):
         return self.objs.local_cache_base()
 
+    def pin(self, obj, lease=None):
+        return self.objs.pin(obj, lease=lease)
+
+    def unpin(self, obj):
+        return self.objs.unpin(obj)
+
+    def object_cache_stats(self):
+        return self.objs.cache_stats()
+
     def get_url(self):
         raise Exception("Not Implemented")
 
 
 class TargetDict(dict):
     def __init__(self, src):
+        if isinstance(src, LazyDoc):
+            # dict(), update() and ** read the storage of a dict directly,
+            # so what is handed out has every field loaded
+            src = src.resolve()
         dict.__init__(self, src)
         self.uuid = src['uuid']
         self.id = src.get('id', None)
 
+def filter_match(meta, filters):
+    """
+    Check a document against filter arguments (see nebula.docstore.query),
+    `filters` may also be an already compiled Query
+    """
+    return compile_query(filters).match(meta)
+
+def make_query(query, filters):
+    """
+    Combine the `query` dict and keyword filter arguments given to filter,
+    the query dict allows dotted paths that can't be keywords
+    """
+    if query:
+        filters = dict(filters)
+        filters.update(query)
+    return Query(filters)
+
 FILE_SUFFIX=".dat.json"
+CONFIG_NAME="docstore.json"
+STORAGE_MODES = ["files", "segment"]
+
+def doc_prefix(file_path, id, layout=DEFAULT_LAYOUT):
+    """
+    Path of a document's file in a FileDocStore, without the suffix. The
+    out of line fields of the document are stored next to it.
+    """
+    return os.path.join(shard_dir(file_path, id, layout), "dataset_" + id)
 
 class FileDocStore(DocStore):
     """
     Cheap and simple file based doc store, not recommended for large systems
+
+    Documents are either stored one file per document (storage="files", the
+    default) or appended to large segment files (storage="segment"). The
+    mode is recorded in the store's docstore.json when the store is created,
+    use migrate_storage to convert an existing store. The `codec` is
+    recorded there too, and used by every writer. Opening an existing store
+    with a different one is an error, use set_codec to change it. Documents
+    already stored keep their encoding until they are rewritten.
+
+    Recently read documents are kept decoded in an LRU cache bounded by
+    `doc_cache_entries` and `doc_cache_bytes` (set either to 0 to disable
+    it). A cached document is only used while the stat of its file (or its
+    location in the segments) is unchanged.
+
+    Out of line fields (see `blob_threshold`) are kept in the shard
+    directories in both storage modes, one file per field, named after the
+    hash of its content. The files of replaced fields are left for compact
+    to remove.
+
+    With create_lineage, the store keeps an index of the provenance edges
+    between datasets, for ancestors and descendants.
+
+    With create_bloom, the store keeps Bloom filters of its document and
+    object ids, so looking up ids it doesn't have (as bulk ingest does)
+    mostly doesn't touch the filesystem (see nebula.docstore.bloom).
+
+    The shard directories are `hash_depth` levels of `hash_width`
+    characters of the id (see nebula.docstore.layout), 1 and 2 by default.
+    The layout is recorded when the store is created, use reshard to
+    change it. The object files follow the same layout.
     """
 
-    def __init__(self, file_path, cache_path=None, **kwds):
+    def __init__(self, file_path, cache_path=None, indexes=None, storage=None, compact_interval=None,
+        doc_cache_entries=DEFAULT_MAX_ENTRIES, doc_cache_bytes=DEFAULT_MAX_BYTES, blob_threshold=None,
+        hash_depth=None, hash_width=None, codec=None, cache_size=None, **kwds):
+        new_store = not os.path.exists(file_path) or not len(os.listdir(file_path))
         if cache_path:
-            objs = CachedDiskObjectStore(DiskObjectStoreConfig(), cache_path=cache_path, file_path=file_path, **kwds)
+            objs = CachedDiskObjectStore(DiskObjectStoreConfig(), cache_path=cache_path, file_path=file_path, cache_size=cache_size, **kwds)
         else:
             objs = DiskObjectStore(DiskObjectStoreConfig(), file_path=file_path, **kwds)
-        super(FileDocStore, self).__init__(objectstore=objs, **kwds)
+        super(FileDocStore, self).__init__(objectstore=objs, blob_threshold=blob_threshold, **kwds)
         self.file_path = os.path.abspath(file_path)
         self.url = os.path.abspath(self.file_path)
         if not os.path.exists(self.file_path):
             os.mkdir(self.file_path)
+        self.config_stamp = None
+        self.config = self._read_config()
+        self._set_layout(*config_layouts(self.config))
+        if hash_depth or hash_width:
+            layout = check_layout( (hash_depth or self.layout[0], hash_width or self.layout[1]) )
+            if layout != self.layout:
+                if 'layout' in self.config or len(shard_dirs(self.file_path, self.layout)):
+                    raise Exception("DocStore %s uses layout depth=%d width=%d, use reshard to convert it" % ((self.file_path,) + self.layout))
+                self._write_config(layout_version=LAYOUT_VERSION, layout=list(layout))
+                self._set_layout(layout, None)
+        if storage is not None and storage != self.config.get('storage', 'files'):
+            if 'storage' in self.config or len(self._doclist()):
+                raise Exception("DocStore %s uses %s storage, use migrate_storage to convert it" % (self.file_path, self.config.get('storage', 'files')))
+            self._write_config(storage=storage)
+        self.storage = self.config.get('storage', 'files')
+        if self.storage not in STORAGE_MODES:
+            raise Exception("Unknown DocStore storage mode %s" % (self.storage))
+        self.segments = None
+        if self.storage == 'segment':
+            self.segments = SegmentStore(os.path.join(self.file_path, SEGMENT_DIR))
+            if compact_interval:
+                self.segments.start_compaction(interval=compact_interval)
+        if new_store and 'codec' not in self.config:
+            #the codec is recorded when the store is created, so opening it
+            #never has to look for documents to know if it can be changed
+            get_codec(codec)
+            self._write_config(codec=codec or DEFAULT_CODEC)
+        elif codec is not None and codec != self.config.get('codec', DEFAULT_CODEC):
+            raise Exception("DocStore %s uses the %s codec, use set_codec to change it" % (self.file_path, self.config.get('codec', DEFAULT_CODEC)))
+        self.codec = get_codec(self.config.get('codec', None))
+        self.doc_cache = None
+        if doc_cache_entries and doc_cache_bytes:
+            self.doc_cache = DocCache(max_entries=doc_cache_entries, max_bytes=doc_cache_bytes)
+        self.changelog = ChangeLog(os.path.join(self.file_path, CHANGES_DIR))
+        self.aggregates = AggregateSet(os.path.join(self.file_path, AGGREGATE_DIR))
+        self.indexes = IndexSet(os.path.join(self.file_path, INDEX_DIR))
+        self.lineage = LineageIndex(os.path.join(self.file_path, LINEAGE_DIR))
+        self.blooms = BloomSet(os.path.join(self.file_path, BLOOM_DIR))
+        for name in BLOOM_NAMES:
+            self.blooms.get(name)
+        for field in indexes or []:
+            if field not in self.indexes:
+                self.create_index(field)
+
+    def shutdown(self):
+        super(FileDocStore, self).shutdown()
+        if self.segments is not None:
+            self.segments.shutdown()
+
+    def _read_config(self):
+        path = os.path.join(self.file_path, CONFIG_NAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as handle:
+            st = os.fstat(handle.fileno())
+            self.config_stamp = (st.st_ino, st.st_size, st.st_mtime)
+            return json.loads(handle.read())
+
+    def _write_config(self, **kwds):
+        self.config.update(kwds)
+        path = os.path.join(self.file_path, CONFIG_NAME)
+        atomic_write(path, json.dumps(self.config))
+        st = os.stat(path)
+        self.config_stamp = (st.st_ino, st.st_size, st.st_mtime)
+
+    def _set_layout(self, layout, previous_layout):
+        self.layout = layout
+        self.previous_layout = previous_layout
+        self.objs.set_layout(layout, [previous_layout] if previous_layout else [])
+
+    def _refresh_layout(self):
+        """
+        Pick up a layout change made by another process (a reshard starting
+        or finishing), or a codec change
+        """
+        try:
+            st = os.stat(os.path.join(self.file_path, CONFIG_NAME))
+        except OSError:
+            return
+        if (st.st_ino, st.st_size, st.st_mtime) != self.config_stamp:
+            self.config = self._read_config()
+            self._set_layout(*config_layouts(self.config))
+            self.codec = get_codec(self.config.get('codec', None))
+
+    def set_codec(self, codec):
+        """
+        Write documents with `codec` from now on, in every process using the
+        store. Documents already stored keep their encoding until they are
+        rewritten.
+        """
+        self.codec = get_codec(codec)
+        self._write_config(codec=codec)
+
+    def _layouts(self):
+        self._refresh_layout()
+        if self.previous_layout is None:
+            return [self.layout]
+        return [self.layout, self.previous_layout]
+
+    def _prefixes(self, id):
+        """
+        Where the document may be, in the current layout and then, during a
+        reshard, in the previous one
+        """
+        return list( doc_prefix(self.file_path, id, layout) for layout in self._layouts() )
 
     def _docpath(self, id):
-        return os.path.join(self.file_path, id[:2], "dataset_" + id + FILE_SUFFIX)
+        prefixes = self._prefixes(id)
+        path = prefixes[0] + FILE_SUFFIX
+        if len(prefixes) > 1 and not os.path.exists(path) and os.path.exists(prefixes[1] + FILE_SUFFIX):
+            return prefixes[1] + FILE_SUFFIX
+        return path
 
     def _doclist(self):
-        return glob(os.path.join(self.file_path, "*", "dataset_*" + FILE_SUFFIX))
+        out = {}
+        for layout in reversed(self._layouts()):
+            for dir in shard_dirs(self.file_path, layout):
+                for path in glob(os.path.join(dir, "dataset_*" + FILE_SUFFIX)):
+                    out[os.path.basename(path)] = path
+        return sorted(out.values())
 
-    def get(self, id):
-        id = self.cleanid(id)
+    def _unshard(self, id):
+        """
+        Move a document (and its spilled fields) left in the previous layout
+        to the current one, before it is rewritten
+        """
+        prefixes = self._prefixes(id)
+        if len(prefixes) < 2:
+            return
+        if self.segments is None:
+            if not os.path.exists(prefixes[1] + FILE_SUFFIX):
+                return
+            suffixes = [FILE_SUFFIX]
+        else:
+            suffixes = []
+        data = self._read_raw(id)
+        if data is not None:
+            suffixes += list( blob_path("", field, ref) for field, ref in stale_blobs(self.loaddoc(data), None) )
+        for suffix in suffixes:
+            move_entry(prefixes[1] + suffix, prefixes[0] + suffix)
+
+    def _read_raw(self, id):
+        if self.segments is not None:
+            return self.segments.get(id)
         path = self._docpath(id)
         if not os.path.exists(path):
             return None
         with open(path) as handle:
-            data = handle.read()
-        return TargetDict(self.loaddoc(data))
+            return handle.read()
+
+    def _stamp(self, id):
+        """
+        Cheap token that changes whenever the stored document does, or None
+        if the document doesn't exist
+        """
+        if self.segments is not None:
+            self.segments.refresh()
+            return self.segments.entries.get(id, None)
+        try:
+            st = os.stat(self._docpath(id))
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _read_doc(self, id, keys=None):
+        """
+        Read and decode a document, through the document cache. Reads of
+        only some fields decode just those on a miss, and aren't cached.
+        """
+        stamp = None
+        if self.doc_cache is not None:
+            stamp = self._stamp(id)
+            if stamp is None:
+                return None
+            doc = self.doc_cache.get(id, stamp, keys)
+            if doc is not None:
+                return doc
+        data = self._read_raw(id)
+        if data is None:
+            return None
+        if keys is not None or stamp is None:
+            return self._decode(id, data, keys)
+        doc = self._decode(id, data)
+        size = len(data)
+        if has_blobs(doc):
+            # cached with its spilled fields, which are never rewritten in
+            # place, so the stamp of the document covers them
+            size += sum( v['size'] for v in doc.itervalues() if is_blob_ref(v) )
+            doc = dict(LazyDoc(doc, self._blob_loader(id)).resolve())
+        self.doc_cache.put(id, stamp, doc, size)
+        return copy_doc(doc)
+
+    def _invalidate(self, ids):
+        if self.doc_cache is not None:
+            for id in ids:
+                self.doc_cache.invalidate(id)
+
+    def cache_stats(self):
+        if self.doc_cache is None:
+            return {}
+        return self.doc_cache.stats()
+
+    def _decode(self, id, data, keys=None):
+        try:
+            if keys is None:
+                return self.loaddoc(data)
+            return load_fields(data, self.loads, keys)
+        except ValueError:
+            raise Exception("Error reading record %s" % (id))
+
+    def _load(self, id, keys=None):
+        if not self.blooms.might_contain("docs", id):
+            return None
+        return self._lazy(id, self._read_doc(id, keys))
+
+    def _blob_loader(self, id):
+        return FileBlobLoader(self._prefixes(id), self.loads)
+
+    def _write_blobs(self, id, blobs):
+        """
+        Write out the spilled fields of a document, returns the new files.
+        Blobs are named after their content, so unchanged fields are not
+        written again, but their mtime is refreshed so collect_blobs leaves
+        them alone.
+        """
+        prefix = self._prefixes(id)[0]
+        written = []
+        for field, (ref, data) in blobs.items():
+            path = blob_path(prefix, field, ref)
+            if os.path.exists(path):
+                try:
+                    os.utime(path, None)
+                    continue
+                except OSError:
+                    pass
+            os.rename(write_temp(path, data), path)
+            written.append(path)
+        return written
+
+    def collect_blobs(self, grace=BLOB_GRACE):
+        """
+        Remove the out of line field files no document uses any more, once
+        they haven't been written for `grace` seconds, so a reader still
+        holding the old document can finish with it. Returns the number of
+        files removed.
+        """
+        found = {}
+        for layout in self._layouts():
+            for dir in shard_dirs(self.file_path, layout):
+                for name in os.listdir(dir):
+                    if name.endswith(BLOB_SUFFIX):
+                        found.setdefault(entry_id(name), []).append(os.path.join(dir, name))
+        now = time.time()
+        removed = 0
+        for id, paths in found.items():
+            data = self._read_raw(id)
+            used = set()
+            if data is not None:
+                used = set( blob_path("dataset_" + id, field, ref) for field, ref in stale_blobs(self.loaddoc(data), None) )
+            for path in paths:
+                if os.path.basename(path) in used:
+                    continue
+                try:
+                    if now - os.stat(path).st_mtime < grace:
+                        continue
+                    os.unlink(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def get(self, id, fields=None):
+        """
+        Fetch a document. If a list of `fields` (which may be dotted paths
+        like 'job.exit_code') is given, only those are decoded and returned.
+        """
+        id = self.cleanid(id)
+        if fields is None:
+            doc = self._load(id)
+        else:
+            doc = self._load(id, top_level(fields) | set(ALWAYS_FIELDS))
+        if doc is None:
+            return None
+        if fields is not None:
+            doc = project(doc, fields)
+        return TargetDict(doc)
 
     def put(self, id, doc):
         id = self.cleanid(id)
-        dir = os.path.join(self.file_path, id[:2])
-        if not os.path.exists(dir):
-            os.mkdir(dir)
-        path =self._docpath(id)
-        with open(path, "w") as handle:
-            handle.write(self.dumpdoc(doc))
-
-    def filter(self, **kwds):
-        for a in self._doclist():
-            doc_id = os.path.basename(a).replace(FILE_SUFFIX, "").replace("dataset_", "")
-            with open(a) as handle:
+        doc = self._with_size(id, doc)
+        self._unshard(id)
+        with self.aggregates.locked():
+            old_doc = None
+            if len(self.indexes) or len(self.aggregates):
+                old_doc = self._load(id)
+            core, blobs = self._spill(doc)
+            if self.segments is None or len(blobs):
+                dir = shard_dir(self.file_path, id, self.layout)
+                if not os.path.exists(dir):
+                    os.makedirs(dir)
+            self._write_blobs(id, blobs)
+            self.indexes.add_postings([(id, old_doc, doc)])
+            bloom = self.blooms.add("docs", [id])
+            if self.segments is not None:
+                self.segments.put(id, self.dumpdoc(core))
+            else:
+                path = self._docpath(id)
+                # a new file (and inode) for every write, so the stamp of a
+                # rewrite of the same size in the same tick still changes
+                os.rename(write_temp(path, self.dumpdoc(core)), path)
+            self.blooms.recheck("docs", [id], bloom)
+            self._invalidate([id])
+            self.indexes.remove_postings([(id, old_doc, doc)])
+            self._update_aggregates([(old_doc, doc)])
+        if self.lineage.maintained():
+            self.lineage.update(id, lineage_edges(doc))
+        self.changelog.append([("P", id)])
+
+    def put_many(self, items, sync=True):
+        """
+        Store a batch of documents. Missing shard directories are created
+        once up front, each document is written to a temporary file and
+        they are renamed into place once all of them are written, and if `sync` is set the batch is flushed to
+        disk once at the end rather than per document. In segment mode the
+        batch is a single append.
+        """
+        items = list( (self.cleanid(id), doc) for id, doc in items )
+        items = list( (id, self._with_size(id, doc)) for id, doc in items )
+        for id, doc in items:
+            self._unshard(id)
+        with self.aggregates.locked():
+            old_docs = {}
+            if len(self.indexes) or len(self.aggregates):
+                for id, doc in items:
+                    old_docs[id] = self._load(id)
+            spilled = list( (id,) + self._spill(doc) for id, doc in items )
+            shards = set( shard_dir(self.file_path, id, self.layout) for id, core, blobs in spilled
+                if self.segments is None or len(blobs) )
+            for dir in shards:
+                if not os.path.exists(dir):
+                    os.makedirs(dir)
+            written = []
+            for id, core, blobs in spilled:
+                written.extend(self._write_blobs(id, blobs))
+            changes = list( (id, old_docs.get(id, None), doc) for id, doc in items )
+            self.indexes.add_postings(changes)
+            ids = list( id for id, doc in items )
+            bloom = self.blooms.add("docs", ids, sync=sync)
+            if self.segments is not None:
+                if sync and len(written):
+                    sync_batch(written, shards)
+                self.segments.put_many( ((id, self.dumpdoc(core)) for id, core, blobs in spilled), sync=sync )
+            else:
+                # all or nothing: the batch only becomes visible once every
+                # document of it is on disk
+                last = dict( (id, i) for i, (id, core, blobs) in enumerate(spilled) )
+                temps = []
                 try:
-                    meta = json.loads(handle.read())
-                except ValueError:
-                    raise Exception("Error reading record %s" % (doc_id))
-                match = True
-                for k,v in kwds.items():
-                    if k not in meta:
-                        match = False
-                    else:
-                        if hasattr(v, "__iter__"):
-                            if meta[k] not in v:
-                                match = False
-                        else:
-                            if meta[k] != v:
-                                match = False
-                if match:
-                    yield doc_id, TargetDict(meta)
+                    for i, (id, core, blobs) in enumerate(spilled):
+                        if last[id] != i:
+                            continue
+                        path = self._docpath(id)
+                        temps.append( (write_temp(path, self.dumpdoc(core)), path) )
+                except:
+                    for tmp, path in temps:
+                        os.unlink(tmp)
+                    raise
+                for tmp, path in temps:
+                    os.rename(tmp, path)
+                    written.append(path)
+                if sync and len(written):
+                    sync_batch(written, shards)
+            self.blooms.recheck("docs", ids, bloom, sync=sync)
+            self._invalidate(id for id, doc in items)
+            self.indexes.remove_postings(changes)
+            self._update_aggregates( (old_docs.get(id, None), doc) for id, doc in items )
+        if self.lineage.maintained():
+            self.lineage.update_many( (id, lineage_edges(doc)) for id, doc in items )
+        self.changelog.append( ("P", id) for id, doc in items )
+
+    def _scan_data(self):
+        if self.segments is not None:
+            for doc_id, data in self.segments.scan():
+                yield doc_id, data
+        else:
+            for a in self._doclist():
+                doc_id = os.path.basename(a).replace(FILE_SUFFIX, "").replace("dataset_", "")
+                with open(a) as handle:
+                    data = handle.read()
+                yield doc_id, data
+
+    def _scan(self, keys=None):
+        for doc_id, data in self._scan_data():
+            yield doc_id, self._lazy(doc_id, self._decode(doc_id, data, keys))
+
+    def filter(self, processes=None, ordered=True, fields=None, query=None, **kwds):
+        """
+        Yield (id, doc) for the documents matching the filter arguments and
+        the `query` dict (see nebula.docstore.query for the operators). If
+        one of the conditions can be answered by an index, only the
+        documents it returns are read and checked against the rest,
+        otherwise every document is scanned. If `processes` is given, the
+        scan is spread over a pool of that many worker processes, and unless
+        `ordered` is set results are returned as soon as a worker has them.
+        With a list of `fields` only those are decoded and returned, as with get.
+        """
+        q = make_query(query, kwds)
+        keys = None
+        if fields is not None:
+            keys = top_level(fields) | q.keys() | set(ALWAYS_FIELDS)
+        candidates = self.indexes.candidates(q)
+        if candidates is None:
+            if processes:
+                results = parallel_filter(self, q, processes, ordered=ordered, keys=keys)
+            else:
+                results = ( (doc_id, meta) for doc_id, meta in self._scan(keys) if q.match(meta) )
+        else:
+            results = ( (doc_id, meta) for doc_id, meta in ( (i, self._load(i, keys)) for i in sorted(candidates) )
+                if meta is not None and q.match(meta) )
+        for doc_id, meta in results:
+            meta = self._lazy(doc_id, meta)
+            if fields is not None:
+                meta = project(meta, fields)
+            yield doc_id, TargetDict(meta)
+
+    def explain(self, query=None, **kwds):
+        """
+        Describe how filter would evaluate a query: the index condition
+        used to find candidates (if any), its estimated cost in posting
+        bytes, and the conditions checked on each document
+        """
+        q = make_query(query, kwds)
+        plan = self.indexes.plan(q)
+        if plan is None:
+            return {"index" : None, "scan" : True, "residual" : list( p[:2] for p in q.predicates )}
+        return {
+            "index" : plan[:2],
+            "estimate" : plan[3],
+            "scan" : False,
+            "residual" : list( p[:2] for p in q.predicates if p[:2] != plan[:2] )
+        }
+
+    def create_index(self, field):
+        """
+        Declare an index on a document field (or dotted path). Existing documents
+        are scanned once to build it, after that put and delete keep it up
+        to date, and filter uses it whenever the field is a filter key.
+        """
+        self.indexes.add(field, self._scan())
+
+    def drop_index(self, field):
+        self.indexes.remove(field)
+
+    def list_indexes(self):
+        return self.indexes.fields()
+
+    def rebuild_indexes(self):
+        """
+        Rebuild (and compact) all of the declared indexes from a full scan
+        """
+        for field in self.indexes.fields():
+            self.indexes.add(field, self._scan())
+
+    def create_lineage(self):
+        self.lineage.build(self.filter(fields=["provenance"]))
+
+    def drop_lineage(self):
+        self.lineage.clear()
+
+    def _check_lineage(self):
+        if not self.lineage.enabled():
+            raise Exception("DocStore %s has no lineage index, use create_lineage to build it" % (self.file_path))
+
+    def parents(self, id):
+        self._check_lineage()
+        return self.lineage.edges(PARENTS, self.cleanid(id))
+
+    def children(self, id):
+        self._check_lineage()
+        return self.lineage.edges(CHILDREN, self.cleanid(id))
+
+    def ids(self):
+        if self.segments is not None:
+            return self.segments.ids()
+        return list( os.path.basename(a)[len("dataset_"):-len(FILE_SUFFIX)] for a in self._doclist() )
+
+    def _object_ids(self):
+        dirs = [self.file_path]
+        for layout in self._layouts():
+            dirs.extend(shard_dirs(self.file_path, layout))
+        out = set()
+        for dir in dirs:
+            for name in os.listdir(dir):
+                if not name.endswith(FILE_SUFFIX) and not name.endswith(BLOB_SUFFIX):
+                    id = entry_id(name)
+                    if id is not None:
+                        out.add(id)
+        return out
+
+    def create_bloom(self, capacity=None, error_rate=DEFAULT_ERROR_RATE):
+        """
+        Build (or rebuild) the Bloom filters of the document and object ids
+        from a scan of the store, sized for `capacity` ids (twice the
+        current number by default) at `error_rate` false positives.
+        Returns their stats, as bloom_stats.
+        """
+        self.blooms.build({"docs" : self.ids, "objects" : self._object_ids}, capacity=capacity, error_rate=error_rate)
+        return self.bloom_stats()
+
+    def drop_bloom(self):
+        self.blooms.clear()
+
+    def bloom_stats(self):
+        """
+        Size, fill ratio and false positive rate of each Bloom filter
+        """
+        return self.blooms.stats()
+
+    def exists(self, obj, **kwds):
+        if not kwds and not self.blooms.might_contain("objects", obj.id):
+            return False
+        return self.objs.exists(obj, **kwds)
+
+    def create(self, obj, **kwds):
+        bloom = self.blooms.add("objects", [obj.id])
+        out = self.objs.create(obj, **kwds)
+        self.blooms.recheck("objects", [obj.id], bloom)
+        return out
+
+    def get_filename(self, obj, **kwds):
+        # the caller may write the file, so the filter has to know the id
+        if not kwds and not self.blooms.might_contain("objects", obj.id):
+            self.blooms.add("objects", [obj.id])
+        return self.objs.get_filename(obj, **kwds)
+
+    def update_from_file(self, obj, file_name=None, create=False, **kwds):
+        bloom = self.blooms.add("objects", [obj.id])
+        out = super(FileDocStore, self).update_from_file(obj, file_name=file_name, create=create, **kwds)
+        self.blooms.recheck("objects", [obj.id], bloom)
+        return out
+
+    def last_seq(self):
+        return self.changelog.last_seq()
+
+    def changes(self, since=0):
+        return self.changelog.read(since)
+
+    def compact(self, blob_grace=BLOB_GRACE):
+        """
+        Compact the segments (in segment storage) until no garbage is left
+        that can be dropped, and remove the unused out of line field files
+        older than `blob_grace` seconds
+        """
+        if self.segments is not None:
+            while self.segments.compact(threshold=0):
+                pass
+        self.collect_blobs(blob_grace)
+
+    def migrate_storage(self, storage, batch_size=1000):
+        """
+        One-shot conversion of the documents in the store to another
+        storage mode. The documents are copied over, the store config is
+        switched, and only then are the old copies removed.
+        """
+        if storage not in STORAGE_MODES:
+            raise Exception("Unknown DocStore storage mode %s" % (storage))
+        if storage == self.storage:
+            return
+        if self.doc_cache is not None:
+            self.doc_cache.clear()
+        if storage == "segment":
+            segments = SegmentStore(os.path.join(self.file_path, SEGMENT_DIR))
+            paths = self._doclist()
+            batch = []
+            for path in paths:
+                doc_id = os.path.basename(path).replace(FILE_SUFFIX, "").replace("dataset_", "")
+                with open(path) as handle:
+                    batch.append( (doc_id, handle.read()) )
+                if len(batch) >= batch_size:
+                    segments.put_many(batch)
+                    batch = []
+            segments.put_many(batch, sync=True)
+            segments.save_snapshot()
+            self._write_config(storage=storage)
+            self.segments = segments
+            for path in paths:
+                os.unlink(path)
+        else:
+            for doc_id, data in self.segments.scan():
+                dir = shard_dir(self.file_path, doc_id, self.layout)
+                if not os.path.exists(dir):
+                    os.makedirs(dir)
+                atomic_write(self._docpath(doc_id), data)
+            self._write_config(storage=storage)
+            self.segments.shutdown()
+            self.segments = None
+            shutil.rmtree(os.path.join(self.file_path, SEGMENT_DIR))
+        self.storage = storage
+
+    def reshard(self, depth, width):
+        """
+        Move the store to a layout of `depth` levels of `width` characters.
+        The new layout is recorded first, and while the entries of the shard
+        directories (documents, spilled fields and object files) are moved
+        over, they are found in either place and rewritten in the new one,
+        so the store stays usable. If interrupted, running it again carries
+        on where it stopped. Returns the number of entries moved.
+        """
+        layout = check_layout((depth, width))
+        self._refresh_layout()
+        if self.previous_layout is None:
+            if layout == self.layout:
+                return 0
+            self._write_config(layout_version=LAYOUT_VERSION, layout=list(layout), previous_layout=list(self.layout))
+            self._set_layout(layout, self.layout)
+        elif layout != self.layout:
+            raise Exception("DocStore %s is being resharded to depth=%d width=%d, finish that first" % ((self.file_path,) + self.layout))
+        if self.doc_cache is not None:
+            self.doc_cache.clear()
+        moved = 0
+        for dir in shard_dirs(self.file_path, self.previous_layout):
+            for name in os.listdir(dir):
+                id = entry_id(name)
+                if id is None:
+                    continue
+                if move_entry(os.path.join(dir, name), os.path.join(shard_dir(self.file_path, id, layout), name)):
+                    moved += 1
+            remove_empty_dirs(self.file_path, dir)
+        del self.config['previous_layout']
+        self._write_config()
+        self._set_layout(layout, None)
+        return moved
 
     def delete(self, obj, **kwds):
-        path = self._docpath(obj.id)
-        print "Delete", path
-        if os.path.exists(path):
-            os.unlink(path)
+        id = self.cleanid(obj.id)
+        with self.aggregates.locked():
+            old_doc = None
+            if len(self.indexes) or len(self.aggregates):
+                old_doc = self._load(id)
+            deleted = False
+            if self.segments is not None:
+                deleted = self.segments.delete(id)
+            else:
+                path = self._docpath(id)
+                print "Delete", path
+                if os.path.exists(path):
+                    os.unlink(path)
+                    deleted = True
+            if deleted:
+                self.indexes.update(id, old_doc, None)
+                self._update_aggregates([(old_doc, None)])
+                if self.lineage.maintained():
+                    self.lineage.update(id, set())
+                self.changelog.append([("D", id)])
+        self._invalidate([id])
         return self.objs.delete(obj, **kwds)
 
     def get_url(self):
@@ -0,0 +1,419 @@
+"""
+Incrementally maintained aggregates for doc stores
+
+An aggregate groups the documents by the value of one or more fields and
+keeps a set of metrics for every group:
+
+    count           number of documents
+    sum:<field>     sum of a numeric field (ie sum:file_size)
+    hist:<field>    histogram of a numeric field, in power of two buckets
+
+Fields are paths as in filter, or one of the DERIVED_FIELDS computed from
+the document (ie runtime_seconds, taken from the job metrics).
+
+Declared aggregates live under <docstore>/_aggregates/<name>. The totals
+are kept in state.json, and every put or delete appends the change it
+makes to the totals to deltas.log, which is folded back into state.json
+once it grows past COMPACT_SIZE. Writers hold <docstore>/_aggregates/lock
+(AggregateSet.locked) from reading the documents they replace until their
+deltas are logged, so two writers of a document can't both subtract the
+same old version. Reading an aggregate costs the size of
+the result plus the deltas since the last fold, not a scan of the store.
+"""
+
+import os
+import json
+import math
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from nebula.docstore.project import get_path
+from nebula.docstore.segment import flocked
+from nebula.docstore.fileutil import atomic_write
+
+AGGREGATE_DIR = "_aggregates"
+AGGREGATE_MANIFEST = "aggregates.json"
+STATE_NAME = "state.json"
+DELTA_NAME = "deltas.log"
+LOCK_NAME = "lock"
+COMPACT_SIZE = 1024 * 1024
+
+METRIC_KINDS = ["sum", "hist"]
+
+
+def job_metric(doc, name):
+    """
+    Value of one of the Galaxy job metrics stored with a document
+    """
+    job = doc.get("job", None)
+    if not isinstance(job, dict):
+        return None
+    for met in job.get("job_metrics", []):
+        if met.get("name", None) == name:
+            return met.get("raw_value", None)
+    return None
+
+
+DERIVED_FIELDS = {
+    "runtime_seconds" : lambda doc: job_metric(doc, "runtime_seconds")
+}
+
+# the document fields each derived field is computed from
+DERIVED_SOURCES = {
+    "runtime_seconds" : ["job.job_metrics"]
+}
+
+
+def field_value(doc, path):
+    if path in DERIVED_FIELDS:
+        return DERIVED_FIELDS[path](doc)
+    return get_path(doc, path)
+
+
+def number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, long, float)):
+        return value
+    if isinstance(value, basestring):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def hist_bucket(value):
+    """
+    Lower bound of the power of two bucket holding value
+    """
+    if value < 1:
+        return 0
+    return 2 ** int(math.floor(math.log(value, 2)))
+
+
+def check_metric(metric):
+    if metric == "count":
+        return
+    kind, sep, field = metric.partition(":")
+    if kind not in METRIC_KINDS or not field or "\t" in field:
+        raise Exception("Invalid aggregate metric: %s" % (metric))
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(a) for a in value)
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+class AggregateSpec(object):
+    """
+    The grouping and the metrics of an aggregate, and how a document
+    contributes to them
+    """
+
+    def __init__(self, group_by=None, metrics=None):
+        if group_by is None:
+            group_by = []
+        elif isinstance(group_by, basestring):
+            group_by = [group_by]
+        self.group_by = list(group_by)
+        self.metrics = sorted(set(metrics or ["count"]))
+        for metric in self.metrics:
+            check_metric(metric)
+
+    def name(self):
+        return hashlib.sha1(json.dumps([self.group_by, self.metrics])).hexdigest()[:16]
+
+    def fields(self):
+        """
+        The document fields needed to evaluate the aggregate
+        """
+        out = set()
+        for f in self.group_by + list( m.partition(":")[2] for m in self.metrics if m != "count" ):
+            out.update(DERIVED_SOURCES.get(f, [f]))
+        return sorted(out)
+
+    def covers(self, group_by, metrics):
+        return self.group_by == group_by and set(metrics) <= set(self.metrics)
+
+    def contributions(self, doc):
+        """
+        The totals a document adds to, as a dict of
+        '<group>\\t<metric>[\\t<bucket>]' -> amount
+        """
+        out = {}
+        if doc is None:
+            return out
+        group = json.dumps(list(field_value(doc, f) for f in self.group_by), sort_keys=True)
+        for metric in self.metrics:
+            if metric == "count":
+                out[group + "\tcount"] = 1
+                continue
+            kind, sep, field = metric.partition(":")
+            value = number(field_value(doc, field))
+            if value is None:
+                continue
+            if kind == "sum":
+                out[group + "\t" + metric] = value
+            else:
+                out["%s\t%s\t%s" % (group, metric, hist_bucket(value))] = 1
+        return out
+
+    def deltas(self, changes):
+        """
+        The change to the totals made by a batch of (old_doc, new_doc) pairs
+        """
+        out = {}
+        for old_doc, new_doc in changes:
+            for key, v in self.contributions(old_doc).items():
+                out[key] = out.get(key, 0) - v
+            for key, v in self.contributions(new_doc).items():
+                out[key] = out.get(key, 0) + v
+        return dict( (k, v) for k, v in out.items() if v != 0 )
+
+    def result(self, totals, metrics=None):
+        """
+        Format a totals dict as {group : {metric : value}}, histograms are
+        {bucket : count}
+        """
+        if metrics is None:
+            metrics = self.metrics
+        metrics = set(metrics)
+        out = {}
+        live = set()
+        for key, v in totals.items():
+            parts = key.split("\t")
+            if parts[1] == "count":
+                live.add(parts[0])
+            if parts[1] not in metrics:
+                continue
+            entry = out.setdefault(parts[0], {})
+            if len(parts) == 3:
+                entry.setdefault(parts[1], {})[float(parts[2]) if "." in parts[2] else int(parts[2])] = v
+            else:
+                entry[parts[1]] = v
+        if "count" in self.metrics:
+            # float sums of groups whose documents were all removed may not
+            # come back to exactly zero
+            out = dict( (k, v) for k, v in out.items() if k in live )
+        return dict( (self.group(k), v) for k, v in out.items() )
+
+    def group(self, key):
+        """
+        The value of the group_by field, a tuple of values if there are
+        several of them, or None if the documents aren't grouped
+        """
+        values = json.loads(key)
+        if len(self.group_by) == 0:
+            return None
+        if len(self.group_by) == 1:
+            return _hashable(values[0])
+        return tuple(_hashable(a) for a in values)
+
+
+def merge(totals, deltas):
+    for key, v in deltas.items():
+        total = totals.get(key, 0) + v
+        if total == 0:
+            totals.pop(key, None)
+        else:
+            totals[key] = total
+
+
+def compute(spec, docs):
+    """
+    Evaluate an aggregate over an iterable of documents
+    """
+    totals = {}
+    for doc in docs:
+        merge(totals, spec.contributions(doc))
+    return totals
+
+
+class Aggregate(object):
+    """
+    A declared aggregate: a state file with the totals as of the last fold,
+    and a log of the deltas applied since
+    """
+
+    def __init__(self, base_path, spec):
+        self.spec = spec
+        self.path = os.path.join(base_path, spec.name())
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.state_path = os.path.join(self.path, STATE_NAME)
+        self.delta_path = os.path.join(self.path, DELTA_NAME)
+        self.lock_path = os.path.join(self.path, LOCK_NAME)
+        self.cache = (None, 0, {})
+
+    def _read_state(self):
+        try:
+            st = os.stat(self.state_path)
+        except OSError:
+            return (None, 0, {})
+        stamp = (st.st_ino, st.st_size, st.st_mtime)
+        if stamp == self.cache[0]:
+            return self.cache
+        with open(self.state_path) as handle:
+            return (stamp, 0, json.loads(handle.read()))
+
+    def totals(self):
+        """
+        Current totals, only the deltas logged since the last call are read
+        """
+        with flocked(self.lock_path, fcntl.LOCK_SH):
+            stamp, offset, totals = self._read_state()
+            totals = dict(totals)
+            if os.path.exists(self.delta_path):
+                with open(self.delta_path) as handle:
+                    handle.seek(offset)
+                    for line in handle:
+                        if not line.endswith("\n"):
+                            break
+                        merge(totals, json.loads(line))
+                        offset += len(line)
+            self.cache = (stamp, offset, totals)
+        return totals
+
+    def result(self, metrics=None):
+        return self.spec.result(self.totals(), metrics)
+
+    def update(self, changes):
+        deltas = self.spec.deltas(changes)
+        if not deltas:
+            return
+        with flocked(self.lock_path):
+            with open(self.delta_path, "a") as handle:
+                handle.write(json.dumps(deltas) + "\n")
+                size = handle.tell()
+            if size >= COMPACT_SIZE:
+                self._fold()
+
+    def _fold(self):
+        """
+        Merge the deltas into the state file, with the lock held
+        """
+        stamp, offset, totals = self._read_state()
+        totals = dict(totals)
+        with open(self.delta_path) as handle:
+            for line in handle:
+                if line.endswith("\n"):
+                    merge(totals, json.loads(line))
+        self._write(totals)
+
+    def _write(self, totals):
+        atomic_write(self.state_path, json.dumps(totals))
+        with open(self.delta_path, "w"):
+            pass
+        self.cache = (None, 0, {})
+
+    def build(self, docs):
+        totals = compute(self.spec, docs)
+        with flocked(self.lock_path):
+            self._write(totals)
+
+    def clear(self):
+        for name in [STATE_NAME, DELTA_NAME, LOCK_NAME]:
+            path = os.path.join(self.path, name)
+            if os.path.exists(path):
+                os.unlink(path)
+        os.rmdir(self.path)
+
+
+class AggregateSet(object):
+    """
+    The aggregates declared on a docstore
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.aggregates = {}
+        self.manifest_mtime = None
+        self.refresh()
+
+    def refresh(self):
+        manifest = os.path.join(self.path, AGGREGATE_MANIFEST)
+        try:
+            mtime = os.stat(manifest).st_mtime
+        except OSError:
+            return
+        if mtime == self.manifest_mtime:
+            return
+        with open(manifest) as handle:
+            specs = list( AggregateSpec(group_by, metrics) for group_by, metrics in json.loads(handle.read()) )
+        self.aggregates = dict( (s.name(), self.aggregates.get(s.name(), None) or Aggregate(self.path, s)) for s in specs )
+        self.manifest_mtime = mtime
+
+    def __len__(self):
+        self.refresh()
+        return len(self.aggregates)
+
+    def specs(self):
+        self.refresh()
+        return list( a.spec for a in self.aggregates.values() )
+
+    def _write_manifest(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        manifest = os.path.join(self.path, AGGREGATE_MANIFEST)
+        atomic_write(manifest, json.dumps(sorted( [a.spec.group_by, a.spec.metrics] for a in self.aggregates.values() )))
+        self.manifest_mtime = os.stat(manifest).st_mtime
+
+    def add(self, spec, docs):
+        self.refresh()
+        agg = Aggregate(self.path, spec)
+        agg.build(docs)
+        self.aggregates[spec.name()] = agg
+        self._write_manifest()
+        return agg
+
+    def remove(self, spec):
+        self.refresh()
+        agg = self.aggregates.pop(spec.name(), None)
+        if agg is not None:
+            agg.clear()
+            self._write_manifest()
+
+    def fields(self):
+        """
+        The document fields needed to update all of the aggregates
+        """
+        out = set()
+        for spec in self.specs():
+            out.update(spec.fields())
+        return sorted(out)
+
+    def find(self, spec):
+        """
+        A declared aggregate that can answer for `spec`, or None
+        """
+        self.refresh()
+        for agg in self.aggregates.values():
+            if agg.spec.covers(spec.group_by, spec.metrics):
+                return agg
+        return None
+
+    @contextmanager
+    def locked(self):
+        """
+        Exclusive lock for a writer, taken before it reads the documents
+        it replaces and held until update. Does nothing while no aggregates
+        are declared.
+        """
+        if not len(self):
+            yield
+            return
+        with flocked(os.path.join(self.path, LOCK_NAME)):
+            yield
+
+    def update(self, changes):
+        """
+        Apply a batch of (old_doc, new_doc) pairs to every aggregate
+        """
+        self.refresh()
+        changes = list(changes)
+        for agg in self.aggregates.values():
+            agg.update(changes)
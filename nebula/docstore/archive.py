@@ -0,0 +1,357 @@
+"""
+Chunked archive format for moving a doc store between sites
+
+An archive is a directory:
+
+    manifest.json       format version, compression and chunk list
+    <chunk>.dat         the records of a chunk, one after the other
+    <chunk>.idx         one JSON line per record in <chunk>.dat, then an
+                        end line once the chunk is complete
+
+Documents are split into chunks by the first `prefix_len` characters of
+their id, and every chunk is written (and read back) by its own worker, so
+a move runs as many streams as there are workers. Each document becomes a
+'doc' record holding its JSON, preceded by a 'data' record with the
+content of its object file if it has one. Records are optionally zlib
+compressed, and the index line of a record gives its offset and size in
+the chunk, its uncompressed length and the sha1 of its uncompressed
+content, which is checked on import.
+
+The 'data' record of a document comes before its 'doc' record, and index
+lines are only written once the data they point to has been flushed, so
+an interrupted export is resumed by dropping whatever follows the last
+indexed 'doc' record of each chunk and carrying on with the ids not
+exported yet. Chunks finished by an earlier attempt are left as they are,
+with a warning if documents have been added to them since.
+Imports record how many records of each chunk they have stored in a state
+file, and skip those when rerun.
+"""
+
+import os
+import json
+import zlib
+import hashlib
+import logging
+import tempfile
+from multiprocessing.pool import ThreadPool
+from nebula.target import Target
+
+FORMAT_NAME = "nebula-docstore-archive"
+FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+DATA_SUFFIX = ".dat"
+INDEX_SUFFIX = ".idx"
+COMPRESSIONS = ["zlib", "none"]
+BLOCK_SIZE = 1024 * 1024
+IMPORT_BATCH = 100
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def chunk_name(prefix):
+    return "chunk-%s" % (prefix)
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_NAME)) as handle:
+        manifest = json.loads(handle.read())
+    if manifest.get("format", None) != FORMAT_NAME or manifest.get("version", 0) > FORMAT_VERSION:
+        raise ArchiveError("%s is not a readable docstore archive" % (path))
+    return manifest
+
+
+def read_index(path, name):
+    """
+    The index records of a chunk up to its last complete document, whether
+    the chunk is finished, and the length of the index up to that point
+    """
+    records = []
+    done = False
+    pos = 0
+    idx_path = os.path.join(path, name + INDEX_SUFFIX)
+    if not os.path.exists(idx_path):
+        return records, done, pos
+    pending = []
+    offset = 0
+    with open(idx_path) as handle:
+        for line in handle:
+            if not line.endswith("\n"):
+                break
+            offset += len(line)
+            rec = json.loads(line)
+            if rec.get("end", False):
+                done = True
+                pos = offset
+                break
+            pending.append(rec)
+            if rec["type"] == "doc":
+                records.extend(pending)
+                pending = []
+                pos = offset
+    return records, done, pos
+
+
+class ChunkWriter(object):
+    """
+    Appends records to a chunk, picking up after the last indexed record
+    of an earlier attempt
+    """
+
+    def __init__(self, path, name, compression):
+        self.compression = compression
+        self.records, self.done, pos = read_index(path, name)
+        end = 0
+        if len(self.records):
+            last = self.records[-1]
+            end = last["offset"] + last["size"]
+        self.data = open(os.path.join(path, name + DATA_SUFFIX), "ab")
+        self.data.truncate(end)
+        self.data.seek(end)
+        self.index = open(os.path.join(path, name + INDEX_SUFFIX), "ab")
+        self.index.truncate(pos)
+
+    def exported(self):
+        return set( r["id"] for r in self.records if r["type"] == "doc" )
+
+    def _write(self, rec_type, id, blocks):
+        offset = self.data.tell()
+        sha = hashlib.sha1()
+        length = 0
+        comp = zlib.compressobj() if self.compression == "zlib" else None
+        for block in blocks:
+            sha.update(block)
+            length += len(block)
+            self.data.write(comp.compress(block) if comp is not None else block)
+        if comp is not None:
+            self.data.write(comp.flush())
+        self.data.flush()
+        return {"type" : rec_type, "id" : id, "offset" : offset, "size" : self.data.tell() - offset,
+            "length" : length, "sha1" : sha.hexdigest()}
+
+    def add(self, id, doc_data, file_path=None):
+        """
+        Write the records of one document, and index them together, so a
+        document is never half exported
+        """
+        recs = []
+        if file_path is not None:
+            with open(file_path, "rb") as handle:
+                recs.append(self._write("data", id, iter(lambda: handle.read(BLOCK_SIZE), "")))
+        recs.append(self._write("doc", id, [doc_data]))
+        self.index.write("".join(json.dumps(r) + "\n" for r in recs))
+        self.index.flush()
+
+    def finish(self, count):
+        os.fsync(self.data.fileno())
+        self.index.write(json.dumps({"end" : True, "docs" : count}) + "\n")
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.close()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+def _export_chunk(args):
+    docstore, path, prefix, ids, compression = args
+    name = chunk_name(prefix)
+    writer = ChunkWriter(path, name, compression)
+    if writer.done:
+        writer.close()
+        missing = set(ids) - writer.exported()
+        if missing:
+            logging.warning("Chunk %s of %s was finished before %d of its documents were added, "
+                "export to a new archive to include them" % (name, path, len(missing)))
+        return name, 0
+    try:
+        skip = writer.exported()
+        count = len(skip)
+        for id in ids:
+            if id in skip:
+                continue
+            doc = docstore.get(id)
+            if doc is None:
+                # deleted since the ids were listed
+                continue
+            t = Target(id)
+            file_path = docstore.get_filename(t) if docstore.exists(t) else None
+            writer.add(id, json.dumps(doc.copy()), file_path)
+            count += 1
+    except:
+        writer.close()
+        raise
+    writer.finish(count)
+    return name, count - len(skip)
+
+
+def export_archive(docstore, path, processes=4, compression="zlib", prefix_len=2):
+    """
+    Write the documents and object files of `docstore` into the archive
+    directory `path` with `processes` writer threads. Rerunning an
+    interrupted export carries on where it stopped. Returns the number of
+    documents written.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        manifest = read_manifest(path)
+        compression, prefix_len = manifest["compression"], manifest["prefix_len"]
+    elif compression not in COMPRESSIONS:
+        raise ArchiveError("Unknown archive compression %s" % (compression))
+    groups = {}
+    for id in docstore.ids():
+        groups.setdefault(id[:prefix_len], []).append(id)
+    if not os.path.exists(manifest_path):
+        manifest = {
+            "format" : FORMAT_NAME,
+            "version" : FORMAT_VERSION,
+            "compression" : compression,
+            "prefix_len" : prefix_len,
+            "source" : docstore.get_url()
+        }
+    manifest["chunks"] = sorted(set(manifest.get("chunks", [])) | set(chunk_name(p) for p in groups))
+    tmp = manifest_path + ".tmp.%d" % (os.getpid())
+    with open(tmp, "w") as handle:
+        handle.write(json.dumps(manifest))
+    os.rename(tmp, manifest_path)
+
+    tasks = list( (docstore, path, prefix, sorted(ids), compression) for prefix, ids in sorted(groups.items()) )
+    pool = ThreadPool(processes)
+    try:
+        total = 0
+        for name, count in pool.imap_unordered(_export_chunk, tasks):
+            logging.info("Exported %d documents to %s" % (count, name))
+            total += count
+    finally:
+        pool.close()
+        pool.join()
+    return total
+
+
+def read_record(handle, rec, compression):
+    """
+    Yields the uncompressed blocks of a record, checking its sha1 once the
+    whole record has been read
+    """
+    handle.seek(rec["offset"])
+    remaining = rec["size"]
+    sha = hashlib.sha1()
+    decomp = zlib.decompressobj() if compression == "zlib" else None
+    while remaining > 0:
+        block = handle.read(min(BLOCK_SIZE, remaining))
+        if not block:
+            raise ArchiveError("Record %s of %s is truncated" % (rec["id"], handle.name))
+        remaining -= len(block)
+        if decomp is not None:
+            try:
+                block = decomp.decompress(block)
+            except zlib.error, e:
+                raise ArchiveError("Record %s of %s is damaged: %s" % (rec["id"], handle.name, e))
+        sha.update(block)
+        yield block
+    if decomp is not None:
+        try:
+            block = decomp.flush()
+        except zlib.error, e:
+            raise ArchiveError("Record %s of %s is damaged: %s" % (rec["id"], handle.name, e))
+        sha.update(block)
+        yield block
+    if sha.hexdigest() != rec["sha1"]:
+        raise ArchiveError("Checksum mismatch for record %s of %s" % (rec["id"], handle.name))
+
+
+class ImportState(object):
+    """
+    How many records of each chunk have been stored, as an append-only log
+    of '<chunk> <count>' lines
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as handle:
+                for line in handle:
+                    if line.endswith("\n"):
+                        name, count = line.split()
+                        self.done[name] = max(self.done.get(name, 0), int(count))
+        self.handle = open(path, "a")
+
+    def get(self, name):
+        return self.done.get(name, 0)
+
+    def record(self, name, count):
+        # one short write, so lines from several threads never interleave
+        os.write(self.handle.fileno(), "%s %d\n" % (name, count))
+
+    def close(self):
+        self.handle.close()
+
+
+def _import_chunk(args):
+    path, name, docstore, compression, state = args
+    records, done, pos = read_index(path, name)
+    if not done:
+        raise ArchiveError("Chunk %s of %s is incomplete, finish the export first" % (name, path))
+    start = state.get(name)
+    batch = []
+    stored = 0
+    with open(os.path.join(path, name + DATA_SUFFIX), "rb") as handle:
+        for i in range(start, len(records)):
+            rec = records[i]
+            if rec["type"] == "doc":
+                data = "".join(read_record(handle, rec, compression))
+                batch.append( (rec["id"], json.loads(data)) )
+            else:
+                t = Target(rec["id"])
+                created = not docstore.exists(t)
+                docstore.create(t)
+                out = tempfile.NamedTemporaryFile(dir=os.path.dirname(docstore.get_filename(t)), delete=False)
+                try:
+                    with out:
+                        for block in read_record(handle, rec, compression):
+                            out.write(block)
+                    os.rename(out.name, docstore.get_filename(t))
+                except:
+                    os.unlink(out.name)
+                    if created:
+                        docstore.objs.delete(t)
+                    raise
+                docstore.update_from_file(t)
+            # batches end with a document, whose data is always stored
+            # before it
+            if rec["type"] == "doc" and (len(batch) >= IMPORT_BATCH or i + 1 == len(records)):
+                docstore.put_many(batch)
+                stored += len(batch)
+                batch = []
+                state.record(name, i + 1)
+    return name, stored
+
+
+def import_archive(path, docstore, processes=4, state_path=None):
+    """
+    Load an archive into `docstore` with `processes` reader threads. The
+    progress is kept in `state_path` (by default a file in the archive
+    named after the destination), so rerunning an interrupted import only
+    loads what is left. Returns the number of documents stored.
+    """
+    manifest = read_manifest(path)
+    if state_path is None:
+        state_path = os.path.join(path, "import-%s.state" % (hashlib.sha1(docstore.get_url()).hexdigest()[:12]))
+    state = ImportState(state_path)
+    tasks = list( (path, name, docstore, manifest["compression"], state) for name in manifest["chunks"] )
+    pool = ThreadPool(processes)
+    try:
+        total = 0
+        for name, count in pool.imap_unordered(_import_chunk, tasks):
+            logging.info("Imported %d documents from %s" % (count, name))
+            total += count
+    finally:
+        pool.close()
+        pool.join()
+        state.close()
+    return total
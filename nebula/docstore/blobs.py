@@ -0,0 +1,190 @@
+"""
+Out of line storage of large document fields
+
+Galaxy result documents carry the provenance and the job record (with its
+stdout/stderr) alongside the handful of fields most queries use. With a
+blob threshold set, top level fields holding an object or list that
+encodes to more than the threshold are compressed and stored separately,
+and the document only keeps a small reference to them:
+
+    {"__blob__" : <field>, "key" : <content hash>, "size" : <encoded size>}
+
+While a scan matches documents against a query they are LazyDocs, which
+fetch a spilled field the first time it is accessed, so documents that
+are rejected on other fields never have theirs read or decompressed. The
+documents a store returns have every field loaded: CPython copies a dict
+subclass (dict(doc), d.update(doc), f(**doc)) from its storage without
+calling the overridden accessors, which would hand out the references.
+Reads that don't need the large fields leave them out with `fields`.
+
+Fields that are replaced or deleted leave their blobs behind, as readers in
+other processes may still hold the old document. They are removed by
+compaction once they are unused and older than BLOB_GRACE seconds.
+"""
+
+import re
+import zlib
+import errno
+import hashlib
+
+BLOB_KEY = "__blob__"
+BLOB_SUFFIX = ".blob.z"
+FIELD_RE = re.compile(r'^[A-Za-z0-9_\-]+$')
+BLOB_GRACE = 3600
+
+# never spilled, they are needed to use a document as a Target
+CORE_FIELDS = ["uuid", "id"]
+
+
+def is_blob_ref(value):
+    return isinstance(value, dict) and BLOB_KEY in value
+
+
+def has_blobs(doc):
+    return any(is_blob_ref(v) for v in dict.itervalues(doc))
+
+
+def spill(doc, threshold, dumps):
+    """
+    Split the large fields out of `doc`. Returns the core document and a
+    dict of field -> (reference, compressed data)
+    """
+    core = {}
+    blobs = {}
+    for k, v in doc.items():
+        if k not in CORE_FIELDS and isinstance(v, (dict, list)) and FIELD_RE.match(k) and not is_blob_ref(v):
+            data = dumps(v)
+            if len(data) > threshold:
+                z = zlib.compress(data)
+                ref = {BLOB_KEY : k, "key" : hashlib.sha1(z).hexdigest()[:16], "size" : len(data)}
+                core[k] = ref
+                blobs[k] = (ref, z)
+                continue
+        core[k] = v
+    return core, blobs
+
+
+def stale_blobs(old_core, new_core):
+    """
+    The (field, reference) pairs of `old_core` that are no longer used by
+    `new_core`
+    """
+    out = []
+    if old_core is None:
+        return out
+    for k, v in dict.iteritems(old_core):
+        if is_blob_ref(v) and (new_core is None or dict.get(new_core, k, None) != v):
+            out.append( (k, v) )
+    return out
+
+
+def blob_path(prefix, field, ref):
+    return "%s.%s.%s%s" % (prefix, field, ref['key'], BLOB_SUFFIX)
+
+
+def decode_blob(data, loads):
+    return loads(zlib.decompress(data))
+
+
+class FileBlobLoader(object):
+    """
+    Reads the spilled fields of a document stored as files next to the
+    document's own path (`prefix`). While a store is being resharded the
+    fields may be in either of two places, so `prefix` can also be a list
+    of paths to try in turn.
+    """
+
+    def __init__(self, prefix, loads):
+        if isinstance(prefix, basestring):
+            prefix = [prefix]
+        self.prefixes = list(prefix)
+        self.loads = loads
+
+    def __call__(self, field, ref):
+        for prefix in self.prefixes[:-1]:
+            try:
+                with open(blob_path(prefix, field, ref), "rb") as handle:
+                    return decode_blob(handle.read(), self.loads)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        with open(blob_path(self.prefixes[-1], field, ref), "rb") as handle:
+            return decode_blob(handle.read(), self.loads)
+
+
+class LazyDoc(dict):
+    """
+    Document whose spilled fields are loaded, using `loader(field, ref)`,
+    the first time they are accessed
+    """
+
+    def __init__(self, src, loader=None):
+        dict.__init__(self, src)
+        if loader is None:
+            loader = getattr(src, "loader", None)
+        self.loader = loader
+
+    def _resolve(self, k, v):
+        if self.loader is not None and is_blob_ref(v):
+            v = self.loader(k, v)
+            dict.__setitem__(self, k, v)
+        return v
+
+    def resolve(self):
+        """
+        Load every spilled field
+        """
+        for k in dict.keys(self):
+            self[k]
+        return self
+
+    def __getitem__(self, k):
+        return self._resolve(k, dict.__getitem__(self, k))
+
+    def get(self, k, default=None):
+        if k in self:
+            return self[k]
+        return default
+
+    def setdefault(self, k, default=None):
+        if k in self:
+            return self[k]
+        dict.__setitem__(self, k, default)
+        return default
+
+    def pop(self, k, *default):
+        if k in self:
+            v = self[k]
+            dict.__delitem__(self, k)
+            return v
+        return dict.pop(self, k, *default)
+
+    def popitem(self):
+        k, v = dict.popitem(self)
+        return k, self._resolve(k, v)
+
+    def items(self):
+        return dict.items(self.resolve())
+
+    def iteritems(self):
+        return dict.iteritems(self.resolve())
+
+    def values(self):
+        return dict.values(self.resolve())
+
+    def itervalues(self):
+        return dict.itervalues(self.resolve())
+
+    def copy(self):
+        return dict(self.resolve())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyDoc):
+            other.resolve()
+        return dict.__eq__(self.resolve(), other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return dict.__repr__(self.resolve())
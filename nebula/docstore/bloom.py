@@ -0,0 +1,286 @@
+"""
+Persisted Bloom filters of the ids known to a FileDocStore
+
+Bulk ingest (sync_doc_dir, the copy script) asks the store about every
+candidate id, and on a store that doesn't have it each question is a
+failed stat or open in a large directory. Once `create_bloom` has been run
+the store keeps two filters under <docstore>/_bloom, one of the documents
+and one of the object files, and a negative answer from them skips the
+filesystem altogether. Positive answers may be wrong (at `fp_rate`), and
+are checked as before.
+
+A filter is a file with a HEADER_FORMAT header followed by the bit array,
+mapped into memory by every process using it. Bits are set under the
+lock, and writes show up in the other processes' mappings straight away.
+A filter never forgets an id, so deletes leave it as it was, and it is
+rebuilt from a scan of the store when it gets too full. A rebuild marks
+the old file as retired, so processes still mapping it switch over to the
+new one on their next lookup, and processes that had no filter look for a
+new one at most every RELOAD_INTERVAL seconds.
+
+Writers set the bits of an id before they write its data, so there is no
+time at which the data exists and the filter denies it, and flush them
+before syncing the data. As a rebuild may scan the store after the bits
+went to the old filter but before the data was written, writers `recheck`
+once the data is in, and add the ids again if the filter has changed.
+Object files are written through FileDocStore.create and update_from_file,
+and get_filename adds the id too, as its callers may write the file.
+"""
+
+import os
+import math
+import time
+import errno
+import mmap
+import struct
+import hashlib
+from nebula.docstore.segment import flocked
+from nebula.docstore.fileutil import temp_path
+
+BLOOM_DIR = "_bloom"
+BLOOM_SUFFIX = ".bloom"
+LOCK_NAME = "lock"
+BLOOM_NAMES = ["docs", "objects"]
+
+MAGIC = "NBLOOM01"
+HEADER_FORMAT = "<8sQQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RETIRED_OFFSET = 8 + 8 + 8
+
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 0.01
+RELOAD_INTERVAL = 1.0
+
+# number of set bits in each byte value
+_POPCOUNT = [bin(i).count("1") for i in range(256)]
+
+
+def bloom_size(capacity, error_rate):
+    """
+    Number of bits and of hash functions for `capacity` ids at `error_rate`
+    """
+    bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+    bits = max(64, (bits + 7) & ~7)
+    hashes = max(1, int(round(bits / float(capacity) * math.log(2))))
+    return bits, hashes
+
+
+def _positions(key, bits, hashes):
+    """
+    Bit positions of a key, by double hashing the two halves of its md5
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    h1, h2 = struct.unpack("<QQ", hashlib.md5(str(key)).digest())
+    return list( (h1 + i * h2) % bits for i in range(hashes) )
+
+
+class BloomFilter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+        self.bits = 0
+        self.hashes = 0
+        self.inode = None
+
+    def _open(self):
+        with open(self.path, "r+b") as handle:
+            mm = mmap.mmap(handle.fileno(), 0)
+            inode = os.fstat(handle.fileno()).st_ino
+        magic, bits, hashes, retired = struct.unpack(HEADER_FORMAT, mm[:HEADER_SIZE])
+        if magic != MAGIC:
+            mm.close()
+            raise Exception("Invalid bloom filter %s" % (self.path))
+        if self.mm is not None:
+            self.mm.close()
+        self.mm, self.bits, self.hashes, self.inode = mm, bits, hashes, inode
+
+    def _current(self):
+        """
+        The mapping to use, reopening the file if it has been rebuilt, or
+        None if the filter has been dropped
+        """
+        if self.mm is None or self.mm[RETIRED_OFFSET] != "\x00":
+            try:
+                self._open()
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self.close()
+        return self.mm
+
+    def __contains__(self, key):
+        mm = self._current()
+        if mm is None:
+            return True
+        for pos in _positions(key, self.bits, self.hashes):
+            if not ord(mm[HEADER_SIZE + (pos >> 3)]) & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, keys):
+        """
+        Set the bits of `keys`, with the lock held
+        """
+        mm = self._current()
+        if mm is None:
+            return
+        for key in keys:
+            for pos in _positions(key, self.bits, self.hashes):
+                i = HEADER_SIZE + (pos >> 3)
+                mm[i] = chr(ord(mm[i]) | (1 << (pos & 7)))
+
+    def flush(self):
+        if self.mm is not None:
+            self.mm.flush()
+
+    def fill_ratio(self):
+        data = self._current()[HEADER_SIZE:]
+        return sum(data.count(chr(i)) * _POPCOUNT[i] for i in range(1, 256)) / float(self.bits)
+
+    def fp_rate(self):
+        """
+        Chance that an id the store doesn't have is reported as present,
+        from the fraction of the bits that are set
+        """
+        return self.fill_ratio() ** self.hashes
+
+    def stats(self):
+        fill = self.fill_ratio()
+        return {
+            "bits" : self.bits,
+            "hashes" : self.hashes,
+            "fill_ratio" : fill,
+            "fp_rate" : fill ** self.hashes
+        }
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+
+def write_bloom(path, keys, capacity, error_rate):
+    """
+    Build a filter holding `keys` and move it into place at `path`,
+    retiring the filter it replaces. Must be called with the lock held.
+    """
+    bits, hashes = bloom_size(capacity, error_rate)
+    tmp = temp_path(path)
+    with open(tmp, "w+b") as handle:
+        handle.write(struct.pack(HEADER_FORMAT, MAGIC, bits, hashes, 0))
+        handle.truncate(HEADER_SIZE + bits / 8)
+    out = BloomFilter(tmp)
+    out.add(keys)
+    out.flush()
+    out.close()
+    if os.path.exists(path):
+        with open(path, "r+b") as handle:
+            handle.seek(RETIRED_OFFSET)
+            handle.write(struct.pack("<Q", 1))
+    os.rename(tmp, path)
+
+
+class BloomSet(object):
+    """
+    The filters of a FileDocStore, by name (see BLOOM_NAMES)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = os.path.join(self.path, LOCK_NAME)
+        self.filters = {}
+        self.checked = {}
+
+    def _path(self, name):
+        return os.path.join(self.path, name + BLOOM_SUFFIX)
+
+    def get(self, name):
+        """
+        The filter called `name`, or None if the store doesn't keep it
+        """
+        out = self.filters.get(name, None)
+        if out is not None and out._current() is None:
+            # dropped by another process
+            del self.filters[name]
+            out = None
+        if out is None and os.path.exists(self._path(name)):
+            out = BloomFilter(self._path(name))
+            self.filters[name] = out
+        return out
+
+    def might_contain(self, name, key):
+        """
+        False only if the filter is certain the store doesn't have `key`
+        """
+        f = self.filters.get(name, None)
+        if f is not None and f._current() is None:
+            # dropped by another process
+            del self.filters[name]
+            f = None
+        if f is None:
+            now = time.time()
+            if now - self.checked.get(name, 0) < RELOAD_INTERVAL:
+                return True
+            self.checked[name] = now
+            f = self.get(name)
+            if f is None:
+                return True
+        return key in f
+
+    def add(self, name, keys, sync=False):
+        """
+        Record new ids, before their data is written, flushing the bits to
+        disk if `sync` is set. Returns a token to hand to `recheck` once the
+        data is written.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with flocked(self.lock_path):
+            f = self.get(name)
+            if f is None:
+                return None
+            f.add(keys)
+            if sync:
+                f.flush()
+            return f.inode
+
+    def recheck(self, name, keys, token, sync=False):
+        """
+        Add ids again if the filter they were added to (see `add`) has been
+        built or rebuilt since, by a scan that may have missed their data
+        """
+        f = self.get(name)
+        if f is not None and f.inode != token:
+            self.add(name, keys, sync)
+
+    def build(self, scans, capacity=None, error_rate=DEFAULT_ERROR_RATE):
+        """
+        Rebuild the filters from `scans`, a dict of name -> function returning
+        the ids. The lock is held throughout, so writers wait for it.
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        with flocked(self.lock_path):
+            for name, scan in scans.items():
+                keys = list(scan())
+                write_bloom(self._path(name), keys, capacity or max(DEFAULT_CAPACITY, 2 * len(keys)), error_rate)
+                self.get(name)
+
+    def clear(self):
+        if not os.path.exists(self.path):
+            return
+        with flocked(self.lock_path):
+            for name in BLOOM_NAMES:
+                if os.path.exists(self._path(name)):
+                    with open(self._path(name), "r+b") as handle:
+                        handle.seek(RETIRED_OFFSET)
+                        handle.write(struct.pack("<Q", 1))
+                    os.unlink(self._path(name))
+                f = self.filters.pop(name, None)
+                if f is not None:
+                    f.close()
+
+    def stats(self):
+        return dict( (name, self.get(name).stats()) for name in BLOOM_NAMES if self.get(name) is not None )
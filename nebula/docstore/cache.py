@@ -0,0 +1,110 @@
+"""
+In-process cache of decoded documents
+
+Entries are stored together with a validity stamp supplied by the store
+(ie the stat of the document file). A lookup only returns the cached
+document if the current stamp is the same, so a change made by another
+process is noticed without reading the document again. Lookups return a
+copy of the cached document (of its containers, the strings and numbers
+are shared), so callers that modify what get returned can never change
+what is in the cache. The copy costs about half as much as decoding.
+Entries are weighed by the size of their encoded form.
+"""
+
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def copy_doc(value, keys=None):
+    """
+    Copy of the dicts and lists of a decoded document, with only the top
+    level members in `keys` if it is given
+    """
+    if keys is not None:
+        return dict( (k, copy_doc(value[k])) for k in keys if k in value )
+    t = type(value)
+    if t is dict:
+        return dict( (k, copy_doc(v) if type(v) in (dict, list) else v) for k, v in value.iteritems() )
+    if t is list:
+        return [ copy_doc(v) if type(v) in (dict, list) else v for v in value ]
+    return value
+
+
+class DocCache(object):
+    """
+    LRU cache bounded both by number of entries and by total bytes
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, id, stamp, keys=None):
+        """
+        A copy of the cached document (or of its top level `keys`), or
+        None if it isn't cached with this stamp
+        """
+        with self.lock:
+            entry = self.entries.pop(id, None)
+            if entry is not None:
+                if entry[0] == stamp:
+                    self.entries[id] = entry
+                    self.hits += 1
+                    doc = entry[1]
+                else:
+                    self.size -= entry[2]
+                    doc = None
+            else:
+                doc = None
+            if doc is None:
+                self.misses += 1
+                return None
+        return copy_doc(doc, keys)
+
+    def put(self, id, stamp, doc, size):
+        """
+        Cache a decoded document, `size` being the length of its encoding.
+        The cache keeps `doc` itself, so the caller must not modify it after.
+        """
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(id, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[id] = (stamp, doc, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                key, entry = self.entries.popitem(last=False)
+                self.size -= entry[2]
+                self.evictions += 1
+
+    def invalidate(self, id):
+        with self.lock:
+            entry = self.entries.pop(id, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries" : len(self.entries),
+                "bytes" : self.size,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions
+            }
@@ -0,0 +1,73 @@
+"""
+Sequence numbered change log for the FileDocStore
+
+Every put and delete appends a record to <docstore>/_changes/changes.log.
+Records are fixed width lines '<seq> <op> <id>', so the record for a
+sequence number is found by seeking to (seq - 1) * RECORD_SIZE, and
+reading the changes since a given point only touches the new records.
+"""
+
+import os
+from nebula.docstore.segment import flocked
+
+CHANGES_DIR = "_changes"
+CHANGES_NAME = "changes.log"
+
+ID_WIDTH = 36
+RECORD_FORMAT = "%016d %s %-36s\n"
+RECORD_SIZE = len(RECORD_FORMAT % (0, "P", ""))
+
+OPS = {"P" : "put", "D" : "delete"}
+
+
+class ChangeLog(object):
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.log_path = os.path.join(self.path, CHANGES_NAME)
+
+    def append(self, records):
+        """
+        Append a batch of (op, id) records, op being 'P' or 'D'. Returns the
+        sequence number of the last one.
+        """
+        records = list(records)
+        with flocked(self.log_path) as handle:
+            size = os.fstat(handle.fileno()).st_size
+            if size % RECORD_SIZE:
+                # drop a record left incomplete by a crashed writer
+                size -= size % RECORD_SIZE
+                os.ftruncate(handle.fileno(), size)
+            seq = size / RECORD_SIZE
+            buf = []
+            for op, id in records:
+                if len(id) > ID_WIDTH:
+                    raise Exception("Invalid change log id: %s" % (id))
+                seq += 1
+                buf.append(RECORD_FORMAT % (seq, op, id))
+            handle.write("".join(buf))
+        return seq
+
+    def last_seq(self):
+        try:
+            return os.path.getsize(self.log_path) / RECORD_SIZE
+        except OSError:
+            return 0
+
+    def read(self, since=0):
+        """
+        Yields (seq, op, id) for the changes after sequence number `since`
+        """
+        end = self.last_seq()
+        if end <= since:
+            return
+        with open(self.log_path, "rb") as handle:
+            handle.seek(since * RECORD_SIZE)
+            for i in xrange(since, end):
+                line = handle.read(RECORD_SIZE)
+                if len(line) < RECORD_SIZE:
+                    break
+                seq, op, id = line.split()
+                yield int(seq), OPS[op], id
@@ -0,0 +1,161 @@
+"""
+Document encodings for doc stores
+
+    json        the default, with the standard library
+    ujson       JSON written with ujson, if it is installed. Faster, but
+                ujson 1.x rounds floats to 9 significant digits.
+    simplejson  JSON written with simplejson, if it is installed
+    msgpack     compact binary encoding, if the msgpack module is installed
+    marshal     compact binary encoding from the standard library. Only
+                readable by the same Python version, and it must never be
+                used on data that isn't trusted.
+
+Binary encodings start with a MAGIC_LEN byte tag that can't begin a JSON
+document, so the format of each stored document is detected when it is
+read (see `loads`) and stores holding a mix of encodings keep working.
+JSON documents are read the same way whichever module wrote them: with
+simplejson if it is installed, which decodes floats exactly as the standard
+library does, and otherwise with the standard library. ujson is never used
+for reads, as it rounds floats.
+"""
+
+import json
+import marshal
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC_LEN = 4
+
+if simplejson is not None:
+    json_loads = simplejson.loads
+else:
+    json_loads = json.loads
+DEFAULT_CODEC = "json"
+
+
+class JSONCodec(object):
+    name = "json"
+    magic = None
+    module = json
+
+    def __init__(self):
+        if self.module is None:
+            raise Exception("The %s codec needs the %s module" % (self.name, self.name))
+
+    def dumps(self, doc):
+        return self.module.dumps(doc)
+
+    def loads(self, data):
+        return json_loads(data)
+
+
+class UJSONCodec(JSONCodec):
+    name = "ujson"
+    module = ujson
+
+
+class SimpleJSONCodec(JSONCodec):
+    name = "simplejson"
+    module = simplejson
+
+
+class MsgpackCodec(object):
+    name = "msgpack"
+    magic = "\x00MP1"
+
+    def __init__(self):
+        if msgpack is None:
+            raise Exception("The msgpack codec needs the msgpack module")
+        if getattr(msgpack, "version", (0,)) >= (0, 5, 2):
+            self.unpack_args = {"raw" : False}
+        else:
+            self.unpack_args = {"encoding" : "utf-8"}
+
+    def dumps(self, doc):
+        return self.magic + msgpack.packb(doc)
+
+    def loads(self, data):
+        return msgpack.unpackb(data[MAGIC_LEN:], **self.unpack_args)
+
+
+class MarshalCodec(object):
+    name = "marshal"
+    magic = "\x00MA2"
+
+    def dumps(self, doc):
+        return self.magic + marshal.dumps(doc, 2)
+
+    def loads(self, data):
+        return marshal.loads(data[MAGIC_LEN:])
+
+
+CODECS = {
+    "json" : JSONCodec,
+    "ujson" : UJSONCodec,
+    "simplejson" : SimpleJSONCodec,
+    "msgpack" : MsgpackCodec,
+    "marshal" : MarshalCodec
+}
+
+_codecs = {}
+
+
+def get_codec(name=None):
+    """
+    The codec called `name` (DEFAULT_CODEC if None)
+    """
+    if name is None:
+        name = DEFAULT_CODEC
+    if name not in CODECS:
+        raise Exception("Unknown DocStore codec %s" % (name))
+    if name not in _codecs:
+        _codecs[name] = CODECS[name]()
+    return _codecs[name]
+
+
+def available_codecs():
+    out = ["json"]
+    if ujson is not None:
+        out.append("ujson")
+    if simplejson is not None:
+        out.append("simplejson")
+    if msgpack is not None:
+        out.append("msgpack")
+    out.append("marshal")
+    return out
+
+
+_magic = dict( (c.magic, c.name) for c in CODECS.values() if c.magic is not None )
+
+
+def detect(data):
+    """
+    Name of the codec a stored document was written with
+    """
+    if data[:1] == "\x00":
+        name = _magic.get(data[:MAGIC_LEN], None)
+        if name is None:
+            raise ValueError("Unknown document encoding")
+        return name
+    return "json"
+
+
+def loads(data):
+    """
+    Decode a stored document in whichever format it was written. A module
+    level function, so it can be handed to scan worker processes.
+    """
+    return get_codec(detect(data)).loads(data)
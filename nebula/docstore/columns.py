@@ -0,0 +1,222 @@
+"""
+Columnar export of document fields for analytics
+
+export_columns flattens a list of field paths (dotted paths into nested
+objects, or one of the derived fields of nebula.docstore.aggregate such as
+runtime_seconds) out of every document into a table with one row per
+document and a 'uuid' column, written as either
+
+    csv     a header of '<field>:<type>' names, type being one of int,
+            float, bool or str, then one line per document. Missing
+            values are empty cells, so in str columns an empty string is
+            written as a single backslash, and a string starting with a
+            backslash gets another one in front.
+    npz     a NumPy archive with one array per field (needs numpy). Number
+            and bool columns with missing values are float arrays with NaN
+            in the gaps, missing strings are empty and flagged in a bool
+            array named '<field>:missing'.
+
+Values that are objects or lists are written as their JSON text. Next to
+the output goes <output>.meta.json holding the fields and the change
+sequence number the export is up to date with (the watermark). A refresh
+only reads the documents put or deleted since then, from the store's
+change feed, and merges them into the existing table.
+"""
+
+import os
+import csv
+import json
+from nebula.docstore.aggregate import field_value, DERIVED_SOURCES
+from nebula.docstore.fileutil import temp_path
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FORMATS = ["csv", "npz"]
+META_SUFFIX = ".meta.json"
+COLUMN_TYPES = ["int", "float", "bool", "str"]
+MISSING = None
+ESCAPE = "\\"
+MASK_SUFFIX = ":missing"
+
+
+def source_fields(fields):
+    """
+    The document fields to read to compute a list of columns
+    """
+    out = set()
+    for f in fields:
+        out.update(DERIVED_SOURCES.get(f, [f]))
+    return sorted(out)
+
+
+def cell(doc, field):
+    value = field_value(doc, field)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+def column_type(values):
+    """
+    The narrowest of COLUMN_TYPES holding every (non missing) value
+    """
+    present = list( v for v in values if v is not MISSING )
+    if len(present) and all(isinstance(v, bool) for v in present):
+        return "bool"
+    if len(present) and all(isinstance(v, (int, long)) and not isinstance(v, bool) for v in present):
+        return "int"
+    if len(present) and all(isinstance(v, (int, long, float)) and not isinstance(v, bool) for v in present):
+        return "float"
+    return "str"
+
+
+PARSERS = {
+    "int" : int,
+    "float" : float,
+    "bool" : lambda v: v == "true",
+    "str" : lambda v: (v[1:] if v.startswith(ESCAPE) else v).decode("utf-8")
+}
+
+
+def _format(value, ctype):
+    if value is MISSING:
+        return ""
+    if ctype == "bool":
+        return "true" if value else "false"
+    if ctype == "str":
+        if not isinstance(value, basestring):
+            value = json.dumps(value)
+        if value == "" or value.startswith(ESCAPE):
+            value = ESCAPE + value
+        return value.encode("utf-8") if isinstance(value, unicode) else value
+    if ctype == "int":
+        return str(value)
+    return repr(float(value))
+
+
+def write_csv(path, fields, rows):
+    types = list( column_type(list( r[i] for r in rows.values() )) for i in range(len(fields)) )
+    with open(path, "wb") as handle:
+        writer = csv.writer(handle)
+        writer.writerow( ["uuid:str"] + list( "%s:%s" % (f, t) for f, t in zip(fields, types) ) )
+        for id in sorted(rows):
+            writer.writerow( [id] + list( _format(v, t) for v, t in zip(rows[id], types) ) )
+
+
+def read_csv(path):
+    """
+    The fields and the rows (uuid -> values) of a csv export
+    """
+    rows = {}
+    with open(path, "rb") as handle:
+        reader = csv.reader(handle)
+        header = list( h.rsplit(":", 1) for h in next(reader) )
+        fields = list( h[0] for h in header[1:] )
+        parsers = list( PARSERS[h[1]] for h in header[1:] )
+        for line in reader:
+            rows[line[0]] = list( p(v) if v != "" else MISSING for p, v in zip(parsers, line[1:]) )
+    return fields, rows
+
+
+def _array(values, ctype):
+    if ctype in ["int", "bool"] and all(v is not MISSING for v in values):
+        return numpy.array(values, dtype=numpy.int64 if ctype == "int" else numpy.bool_)
+    if ctype in ["int", "float", "bool"]:
+        return numpy.array(list( float("nan") if v is MISSING else float(v) for v in values ), dtype=numpy.float64)
+    return numpy.array(list( u"" if v is MISSING else (v if isinstance(v, unicode) else unicode(v)) for v in values ))
+
+
+def write_npz(path, fields, rows):
+    if numpy is None:
+        raise Exception("npz export needs numpy")
+    ids = sorted(rows)
+    arrays = {"uuid" : numpy.array(ids)}
+    for i, f in enumerate(fields):
+        values = list( rows[id][i] for id in ids )
+        ctype = column_type(values)
+        arrays[f] = _array(values, ctype)
+        if ctype == "str" and MISSING in values:
+            arrays[f + MASK_SUFFIX] = numpy.array(list( v is MISSING for v in values ), dtype=numpy.bool_)
+    with open(path, "wb") as handle:
+        numpy.savez(handle, **arrays)
+
+
+def read_npz(path, fields):
+    if numpy is None:
+        raise Exception("npz export needs numpy")
+    data = numpy.load(path)
+    ids = list( str(a) for a in data["uuid"] )
+    columns = []
+    for f in fields:
+        col = data[f]
+        if col.dtype.kind == "f":
+            columns.append( list( MISSING if v != v else float(v) for v in col ) )
+        elif col.dtype.kind == "U":
+            if f + MASK_SUFFIX in data.files:
+                mask = data[f + MASK_SUFFIX]
+            else:
+                mask = list( v == u"" for v in col )
+            columns.append( list( MISSING if m else unicode(v) for v, m in zip(col, mask) ) )
+        else:
+            columns.append( list( v.item() for v in col ) )
+    return fields, dict( (id, list( c[i] for c in columns )) for i, id in enumerate(ids) )
+
+
+def read_meta(path):
+    meta_path = path + META_SUFFIX
+    if not os.path.exists(meta_path) or not os.path.exists(path):
+        return None
+    with open(meta_path) as handle:
+        return json.loads(handle.read())
+
+
+def export_columns(docstore, path, fields, format="csv", processes=None, refresh=True):
+    """
+    Write the `fields` of every document of `docstore` to `path`. With
+    `refresh`, an earlier export of the same fields in the same format is
+    brought up to date from the change feed rather than rewritten from a
+    full (parallel, if `processes` is set) scan. Returns the number of
+    documents read.
+    """
+    if format not in FORMATS:
+        raise Exception("Unknown column export format %s" % (format))
+    fields = list(fields)
+    meta = read_meta(path) if refresh else None
+    if meta is not None and (meta["fields"] != fields or meta["format"] != format):
+        meta = None
+    # read before the documents, so changes made during the export are
+    # picked up again by the next refresh
+    seq = docstore.last_seq()
+    sources = source_fields(fields)
+    if meta is None:
+        rows = {}
+        for id, doc in docstore.filter(processes=processes, ordered=False, fields=sources):
+            rows[id] = list( cell(doc, f) for f in fields )
+        count = len(rows)
+    else:
+        if format == "csv":
+            fields, rows = read_csv(path)
+        else:
+            fields, rows = read_npz(path, fields)
+        changed = set( id for change_seq, op, id in docstore.changes(meta["seq"]) )
+        count = 0
+        for id in changed:
+            doc = docstore.get(id, fields=sources)
+            if doc is None:
+                rows.pop(id, None)
+            else:
+                rows[id] = list( cell(doc, f) for f in fields )
+                count += 1
+    tmp = temp_path(path)
+    if format == "csv":
+        write_csv(tmp, fields, rows)
+    else:
+        write_npz(tmp, fields, rows)
+    os.rename(tmp, path)
+    with open(temp_path(path + META_SUFFIX), "w") as handle:
+        handle.write(json.dumps({"fields" : fields, "format" : format, "seq" : seq}))
+    os.rename(temp_path(path + META_SUFFIX), path + META_SUFFIX)
+    return count
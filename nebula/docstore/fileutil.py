@@ -0,0 +1,74 @@
+"""
+Small file helpers shared by the file based doc stores
+"""
+
+import os
+import ctypes
+import threading
+import ctypes.util
+import logging
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _syncfs = _libc.syncfs
+except (OSError, AttributeError, TypeError):
+    _syncfs = None
+
+
+def temp_path(path):
+    """
+    Temporary name for a new version of `path`, unique to the writing
+    thread, so threads of one process don't write over each other
+    """
+    return "%s.tmp.%d.%d" % (path, os.getpid(), threading.current_thread().ident)
+
+
+def write_temp(path, data):
+    """
+    Write data next to `path` under a temporary name, returning that name.
+    It becomes visible with os.rename, so readers never see partial files
+    """
+    tmp = temp_path(path)
+    try:
+        with open(tmp, "w") as handle:
+            handle.write(data)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return tmp
+
+
+def atomic_write(path, data):
+    tmp = write_temp(path, data)
+    os.rename(tmp, path)
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_batch(paths, dirs):
+    """
+    Make a batch of newly written files durable. Where syncfs(2) is
+    available the filesystem holding them is flushed with a single call,
+    otherwise each file is fsync'ed, followed by the directories holding
+    their (renamed) entries.
+    """
+    dirs = set(dirs)
+    if _syncfs is not None and len(dirs):
+        fd = os.open(next(iter(dirs)), os.O_RDONLY)
+        try:
+            if _syncfs(fd) == 0:
+                return
+            logging.debug("syncfs failed: %s" % (os.strerror(ctypes.get_errno())))
+        finally:
+            os.close(fd)
+    for path in paths:
+        fsync_path(path)
+    for dir in dirs:
+        fsync_path(dir)
@@ -0,0 +1,428 @@
+"""
+Persistent secondary indexes for the FileDocStore
+
+Every indexed field gets a directory under <docstore>/_index/<field>. Each
+distinct value of the field has its own posting file, named after the hash
+of the value. A posting file starts with a header line holding the encoded
+value, followed by an append-only log of '+<id>' and '-<id>' lines. Looking
+up a value only reads the ids that match it, and updating a document only
+appends to the postings of the values that changed. Appends are made under
+a flock on the posting file, and a posting whose dead entries outnumber its
+live ones is rewritten when it is next read (or dropped, once it is empty).
+
+Writers post a document under its new values before the document is
+written, and take it off its old values afterwards, so a crash in between
+leaves ids that don't match (which filter checks the documents for) rather
+than missing ones.
+
+The encoded values are also listed, one per line, in values.log, which is
+what prefix and range conditions are answered from.
+"""
+
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+from nebula.docstore.segment import flocked
+from nebula.docstore.project import get_path
+from nebula.docstore.query import compile_query, comparable, RANGE_OPERATORS, compare
+
+INDEX_DIR = "_index"
+INDEX_MANIFEST = "fields.json"
+POSTING_SUFFIX = ".ids"
+VALUES_NAME = "values.log"
+# minimum number of dead entries before a posting file is compacted
+COMPACT_DEAD = 256
+
+
+def index_key(value):
+    """
+    Canonical string used to identify a value in an index
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return json.dumps(value, sort_keys=True)
+
+
+@contextmanager
+def locked_file(path):
+    """
+    flock a file that may be replaced by a rename, retrying until the lock
+    is held on the file currently at `path`
+    """
+    while True:
+        with flocked(path) as handle:
+            try:
+                current = os.fstat(handle.fileno()).st_ino == os.stat(path).st_ino
+            except OSError:
+                current = False
+            if current:
+                yield handle
+                return
+
+
+def is_multi_value(value):
+    """
+    Filter values that are iterable (but not strings) mean 'match any of'
+    """
+    return hasattr(value, "__iter__")
+
+
+class FieldIndex(object):
+    """
+    Posting list index for a single document field, which may be a dotted
+    path to a nested field.
+
+    Documents are posted under '=<value>', and when the field holds a list,
+    also under '~<element>' for each element of the list.
+    """
+
+    def __init__(self, base_path, field):
+        if "/" in field or field.startswith("."):
+            raise Exception("Invalid index field name: %s" % (field))
+        self.field = field
+        self.path = os.path.join(base_path, field)
+        self.values_path = os.path.join(self.path, VALUES_NAME)
+        self.values_cache = (None, [])
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def _posting_path(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest() + POSTING_SUFFIX)
+
+    def doc_keys(self, doc):
+        """
+        The set of posting keys a document is filed under
+        """
+        if doc is None:
+            return set()
+        missing = []
+        value = get_path(doc, self.field, missing)
+        if value is missing:
+            return set()
+        out = set( ["=" + index_key(value)] )
+        if isinstance(value, list):
+            for e in value:
+                out.add( "~" + index_key(e) )
+        return out
+
+    def _append(self, key, lines):
+        path = self._posting_path(key)
+        with locked_file(path) as handle:
+            if os.fstat(handle.fileno()).st_size == 0:
+                handle.write("#" + key + "\n")
+                with locked_file(self.values_path) as values:
+                    values.write(key + "\n")
+            handle.write("".join(lines))
+
+    def _read_posting(self, path):
+        """
+        The header and live ids of a posting file, and its number of dead entries
+        """
+        out = set()
+        header = None
+        entries = 0
+        with open(path) as handle:
+            for line in handle:
+                if line.startswith("+"):
+                    out.add(line[1:].rstrip("\n"))
+                    entries += 1
+                elif line.startswith("-"):
+                    out.discard(line[1:].rstrip("\n"))
+                    entries += 1
+                elif line.startswith("#") and header is None:
+                    header = line
+        return header, out, entries - len(out)
+
+    def _compact(self, key):
+        """
+        Rewrite a posting file with only its live entries, or remove it
+        (and its value) if there are none
+        """
+        path = self._posting_path(key)
+        try:
+            with locked_file(path):
+                header, ids, dead = self._read_posting(path)
+                if len(ids):
+                    tmp = path + ".tmp.%d" % (os.getpid())
+                    with open(tmp, "w") as handle:
+                        handle.write(header or "#" + key + "\n")
+                        handle.write("".join( "+%s\n" % (id) for id in sorted(ids) ))
+                    os.rename(tmp, path)
+                else:
+                    with locked_file(self.values_path) as values:
+                        with open(self.values_path) as handle:
+                            keys = list( line for line in handle if line.rstrip("\n") != key )
+                        tmp = self.values_path + ".tmp.%d" % (os.getpid())
+                        with open(tmp, "w") as handle:
+                            handle.write("".join(keys))
+                        os.rename(tmp, self.values_path)
+                    os.unlink(path)
+        except (IOError, OSError):
+            # e.g. a read-only store, the posting is still correct
+            pass
+
+    def values(self):
+        """
+        The (key, value) pairs of the distinct values that have postings
+        """
+        if not os.path.exists(self.values_path):
+            self._write_values()
+        stat = os.stat(self.values_path)
+        size = (stat.st_ino, stat.st_size)
+        if self.values_cache[0] != size:
+            out = []
+            with open(self.values_path) as handle:
+                for line in handle:
+                    key = line.rstrip("\n")
+                    if key.startswith("="):
+                        out.append( (key, json.loads(key[1:])) )
+            self.values_cache = (size, out)
+        return self.values_cache[1]
+
+    def _write_values(self):
+        """
+        Recover the value list from the posting headers, for indexes that
+        were built before it was kept
+        """
+        keys = []
+        for name in os.listdir(self.path):
+            if name.endswith(POSTING_SUFFIX):
+                with open(os.path.join(self.path, name)) as handle:
+                    keys.append(handle.readline()[1:])
+        tmp = self.values_path + ".tmp.%d" % (os.getpid())
+        with open(tmp, "w") as handle:
+            handle.write("".join(keys))
+        os.rename(tmp, self.values_path)
+
+    def plan_keys(self, op, arg):
+        """
+        The posting keys holding every document that can match a query
+        operator on the field, or None if the index can't answer it
+        """
+        if op == "$eq":
+            return ["=" + index_key(arg)]
+        if op == "$in":
+            return list( "=" + index_key(v) for v in arg )
+        if op == "$contains":
+            keys = ["~" + index_key(arg)]
+            if isinstance(arg, basestring):
+                keys.extend( k for k, v in self.values() if isinstance(v, basestring) and arg in v )
+            return keys
+        if op == "$prefix":
+            if not isinstance(arg, basestring):
+                return []
+            return list( k for k, v in self.values() if isinstance(v, basestring) and v.startswith(arg) )
+        if op in RANGE_OPERATORS:
+            return list( k for k, v in self.values() if comparable(v, arg) and compare(v, op, arg) )
+        return None
+
+    def estimate(self, keys):
+        """
+        Rough cost of reading a set of postings, their size in bytes
+        """
+        total = 0
+        for key in keys:
+            try:
+                total += os.path.getsize(self._posting_path(key))
+            except OSError:
+                pass
+        return total
+
+    def lookup_keys(self, keys):
+        out = set()
+        for key in keys:
+            out.update(self.lookup_key(key))
+        return out
+
+    def _post(self, items, added):
+        lines = {}
+        for id, old_doc, new_doc in items:
+            old_keys = self.doc_keys(old_doc)
+            new_keys = self.doc_keys(new_doc)
+            if added:
+                for key in new_keys - old_keys:
+                    lines.setdefault(key, []).append("+%s\n" % (id))
+            else:
+                for key in old_keys - new_keys:
+                    lines.setdefault(key, []).append("-%s\n" % (id))
+        for key, key_lines in lines.items():
+            self._append(key, key_lines)
+
+    def add_postings(self, items):
+        """
+        Post (id, old_doc, new_doc) changes under the values they gain
+        """
+        self._post(items, True)
+
+    def remove_postings(self, items):
+        """
+        Take (id, old_doc, new_doc) changes off the values they lose
+        """
+        self._post(items, False)
+
+    def update(self, id, old_doc, new_doc):
+        self.add_postings([(id, old_doc, new_doc)])
+        self.remove_postings([(id, old_doc, new_doc)])
+
+    def lookup_key(self, key):
+        path = self._posting_path(key)
+        try:
+            header, out, dead = self._read_posting(path)
+        except IOError:
+            return set()
+        if dead >= COMPACT_DEAD and dead > len(out):
+            self._compact(key)
+        return out
+
+    def lookup(self, value):
+        """
+        Ids of documents where the field matches `value` using the same rules
+        as FileDocStore.filter: equality, or membership for iterable values
+        """
+        if is_multi_value(value):
+            out = set()
+            for v in value:
+                out.update(self.lookup_key("=" + index_key(v)))
+            return out
+        return self.lookup_key("=" + index_key(value))
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith(POSTING_SUFFIX) or name == VALUES_NAME:
+                os.unlink(os.path.join(self.path, name))
+        self.values_cache = (None, [])
+
+    def build(self, docs):
+        """
+        Rebuild the index from an iterable of (id, doc) pairs, writing out
+        compacted posting files
+        """
+        postings = {}
+        for id, doc in docs:
+            for key in self.doc_keys(doc):
+                postings.setdefault(key, []).append("+%s\n" % (id))
+        self.clear()
+        for key, lines in postings.items():
+            self._append(key, lines)
+
+
+class IndexSet(object):
+    """
+    The collection of FieldIndexes declared on a docstore
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.indexes = {}
+        self.manifest_mtime = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Pick up indexes declared or dropped by other processes, so their
+        postings are maintained by every writer
+        """
+        manifest = os.path.join(self.path, INDEX_MANIFEST)
+        try:
+            mtime = os.stat(manifest).st_mtime
+        except OSError:
+            return
+        if mtime == self.manifest_mtime:
+            return
+        with open(manifest) as handle:
+            fields = json.loads(handle.read())
+        self.indexes = dict( (field, self.indexes.get(field, None) or FieldIndex(self.path, field)) for field in fields )
+        self.manifest_mtime = mtime
+
+    def __contains__(self, field):
+        self.refresh()
+        return field in self.indexes
+
+    def __len__(self):
+        self.refresh()
+        return len(self.indexes)
+
+    def fields(self):
+        self.refresh()
+        return sorted(self.indexes.keys())
+
+    def _write_manifest(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        manifest = os.path.join(self.path, INDEX_MANIFEST)
+        tmp = manifest + ".tmp.%d" % (os.getpid())
+        with open(tmp, "w") as handle:
+            handle.write(json.dumps(sorted(self.indexes.keys())))
+        os.rename(tmp, manifest)
+        self.manifest_mtime = os.stat(manifest).st_mtime
+
+    def add(self, field, docs):
+        self.refresh()
+        index = FieldIndex(self.path, field)
+        index.build(docs)
+        self.indexes[field] = index
+        self._write_manifest()
+        return index
+
+    def remove(self, field):
+        self.refresh()
+        index = self.indexes.pop(field, None)
+        if index is not None:
+            index.clear()
+            self._write_manifest()
+
+    def update(self, id, old_doc, new_doc):
+        self.add_postings([(id, old_doc, new_doc)])
+        self.remove_postings([(id, old_doc, new_doc)])
+
+    def add_postings(self, items):
+        """
+        Post a batch of (id, old_doc, new_doc) changes under their new
+        values, before the documents are written
+        """
+        self.refresh()
+        items = list(items)
+        for index in self.indexes.values():
+            index.add_postings(items)
+
+    def remove_postings(self, items):
+        """
+        Take a batch of (id, old_doc, new_doc) changes off their old
+        values, once the documents are written
+        """
+        self.refresh()
+        items = list(items)
+        for index in self.indexes.values():
+            index.remove_postings(items)
+
+    def plan(self, query):
+        """
+        Pick the predicate of a query that is answered by reading the
+        fewest postings. Returns (field, op, keys, estimate), or None if
+        no predicate can use an index and a full scan is required.
+        """
+        self.refresh()
+        best = None
+        for path, op, arg in compile_query(query).predicates:
+            if path not in self.indexes:
+                continue
+            index = self.indexes[path]
+            keys = index.plan_keys(op, arg)
+            if keys is None:
+                continue
+            estimate = index.estimate(keys)
+            if best is None or estimate < best[3]:
+                best = (path, op, keys, estimate)
+        return best
+
+    def candidates(self, query):
+        """
+        Ids of the documents that can match the query, according to the
+        most selective usable index. Returns None if a full scan is required.
+        The other predicates still have to be checked on the documents.
+        """
+        plan = self.plan(query)
+        if plan is None:
+            return None
+        return self.indexes[plan[0]].lookup_keys(plan[2])
@@ -0,0 +1,127 @@
+"""
+Directory fan-out of a FileDocStore
+
+Documents, their out of line fields and the object files are kept in shard
+directories named after the start of the id. The layout is (depth, width):
+the default (1, 2) gives the 256 'ab/' directories of the original stores,
+(2, 2) gives 65536 'ab/cd/' ones.
+
+The layout is recorded in docstore.json along with LAYOUT_VERSION, stores
+without it use DEFAULT_LAYOUT. While a store is being resharded the old
+layout is recorded as 'previous_layout', and entries that haven't been
+moved yet are still found there.
+"""
+
+import os
+import re
+import errno
+from glob import glob
+from galaxy.util.directory_hash import directory_hash_id
+
+DEFAULT_LAYOUT = (1, 2)
+LAYOUT_VERSION = 2
+
+
+def check_layout(layout):
+    depth, width = layout
+    if depth < 1 or width < 1 or depth * width > 8:
+        raise Exception("Invalid DocStore layout depth=%s width=%s" % (depth, width))
+    return (depth, width)
+
+
+def config_layouts(config):
+    """
+    The (current, previous) layouts recorded in a store config, previous
+    is None unless a reshard is in progress
+    """
+    if config.get("layout_version", 1) < LAYOUT_VERSION or "layout" not in config:
+        return DEFAULT_LAYOUT, None
+    previous = config.get("previous_layout", None)
+    return tuple(config["layout"]), tuple(previous) if previous else None
+
+
+def shard_dir(file_path, id, layout=DEFAULT_LAYOUT):
+    return os.path.join(file_path, *directory_hash_id(id, *layout))
+
+
+def shard_dirs(file_path, layout=DEFAULT_LAYOUT):
+    """
+    The existing leaf directories of a layout
+    """
+    depth, width = layout
+    out = []
+    for path in glob(os.path.join(file_path, *(["?" * width] * depth))):
+        parts = os.path.relpath(path, file_path).split(os.sep)
+        if os.path.isdir(path) and not any(p.startswith("_") for p in parts):
+            out.append(path)
+    return sorted(out)
+
+
+ENTRY_RE = re.compile(r'^(dataset_)?([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})')
+
+
+def entry_id(name):
+    """
+    The id a shard directory entry belongs to (a document, one of its
+    spilled fields, an object file or object directory), or None
+    """
+    m = ENTRY_RE.match(name)
+    if m is None:
+        return None
+    return m.group(2)
+
+
+def move_entry(src, dst):
+    """
+    Move a shard directory entry to its place in another layout. Files are
+    linked into place, so an entry written at `dst` after the move started
+    is never replaced by the old copy, which is dropped instead. Entries
+    moved or removed by someone else in the meantime are skipped. Returns
+    True if the entry was moved.
+    """
+    try:
+        dst_dir = os.path.dirname(dst)
+        if not os.path.exists(dst_dir):
+            try:
+                os.makedirs(dst_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        if os.path.isdir(src):
+            if os.path.exists(dst):
+                return False
+            os.rename(src, dst)
+            return True
+        try:
+            os.link(src, dst)
+            moved = True
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                moved = False
+            elif e.errno in (errno.EPERM, errno.EXDEV, errno.EOPNOTSUPP):
+                # no hard links on this filesystem
+                if os.path.exists(dst):
+                    moved = False
+                else:
+                    os.rename(src, dst)
+                    return True
+            else:
+                raise
+        os.unlink(src)
+        return moved
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    return False
+
+
+def remove_empty_dirs(file_path, path):
+    """
+    Remove `path` and its parents up to `file_path` while they are empty
+    """
+    while os.path.abspath(path) != os.path.abspath(file_path):
+        try:
+            os.rmdir(path)
+        except OSError:
+            return
+        path = os.path.dirname(path)
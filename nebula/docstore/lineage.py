@@ -0,0 +1,211 @@
+"""
+Lineage index over Galaxy result documents
+
+GalaxyService.get_meta stores the provenance of every dataset with its
+document: the job that made it, and the job parameters, where the input
+datasets appear as {"id" : ..., "uuid" : ...} records. Each document
+contributes the edges from its inputs to itself, labelled with the job:
+
+    input uuid --job_id--> document uuid
+
+The FileDocStore keeps them, once create_lineage has been run, under
+<docstore>/_lineage as two sets of posting files: parents/<id> lists the
+inputs of a dataset and children/<id> the datasets made from it. As with
+the field indexes these are append-only logs of '+<uuid> <job_id>' and
+'-<uuid> <job_id>' lines, so traversals read one small file per dataset
+visited and never scan the store.
+
+Writers update the postings under a flock on <docstore>/_lineage.lock, and
+a rebuild holds it from the scan of the store until the new postings,
+written to a temporary directory, have been renamed into place, so no
+edge written meanwhile is lost.
+"""
+
+import os
+import uuid
+import shutil
+from nebula.docstore.segment import flocked
+
+LINEAGE_DIR = "_lineage"
+LOCK_SUFFIX = ".lock"
+EDGES_SUFFIX = ".edges"
+PARENTS = "parents"
+CHILDREN = "children"
+
+
+def _clean_uuid(value):
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None
+
+
+def _input_uuids(value):
+    """
+    The dataset uuids referenced by a job parameter value. The records of
+    the inputs are not descended into, with follow=True provenance they
+    hold the inputs' own parameters.
+    """
+    if isinstance(value, dict):
+        if "uuid" in value:
+            id = _clean_uuid(value["uuid"])
+            if id is not None:
+                yield id
+            return
+        for v in value.values():
+            for id in _input_uuids(v):
+                yield id
+    elif isinstance(value, list):
+        for v in value:
+            for id in _input_uuids(v):
+                yield id
+
+
+def lineage_edges(doc):
+    """
+    The set of (input uuid, job id) pairs of the job that made `doc`
+    """
+    out = set()
+    if doc is None:
+        return out
+    prov = doc.get("provenance", None)
+    if not isinstance(prov, dict):
+        return out
+    job = str(prov.get("job_id", None) or "")
+    own = _clean_uuid(doc.get("uuid", None))
+    for id in _input_uuids(prov.get("parameters", None) or {}):
+        if id != own:
+            out.add( (id, job) )
+    return out
+
+
+def traverse(step, id, max_depth=None):
+    """
+    The ids reachable from `id` by repeatedly following `step(id)`, a
+    function returning (id, job) pairs, up to `max_depth` steps away
+    """
+    seen = set()
+    frontier = [id]
+    depth = 0
+    while frontier and (max_depth is None or depth < max_depth):
+        depth += 1
+        next_frontier = []
+        for node in frontier:
+            for other, job in step(node):
+                if other != id and other not in seen:
+                    seen.add(other)
+                    next_frontier.append(other)
+        frontier = next_frontier
+    return seen
+
+
+class LineageIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + LOCK_SUFFIX
+
+    def enabled(self):
+        return os.path.exists(self.path)
+
+    def maintained(self):
+        """
+        Whether writers have to update the index: it exists, or is being
+        built for the first time, or is in the middle of being replaced
+        """
+        return os.path.exists(self.lock_path) or os.path.exists(self.path)
+
+    def _posting_path(self, kind, id, base=None):
+        return os.path.join(base or self.path, kind, id[:2], id + EDGES_SUFFIX)
+
+    def _append(self, kind, id, lines, base=None):
+        path = self._posting_path(kind, id, base)
+        dir = os.path.dirname(path)
+        if not os.path.exists(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                if not os.path.exists(dir):
+                    raise
+        with open(path, "a") as handle:
+            handle.write("".join(lines))
+
+    def edges(self, kind, id):
+        """
+        The (uuid, job id) pairs of the parents or children of `id`
+        """
+        out = set()
+        try:
+            handle = open(self._posting_path(kind, id))
+        except IOError:
+            return out
+        with handle:
+            for line in handle:
+                other, job = line[1:].rstrip("\n").split(" ", 1)
+                if line.startswith("+"):
+                    out.add( (other, job) )
+                else:
+                    out.discard( (other, job) )
+        return out
+
+    def update(self, id, new_edges):
+        """
+        Replace the inputs recorded for `id`, the current ones are read from
+        its parents posting rather than from the old document
+        """
+        self.update_many([(id, new_edges)])
+
+    def update_many(self, items):
+        """
+        Replace the inputs recorded for a batch of (id, edges) pairs, under
+        the lock
+        """
+        with flocked(self.lock_path):
+            if not os.path.exists(self.path):
+                # dropped
+                return
+            for id, new_edges in items:
+                old_edges = self.edges(PARENTS, id)
+                lines = []
+                for other, job in old_edges - new_edges:
+                    self._append(CHILDREN, other, ["-%s %s\n" % (id, job)])
+                    lines.append("-%s %s\n" % (other, job))
+                for other, job in new_edges - old_edges:
+                    self._append(CHILDREN, other, ["+%s %s\n" % (id, job)])
+                    lines.append("+%s %s\n" % (other, job))
+                if len(lines):
+                    self._append(PARENTS, id, lines)
+
+    def build(self, docs):
+        """
+        Rebuild the index from an iterable of (id, doc) pairs, writing out
+        compacted posting files. Writers wait for it to finish, and then
+        apply their changes to the new postings.
+        """
+        with flocked(self.lock_path):
+            postings = {}
+            for id, doc in docs:
+                for other, job in lineage_edges(doc):
+                    postings.setdefault( (PARENTS, id), [] ).append("+%s %s\n" % (other, job))
+                    postings.setdefault( (CHILDREN, other), [] ).append("+%s %s\n" % (id, job))
+            tmp = "%s.tmp.%d" % (self.path, os.getpid())
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+            os.makedirs(tmp)
+            for (kind, id), lines in postings.items():
+                self._append(kind, id, lines, tmp)
+            old = None
+            if os.path.exists(self.path):
+                old = "%s.old.%d" % (self.path, os.getpid())
+                os.rename(self.path, old)
+            os.rename(tmp, self.path)
+            if old is not None:
+                shutil.rmtree(old)
+
+    def clear(self):
+        if not self.maintained():
+            return
+        with flocked(self.lock_path):
+            if os.path.exists(self.path):
+                shutil.rmtree(self.path)
+            os.unlink(self.lock_path)
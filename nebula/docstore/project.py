@@ -0,0 +1,138 @@
+"""
+Field projection for doc store reads
+
+Galaxy result documents are dominated by fields most queries never look
+at (provenance, the job record with its stdout/stderr). decode_fields
+walks the top level of a JSON document and only decodes the requested
+members, the rest are skipped over with regular expressions, without
+building Python objects for them.
+"""
+
+import re
+import json
+
+_decoder = json.JSONDecoder()
+
+WS = re.compile(r'[ \t\n\r]*')
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]', re.S)
+SCALAR = re.compile(r'[^,}\]\s]*')
+
+# always returned, so projected documents can still be used as Targets
+ALWAYS_FIELDS = ["uuid", "id"]
+
+
+def _skip_value(data, pos):
+    """
+    Return the position just after the JSON value starting at `pos`
+    """
+    c = data[pos]
+    if c == '"':
+        m = STRING.match(data, pos)
+        if m is None:
+            raise ValueError("Unterminated string at %d" % (pos))
+        return m.end()
+    if c in "[{":
+        depth = 0
+        for m in TOKEN.finditer(data, pos):
+            t = m.group(0)
+            if t in "[{":
+                depth += 1
+            elif t in "]}":
+                depth -= 1
+                if depth == 0:
+                    return m.end()
+        raise ValueError("Unterminated value at %d" % (pos))
+    return SCALAR.match(data, pos).end()
+
+
+def decode_fields(data, keys):
+    """
+    Decode only the top level members named in `keys` from the JSON object
+    in `data`. Stops reading as soon as all of them have been found.
+    """
+    remaining = set(keys)
+    out = {}
+    pos = WS.match(data, 0).end()
+    if data[pos:pos+1] != "{":
+        raise ValueError("Not a JSON object")
+    pos = WS.match(data, pos + 1).end()
+    if data[pos:pos+1] == "}":
+        return out
+    while remaining:
+        m = STRING.match(data, pos)
+        if m is None:
+            raise ValueError("Expecting member name at %d" % (pos))
+        key = json.loads(m.group(0))
+        pos = WS.match(data, m.end()).end()
+        if data[pos:pos+1] != ":":
+            raise ValueError("Expecting ':' at %d" % (pos))
+        pos = WS.match(data, pos + 1).end()
+        if key in remaining:
+            out[key], pos = _decoder.raw_decode(data, pos)
+            remaining.discard(key)
+        else:
+            pos = _skip_value(data, pos)
+        pos = WS.match(data, pos).end()
+        c = data[pos:pos+1]
+        if c == ",":
+            pos = WS.match(data, pos + 1).end()
+        elif c == "}":
+            break
+        else:
+            raise ValueError("Expecting ',' or '}' at %d" % (pos))
+    return out
+
+
+def top_level(fields):
+    """
+    The top level member names needed to evaluate a list of field paths
+    """
+    return set( f.split(".")[0] for f in fields )
+
+
+def load_fields(data, loads, keys):
+    """
+    Decode a stored document, only the top level `keys` of it if that is
+    not None. Falls back to a full decode for anything that isn't plain JSON.
+    """
+    if keys is None:
+        return loads(data)
+    if data[:1] == "{":
+        try:
+            return decode_fields(data, keys)
+        except ValueError:
+            pass
+    meta = loads(data)
+    return dict( (k, meta[k]) for k in keys if k in meta )
+
+
+def get_path(doc, path, default=None):
+    """
+    Look up a dotted field path (ie 'job.exit_code') in a document
+    """
+    value = doc
+    for p in path.split("."):
+        if isinstance(value, dict) and p in value:
+            value = value[p]
+        else:
+            return default
+    return value
+
+
+def project(doc, fields):
+    """
+    Copy of `doc` with only the listed field paths (plus the uuid/id)
+    """
+    missing = object()
+    out = {}
+    for f in list(fields) + ALWAYS_FIELDS:
+        value = get_path(doc, f, missing)
+        if value is missing:
+            continue
+        parts = f.split(".")
+        dst = out
+        for p in parts[:-1]:
+            dst = dst.setdefault(p, {})
+        dst[parts[-1]] = value
+    return out
@@ -0,0 +1,127 @@
+"""
+Query language for DocStore.filter
+
+Filter arguments map a field path, which may be dotted to reach into
+nested objects (ie 'job.exit_code'), to a condition. A plain value must be
+equal to the field, a list (or other iterable) of values must contain it,
+and a dict of operators applies each of them:
+
+    $eq, $ne        equal / not equal (a missing field is 'not equal')
+    $gt, $gte       greater than (or equal), for numbers and for strings
+    $lt, $lte       less than (or equal)
+    $in             one of a list of values
+    $exists         true if the field must be present, false if absent
+    $prefix         string field starting with the argument
+    $contains       list field holding the argument, or string field
+                    containing it as a substring
+
+ie filter(**{"job.exit_code" : {"$ne" : 0}, "file_size" : {"$gt" : 1e9}})
+"""
+
+from nebula.docstore.project import get_path, top_level
+
+OPERATORS = ["$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$exists", "$prefix", "$contains"]
+RANGE_OPERATORS = ["$gt", "$gte", "$lt", "$lte"]
+NUMBER_TYPES = (int, long, float)
+
+_missing = object()
+
+
+class QueryError(Exception):
+    pass
+
+
+def is_operator_spec(value):
+    return isinstance(value, dict) and len(value) > 0 and all(isinstance(k, basestring) and k.startswith("$") for k in value)
+
+
+def comparable(a, b):
+    """
+    Ordering is only defined between two numbers or two strings
+    """
+    if isinstance(a, bool) or isinstance(b, bool):
+        return False
+    if isinstance(a, NUMBER_TYPES) and isinstance(b, NUMBER_TYPES):
+        return True
+    return isinstance(a, basestring) and isinstance(b, basestring)
+
+
+def compare(value, op, arg):
+    if not comparable(value, arg):
+        return False
+    if op == "$gt":
+        return value > arg
+    if op == "$gte":
+        return value >= arg
+    if op == "$lt":
+        return value < arg
+    return value <= arg
+
+
+def match_value(value, op, arg):
+    """
+    Evaluate one operator against a field value (which is _missing if the
+    document doesn't have the field)
+    """
+    if op == "$exists":
+        return (value is not _missing) == bool(arg)
+    if value is _missing:
+        return op == "$ne"
+    if op == "$eq":
+        return value == arg
+    if op == "$ne":
+        return value != arg
+    if op == "$in":
+        return value in arg
+    if op == "$contains":
+        if isinstance(value, list):
+            return arg in value
+        if isinstance(value, basestring) and isinstance(arg, basestring):
+            return arg in value
+        return False
+    if op == "$prefix":
+        return isinstance(value, basestring) and isinstance(arg, basestring) and value.startswith(arg)
+    return compare(value, op, arg)
+
+
+class Query(object):
+    """
+    Compiled form of a set of filter arguments, a list of
+    (path, operator, argument) predicates that must all match
+    """
+
+    def __init__(self, filters):
+        self.predicates = []
+        for path, value in sorted(filters.items()):
+            if is_operator_spec(value):
+                for op, arg in sorted(value.items()):
+                    if op not in OPERATORS:
+                        raise QueryError("Unknown query operator %s" % (op))
+                    if op == "$in" and not hasattr(arg, "__iter__"):
+                        raise QueryError("$in needs a list of values")
+                    self.predicates.append( (path, op, arg) )
+            elif hasattr(value, "__iter__"):
+                self.predicates.append( (path, "$in", value) )
+            else:
+                self.predicates.append( (path, "$eq", value) )
+
+    def paths(self):
+        return set( p[0] for p in self.predicates )
+
+    def keys(self):
+        """
+        The top level document members needed to evaluate the query
+        """
+        return top_level(self.paths())
+
+    def match(self, doc):
+        for path, op, arg in self.predicates:
+            if not match_value(get_path(doc, path, _missing), op, arg):
+                return False
+        return True
+
+
+def compile_query(filters):
+    if isinstance(filters, Query):
+        return filters
+    return Query(filters)
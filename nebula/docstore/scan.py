@@ -0,0 +1,178 @@
+"""
+Multi-process scanning for FileDocStore.filter
+
+The store is split into partitions, the shard directories for the one file
+per document layout or the segment files for the segment layout.
+Partitions are handed to a process pool, where the documents are decoded
+and the filter is evaluated, and only the matches are sent back. At most
+`window` partitions are in flight at once, so memory stays bounded however
+slowly the caller consumes the results.
+"""
+
+import os
+import Queue
+import logging
+import traceback
+import multiprocessing
+from glob import glob
+from collections import deque
+from itertools import islice
+from nebula.docstore.project import load_fields
+from nebula.docstore.blobs import LazyDoc, FileBlobLoader, has_blobs
+from nebula.docstore.layout import shard_dirs
+
+# Waiting with a timeout keeps the main process responsive to Ctrl-C
+WAIT_TIMEOUT = 1e9
+
+
+class ScanError(Exception):
+    pass
+
+
+def _match(meta, filters, prefix, loads):
+    """
+    Evaluate the filter, loading the spilled fields of the document only
+    if the filter needs them. Returns the document as a plain dict.
+    """
+    from nebula.docstore import filter_match
+    if has_blobs(meta):
+        meta = LazyDoc(meta, FileBlobLoader(prefix, loads))
+        return filter_match(meta, filters), dict(meta)
+    return filter_match(meta, filters), meta
+
+
+def _run_task(args):
+    func, task = args
+    try:
+        return True, func(task)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _scan_file_shard(task):
+    from nebula.docstore import FILE_SUFFIX
+    dir, filters, loads, keys = task
+    out = []
+    for path in glob(os.path.join(dir, "dataset_*" + FILE_SUFFIX)):
+        doc_id = os.path.basename(path).replace(FILE_SUFFIX, "").replace("dataset_", "")
+        with open(path) as handle:
+            data = handle.read()
+        try:
+            meta = load_fields(data, loads, keys)
+        except ValueError:
+            raise Exception("Error reading record %s" % (doc_id))
+        matched, meta = _match(meta, filters, path[:-len(FILE_SUFFIX)], loads)
+        if matched:
+            out.append( (doc_id, meta) )
+    return out
+
+
+def _scan_segment(task):
+    from nebula.docstore import doc_prefix
+    from nebula.docstore.segment import read_records
+    file_path, layouts, path, seg, end, filters, loads, keys = task
+    out = []
+    for op, doc_id, offset, size, data in read_records(path, 0):
+        if offset >= end:
+            break
+        if op != "P":
+            continue
+        meta = load_fields(data, loads, keys)
+        matched, meta = _match(meta, filters, list( doc_prefix(file_path, doc_id, l) for l in layouts ), loads)
+        if matched:
+            out.append( (doc_id, seg + (offset, size), meta) )
+    return out
+
+
+def windowed_map(pool, func, tasks, window, ordered=True):
+    """
+    Like pool.imap / pool.imap_unordered, but never has more than `window`
+    tasks submitted and not yet consumed
+    """
+    tasks = iter(tasks)
+    if ordered:
+        pending = deque()
+        for task in islice(tasks, window):
+            pending.append(pool.apply_async(_run_task, ((func, task),)))
+        while pending:
+            ok, result = pending.popleft().get(WAIT_TIMEOUT)
+            for task in islice(tasks, 1):
+                pending.append(pool.apply_async(_run_task, ((func, task),)))
+            if not ok:
+                raise ScanError(result)
+            yield result
+    else:
+        done = Queue.Queue()
+        outstanding = 0
+        for task in islice(tasks, window):
+            pool.apply_async(_run_task, ((func, task),), callback=done.put)
+            outstanding += 1
+        while outstanding:
+            ok, result = done.get(True, WAIT_TIMEOUT)
+            outstanding -= 1
+            for task in islice(tasks, 1):
+                pool.apply_async(_run_task, ((func, task),), callback=done.put)
+                outstanding += 1
+            if not ok:
+                raise ScanError(result)
+            yield result
+
+
+def file_partitions(store):
+    out = []
+    for layout in store._layouts():
+        out.extend(shard_dirs(store.file_path, layout))
+    return out
+
+
+def parallel_filter(store, filters, processes, ordered=True, keys=None, window=None, min_partitions=2):
+    """
+    Evaluate `filters` against every document of a FileDocStore using a
+    pool of `processes` workers, yields (id, doc) pairs. With `ordered` the
+    results come back in partition order, otherwise as soon as they are
+    ready. Stores with fewer than `min_partitions` partitions are scanned in
+    this process. If `keys` is set, workers only decode those top level
+    fields of each document.
+    """
+    if window is None:
+        window = processes * 2
+    if store.segments is not None:
+        store.segments.refresh()
+        segments = store.segments
+        with segments.mutex:
+            tasks = list( (store.file_path, store._layouts(), segments._segment_path(seg), seg, segments.positions.get(seg, 0), filters, store.loads, keys) for seg in segments.segments )
+        func = _scan_segment
+    else:
+        tasks = list( (dir, filters, store.loads, keys) for dir in file_partitions(store) )
+        func = _scan_file_shard
+
+    if len(tasks) < min_partitions or processes <= 1:
+        results = (func(task) for task in tasks)
+        pool = None
+    else:
+        logging.debug("Scanning %d partitions with %d processes" % (len(tasks), processes))
+        pool = multiprocessing.Pool(processes)
+        results = windowed_map(pool, func, tasks, window, ordered)
+    # while a store is being resharded a document may briefly be in both
+    # layouts
+    seen = set() if func is _scan_file_shard and store.previous_layout is not None else None
+    try:
+        for batch in results:
+            for rec in batch:
+                if func is _scan_segment:
+                    doc_id, loc, meta = rec
+                    # the worker can't tell superseded records apart, the
+                    # current location of each id is only known here
+                    if segments.entries.get(doc_id, None) != loc:
+                        continue
+                    yield doc_id, meta
+                elif seen is not None:
+                    if rec[0] not in seen:
+                        seen.add(rec[0])
+                        yield rec
+                else:
+                    yield rec
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,522 @@
+"""
+Log structured document storage for the FileDocStore
+
+Rather than one small file per document, documents are appended to large
+segment files under <docstore>/_segments. Each record is a header line
+'<op> <id> <length>' followed by the encoded document and a newline. A put
+is recorded with op 'P', a delete leaves a tombstone record with op 'D'.
+
+An in-memory map of id -> record location is rebuilt by replaying the
+segments, and a snapshot of it is persisted so opening a store only has to
+replay what was appended since the snapshot was written.
+
+Segment files are named segment_<number>_<generation>.log. Compaction is
+size tiered: it merges a run of at most MERGE_MAX adjacent sealed segments
+of about the same size (or a single segment that is mostly garbage) into
+one file, named segment_<last>_<generation>_<first>.log after the range of
+numbers it replaces, with a higher generation than any of them. When
+replaying, a file is superseded by one of a higher generation whose range
+covers its own, so a crash part way through a compaction leaves the store
+readable. (Files compacted before merges were tiered have no <first>, and
+cover every number up to their own.) Tombstones are only dropped by a merge
+that starts at the oldest segment, as the records they delete may be in
+older segments.
+"""
+
+import os
+import re
+import json
+import math
+import errno
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from nebula.docstore.fileutil import atomic_write
+
+SEGMENT_DIR = "_segments"
+SEGMENT_RE = re.compile(r'^segment_(\d{8})_(\d{4})(?:_(\d{8}))?\.log$')
+SNAPSHOT_NAME = "index.snapshot"
+LOCK_NAME = "lock"
+COMPACT_LOCK_NAME = "compact.lock"
+
+MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+SNAPSHOT_EVERY = 100000
+# segments are merged in runs of MERGE_MIN to MERGE_MAX, of sizes in the
+# same power of TIER_RATIO above TIER_BASE bytes
+MERGE_MIN = 4
+MERGE_MAX = 10
+TIER_RATIO = 4
+TIER_BASE = 1024 * 1024
+
+
+class SegmentMismatch(Exception):
+    """
+    A record wasn't found where the index said it would be, which happens
+    when another process compacted the segments
+    """
+    pass
+
+
+@contextmanager
+def flocked(path, flags=fcntl.LOCK_EX):
+    handle = open(path, "a")
+    try:
+        fcntl.flock(handle, flags)
+        yield handle
+    finally:
+        handle.close()
+
+
+def read_records(path, pos):
+    """
+    Iterate over the complete records of a segment file starting at `pos`,
+    yields (op, id, offset, size, data)
+    """
+    with open(path, "rb") as handle:
+        handle.seek(pos)
+        while True:
+            header = handle.readline()
+            if not header.endswith("\n"):
+                break
+            op, id, length = header.split()
+            length = int(length)
+            data = handle.read(length + 1)
+            if len(data) < length + 1:
+                # a write that is still in progress
+                break
+            yield op, id, pos, len(header) + length + 1, data[:-1]
+            pos = handle.tell()
+
+
+def size_tier(size):
+    if size <= TIER_BASE:
+        return 0
+    return int(math.log(float(size) / TIER_BASE, TIER_RATIO)) + 1
+
+
+class SegmentStore(object):
+
+    def __init__(self, path, max_segment_size=MAX_SEGMENT_SIZE, snapshot_every=SNAPSHOT_EVERY):
+        self.path = path
+        self.max_segment_size = max_segment_size
+        self.snapshot_every = snapshot_every
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.lock_path = os.path.join(self.path, LOCK_NAME)
+        self.names = {}
+        self.mutex = threading.RLock()
+        self.compact_thread = None
+        self.reload()
+
+    def _segment_path(self, seg):
+        name = self.names.get(seg, None)
+        if name is None:
+            name = "segment_%08d_%04d.log" % seg
+        return os.path.join(self.path, name)
+
+    def _spans(self):
+        """
+        Map of (number, generation) -> (first number covered, file name) for
+        every segment file
+        """
+        spans = {}
+        for name in os.listdir(self.path):
+            m = SEGMENT_RE.match(name)
+            if m:
+                seg = (int(m.group(1)), int(m.group(2)))
+                if m.group(3) is not None:
+                    first = int(m.group(3))
+                elif seg[1] > 0:
+                    first = 0
+                else:
+                    first = seg[0]
+                spans[seg] = (first, name)
+        return spans
+
+    def _live_segments(self, spans=None):
+        """
+        The segment files to replay, in order, as (number, generation) tuples
+        """
+        if spans is None:
+            spans = self._spans()
+        self.names.update( (seg, name) for seg, (first, name) in spans.items() )
+        return sorted( seg for seg, (first, name) in spans.items()
+            if not any( g > seg[1] and f <= first and n >= seg[0] for (n, g), (f, x) in spans.items() ) )
+
+    def _reset(self):
+        self.entries = {}
+        self.positions = {}
+        self.segments = []
+        self.dead_bytes = 0
+        self.total_bytes = 0
+        self.since_snapshot = 0
+
+    def reload(self):
+        with self.mutex:
+            self._reset()
+            self._load_snapshot()
+            self._replay()
+
+    def _load_snapshot(self):
+        path = os.path.join(self.path, SNAPSHOT_NAME)
+        if not os.path.exists(path):
+            return
+        live = set(self._live_segments())
+        with open(path) as handle:
+            header = json.loads(handle.readline())
+            for num, gen, pos in header['segments']:
+                seg = (num, gen)
+                if seg not in live or os.path.getsize(self._segment_path(seg)) < pos:
+                    logging.info("Discarding stale segment index snapshot")
+                    self._reset()
+                    return
+                self.positions[seg] = pos
+            for line in handle:
+                id, num, gen, offset, size = line.split()
+                self.entries[id] = (int(num), int(gen), int(offset), int(size))
+        self.dead_bytes = header['dead_bytes']
+        self.total_bytes = header['total_bytes']
+
+    def save_snapshot(self):
+        with self.mutex:
+            lines = [ json.dumps( {
+                "segments" : list( [seg[0], seg[1], pos] for seg, pos in sorted(self.positions.items()) ),
+                "dead_bytes" : self.dead_bytes,
+                "total_bytes" : self.total_bytes
+            } ) + "\n" ]
+            for id, loc in self.entries.iteritems():
+                lines.append("%s %d %d %d %d\n" % ((id,) + loc))
+            atomic_write(os.path.join(self.path, SNAPSHOT_NAME), "".join(lines))
+            self.since_snapshot = 0
+
+    def _apply(self, op, id, loc):
+        old = self.entries.get(id, None)
+        if old is not None:
+            self.dead_bytes += old[3]
+        if op == "P":
+            self.entries[id] = loc
+        else:
+            self.entries.pop(id, None)
+            self.dead_bytes += loc[3]
+        self.total_bytes += loc[3]
+        self.since_snapshot += 1
+
+    def _read_records(self, seg, pos):
+        return read_records(self._segment_path(seg), pos)
+
+    def _replay(self):
+        """
+        Bring the in-memory index up to date with everything appended to
+        the segments (by this or any other process)
+        """
+        live = self._live_segments()
+        if any(seg not in live for seg in self.positions):
+            # segments were compacted underneath us, start over from the
+            # snapshot the compaction wrote
+            self._reset()
+            self._load_snapshot()
+        for seg in live:
+            pos = self.positions.get(seg, 0)
+            if os.path.getsize(self._segment_path(seg)) <= pos:
+                continue
+            for op, id, offset, size, data in self._read_records(seg, pos):
+                self._apply(op, id, seg + (offset, size))
+                pos = offset + size
+            self.positions[seg] = pos
+        self.segments = live
+
+    def refresh(self):
+        """
+        Cheap check for appends from other processes: only the tail segment
+        and the name of the next one are looked at
+        """
+        with self.mutex:
+            if not self.segments:
+                if os.listdir(self.path):
+                    self._replay()
+                return
+            tail = self.segments[-1]
+            next_seg = (tail[0] + 1, 0)
+            try:
+                size = os.path.getsize(self._segment_path(tail))
+            except OSError:
+                size = None
+            if size != self.positions.get(tail, 0) or os.path.exists(self._segment_path(next_seg)):
+                self._replay()
+
+    def _read(self, id, loc):
+        num, gen, offset, size = loc
+        with open(self._segment_path((num, gen)), "rb") as handle:
+            handle.seek(offset)
+            data = handle.read(size)
+        header, sep, body = data.partition("\n")
+        fields = header.split()
+        if len(fields) != 3 or fields[0] != "P" or fields[1] != id or not body.endswith("\n"):
+            raise SegmentMismatch()
+        return body[:-1]
+
+    def get(self, id):
+        """
+        Returns the encoded document or None
+        """
+        self.refresh()
+        for attempt in range(2):
+            with self.mutex:
+                loc = self.entries.get(id, None)
+            if loc is None:
+                return None
+            try:
+                return self._read(id, loc)
+            except (IOError, OSError, SegmentMismatch):
+                if attempt:
+                    raise
+                self.reload()
+
+    def exists(self, id):
+        self.refresh()
+        return id in self.entries
+
+    def ids(self):
+        self.refresh()
+        with self.mutex:
+            return list(self.entries.keys())
+
+    def _append(self, records, sync=False):
+        """
+        Append a batch of (op, id, data) records to the tail segment
+        """
+        with self.mutex:
+            with flocked(self.lock_path):
+                self._replay()
+                if self.segments:
+                    seg = self.segments[-1]
+                    if seg[1] != 0 or self.positions.get(seg, 0) >= self.max_segment_size:
+                        seg = (seg[0] + 1, 0)
+                else:
+                    seg = (1, 0)
+                buf = []
+                pos = self.positions.get(seg, 0)
+                locs = []
+                for op, id, data in records:
+                    header = "%s %s %d\n" % (op, id, len(data))
+                    size = len(header) + len(data) + 1
+                    buf.append(header)
+                    buf.append(data)
+                    buf.append("\n")
+                    locs.append( (op, id, seg + (pos, size)) )
+                    pos += size
+                with open(self._segment_path(seg), "ab") as handle:
+                    handle.write("".join(buf))
+                    handle.flush()
+                    if sync:
+                        os.fsync(handle.fileno())
+                for op, id, loc in locs:
+                    self._apply(op, id, loc)
+                self.positions[seg] = pos
+                if seg not in self.segments:
+                    self.segments.append(seg)
+            if self.since_snapshot >= self.snapshot_every:
+                self.save_snapshot()
+
+    def put(self, id, data):
+        self._append([("P", id, data)])
+
+    def put_many(self, items, sync=False):
+        items = list(items)
+        if len(items):
+            self._append(list( ("P", id, data) for id, data in items ), sync=sync)
+
+    def delete(self, id):
+        self.refresh()
+        if id not in self.entries:
+            return False
+        self._append([("D", id, "")])
+        return True
+
+    def scan(self):
+        """
+        Sequentially read the live documents, yields (id, data). If another
+        process compacts away a segment before it is read, the scan carries
+        on from the new segments, skipping the documents already returned.
+        """
+        self.refresh()
+        seen = set()
+        while True:
+            with self.mutex:
+                segments = list(self.segments)
+                positions = dict(self.positions)
+                entries = self.entries
+            try:
+                for seg in segments:
+                    end = positions.get(seg, 0)
+                    for op, id, offset, size, data in self._read_records(seg, 0):
+                        if offset >= end:
+                            break
+                        if op == "P" and entries.get(id, None) == seg + (offset, size) and id not in seen:
+                            seen.add(id)
+                            yield id, data
+                return
+            except (IOError, OSError), e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self.reload()
+
+    def garbage_ratio(self):
+        if self.total_bytes == 0:
+            return 0.0
+        return float(self.dead_bytes) / self.total_bytes
+
+    def _segment_bytes(self, entries):
+        """
+        Map of segment -> bytes of its records that are still live
+        """
+        out = {}
+        for num, gen, offset, size in entries.itervalues():
+            seg = (num, gen)
+            out[seg] = out.get(seg, 0) + size
+        return out
+
+    def _pick_merge(self, segments, positions, live_bytes, threshold):
+        """
+        The run of segments to merge next: in the smallest tier that has
+        MERGE_MIN adjacent segments, up to MERGE_MAX of them. Otherwise the
+        segment with the most garbage if more than `threshold` of it is,
+        only counting segments that were never compacted or the oldest one,
+        as the others may hold tombstones that have to be kept. None if
+        nothing is worth merging.
+        """
+        best = None
+        run = []
+        for seg in segments + [None]:
+            if seg is not None and len(run) and len(run) < MERGE_MAX and \
+                size_tier(positions.get(seg, 0)) == size_tier(positions.get(run[0], 0)):
+                run.append(seg)
+                continue
+            if len(run) >= MERGE_MIN:
+                tier = size_tier(positions.get(run[0], 0))
+                if best is None or tier < best[0]:
+                    best = (tier, run)
+            run = [seg]
+        if best is not None:
+            return best[1]
+        worst = None
+        for seg in segments:
+            size = positions.get(seg, 0)
+            if size and (seg[1] == 0 or seg == self.segments[0]):
+                ratio = 1.0 - float(live_bytes.get(seg, 0)) / size
+                if ratio > 0 and ratio >= threshold and (worst is None or ratio > worst[0]):
+                    worst = (ratio, seg)
+        if worst is not None:
+            return [worst[1]]
+        return None
+
+    def compact(self, threshold=0.5):
+        """
+        Merge a run of sealed segments into a new file (see _pick_merge) and
+        remove them, returns the number of segments merged. The tail segment
+        is sealed first if it is the one with the garbage. Writers are only
+        blocked while the merge is picked and while the new file is swapped in.
+        """
+        with flocked(os.path.join(self.path, COMPACT_LOCK_NAME)):
+            with self.mutex:
+                with flocked(self.lock_path):
+                    spans = self._spans()
+                    self._replay()
+                    live = list(self.segments)
+                    if len(live) == 0:
+                        return 0
+                    # leftovers of a compaction that crashed after its rename
+                    for seg in spans:
+                        if seg not in live:
+                            os.unlink(self._segment_path(seg))
+                            self.names.pop(seg, None)
+                    live_bytes = self._segment_bytes(self.entries)
+                    run = self._pick_merge(live[:-1], self.positions, live_bytes, threshold)
+                    if run is None:
+                        run = self._pick_merge(live[-1:], self.positions, live_bytes, threshold)
+                        if run is None:
+                            return 0
+                        # start a new tail segment so the old one is immutable
+                        open(self._segment_path( (live[-1][0] + 1, 0) ), "ab").close()
+                        self._replay()
+                    entries = dict(self.entries)
+                    positions = dict(self.positions)
+                    firsts = dict( (seg, first) for seg, (first, name) in self._spans().items() )
+            # tombstones have to be kept if there are older segments, which
+            # may hold the records they delete
+            keep_tombstones = run[0] != live[0]
+            out_seg = (run[-1][0], max(a[1] for a in run) + 1)
+            out_name = "segment_%08d_%04d_%08d.log" % (out_seg + (firsts[run[0]],))
+            out_path = os.path.join(self.path, out_name)
+            tmp = out_path + ".tmp"
+            moved = {}
+            deleted = set()
+            pos = 0
+            with open(tmp, "wb") as out:
+                for seg in run:
+                    end = positions.get(seg, 0)
+                    for op, id, offset, size, data in self._read_records(seg, 0):
+                        if offset >= end:
+                            break
+                        if op == "P" and entries.get(id, None) == seg + (offset, size):
+                            moved[id] = (seg + (offset, size), out_seg + (pos, size))
+                        elif op == "D" and keep_tombstones and id not in entries and id not in deleted:
+                            deleted.add(id)
+                        else:
+                            continue
+                        out.write("%s %s %d\n%s\n" % (op, id, len(data), data))
+                        pos += size
+                out.flush()
+                os.fsync(out.fileno())
+            with self.mutex:
+                with flocked(self.lock_path):
+                    self._replay()
+                    os.rename(tmp, out_path)
+                    self.names[out_seg] = out_name
+                    removed = 0
+                    for seg in run:
+                        os.unlink(self._segment_path(seg))
+                        self.names.pop(seg, None)
+                        removed += self.positions.pop(seg, 0)
+                    for id, (old, new) in moved.iteritems():
+                        if self.entries.get(id, None) == old:
+                            self.entries[id] = new
+                    self.positions[out_seg] = pos
+                    self.dead_bytes -= removed - pos
+                    self.total_bytes -= removed - pos
+                    self.segments = self._live_segments()
+                self.save_snapshot()
+        logging.info("Merged %d segments in %s" % (len(run), self.path))
+        return len(run)
+
+    def _compact_loop(self, interval, threshold):
+        while self.compact_thread is not None:
+            self.compact_event.wait(interval)
+            if self.compact_thread is None:
+                break
+            try:
+                while self.compact_thread is not None and self.compact(threshold):
+                    pass
+            except Exception:
+                logging.exception("Segment compaction failed")
+
+    def start_compaction(self, interval=600, threshold=0.5):
+        """
+        Start a background thread that merges segments every `interval`
+        seconds, until there is nothing left worth merging (see compact)
+        """
+        if self.compact_thread is None:
+            self.compact_event = threading.Event()
+            self.compact_thread = threading.Thread(target=self._compact_loop, args=(interval, threshold))
+            self.compact_thread.daemon = True
+            self.compact_thread.start()
+
+    def shutdown(self):
+        if self.compact_thread is not None:
+            thread = self.compact_thread
+            self.compact_thread = None
+            self.compact_event.set()
+            thread.join()
+        if self.since_snapshot:
+            self.save_snapshot()
@@ -0,0 +1,396 @@
+"""
+DocStore that keeps document JSON in an embedded SQLite database, while
+data objects stay in a DiskObjectStore next to it
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import functools
+from galaxy.objectstore import DiskObjectStore
+from galaxy.objectstore.local_cache import CachedDiskObjectStore
+from nebula.docstore import DocStore, TargetDict, DiskObjectStoreConfig, make_query
+from nebula.docstore.aggregate import AggregateSet, AGGREGATE_DIR
+from nebula.docstore.project import project, top_level, ALWAYS_FIELDS
+from nebula.docstore.query import compile_query, NUMBER_TYPES
+from nebula.docstore.blobs import decode_blob, BLOB_KEY
+from nebula.docstore.lineage import lineage_edges
+
+DB_NAME = "docstore.sqlite"
+FETCH_SIZE = 1000
+
+SCALAR_TYPES = (basestring, int, long, float, bool)
+COMPARE_SQL = {"$gt" : ">", "$gte" : ">=", "$lt" : "<", "$lte" : "<="}
+
+
+def path_literal(field):
+    """
+    JSON1 path for a field, which may be a dotted path to a nested field
+    """
+    if '"' in field or "'" in field:
+        raise Exception("Invalid field name: %s" % (field))
+    return "'$.%s'" % (".".join('"%s"' % (p) for p in field.split(".")))
+
+
+def json_path(field):
+    """
+    JSON1 expression for the value of a field. Indexes are expression
+    indexes, so queries must embed exactly the same expression text
+    """
+    return "json_extract(doc, %s)" % (path_literal(field))
+
+
+def predicate_sql(field, op, arg):
+    """
+    SQL for a query predicate, as (clause, params), or None if it can't be
+    expressed. The clause may match documents the predicate doesn't (ie
+    values of a different type), never the other way around.
+    """
+    expr = json_path(field)
+    if op == "$eq" and isinstance(arg, SCALAR_TYPES):
+        return "%s = ?" % (expr), [sql_value(arg)]
+    if op == "$ne" and isinstance(arg, SCALAR_TYPES):
+        return "(%s IS NULL OR %s != ?)" % (expr, expr), [sql_value(arg)]
+    if op == "$in" and isinstance(arg, (list, tuple, set, frozenset)) and all(isinstance(a, SCALAR_TYPES) for a in arg):
+        if len(arg) == 0:
+            return "0", []
+        return "%s IN (%s)" % (expr, ",".join("?" for a in arg)), list(sql_value(a) for a in arg)
+    if op in COMPARE_SQL and not isinstance(arg, bool) and isinstance(arg, NUMBER_TYPES + (basestring,)):
+        return "%s %s ?" % (expr, COMPARE_SQL[op]), [arg]
+    if op == "$exists":
+        return "json_type(doc, %s) IS %s NULL" % (path_literal(field), "NOT" if arg else ""), []
+    if op == "$prefix" and isinstance(arg, basestring):
+        if isinstance(arg, str):
+            arg = arg.decode("utf-8")
+        if len(arg) == 0 or ord(arg[-1]) >= 0xffff:
+            return "json_type(doc, %s) = 'text'" % (path_literal(field)), []
+        # a range, so an index on the field can be used
+        return "(%s >= ? AND %s < ?)" % (expr, expr), [arg, arg[:-1] + unichr(ord(arg[-1]) + 1)]
+    if op == "$contains" and isinstance(arg, SCALAR_TYPES):
+        path = path_literal(field)
+        return ("CASE json_type(doc, %s) WHEN 'array' THEN EXISTS (SELECT 1 FROM json_each(doc, %s) AS e WHERE e.value = ?) "
+            "WHEN 'text' THEN instr(%s, ?) > 0 ELSE 0 END" % (path, path, expr)), [sql_value(arg), arg]
+    return None
+
+
+def index_name(field):
+    return "doc_idx_" + re.sub(r'[^A-Za-z0-9_]', "_", field)
+
+
+def sql_value(value):
+    # JSON1 returns booleans as integers
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+class SQLiteDocStore(DocStore):
+    """
+    SQLite backed doc store. Documents are kept as JSON text in a single
+    table, declared fields get JSON path expression indexes, and filter
+    arguments are evaluated by SQLite. The database runs in WAL mode so
+    readers in other processes do not block a writer. Out of line fields
+    (see `blob_threshold`) go to a separate blobs table, and puts and
+    deletes are numbered in a changes table. The provenance edges between
+    datasets are kept in a lineage table. Declared aggregates are kept in
+    the store directory as for the FileDocStore.
+    """
+
+    def __init__(self, file_path, cache_path=None, indexes=None, blob_threshold=None, codec=None, cache_size=None, **kwds):
+        if codec not in (None, "json"):
+            raise Exception("SQLiteDocStore keeps documents as JSON, so they can be queried in SQL")
+        if cache_path:
+            objs = CachedDiskObjectStore(DiskObjectStoreConfig(), cache_path=cache_path, file_path=file_path, cache_size=cache_size, **kwds)
+        else:
+            objs = DiskObjectStore(DiskObjectStoreConfig(), file_path=file_path, **kwds)
+        super(SQLiteDocStore, self).__init__(objectstore=objs, blob_threshold=blob_threshold, **kwds)
+        self.file_path = os.path.abspath(file_path)
+        self.url = os.path.abspath(self.file_path)
+        if not os.path.exists(self.file_path):
+            os.mkdir(self.file_path)
+        self.db_path = os.path.join(self.file_path, DB_NAME)
+        self.local = threading.local()
+        conn = self._conn()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, doc TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS doc_indexes (field TEXT PRIMARY KEY)")
+            conn.execute("CREATE TABLE IF NOT EXISTS blobs (id TEXT, field TEXT, data BLOB NOT NULL, PRIMARY KEY (id, field))")
+            conn.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, id TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS lineage (parent TEXT NOT NULL, job TEXT NOT NULL, child TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS lineage_parent ON lineage (parent)")
+            conn.execute("CREATE INDEX IF NOT EXISTS lineage_child ON lineage (child)")
+        self.aggregates = AggregateSet(os.path.join(self.file_path, AGGREGATE_DIR))
+        for field in indexes or []:
+            self.create_index(field)
+
+    def _conn(self):
+        """
+        sqlite3 connections can't be shared between threads, so each thread
+        (ie the service thread and the main thread) gets its own
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def _select(self, keys):
+        """
+        Column expression for a document, or for only some of its top level
+        members: JSON1 extracts them as one JSON array, so the rest of the
+        document is never handed to Python. It is followed by the array of
+        their json_type, which is NULL only for a missing member.
+        """
+        if keys is None:
+            return "doc"
+        paths = list( path_literal(k) for k in sorted(keys) )
+        return "'[' || json_extract(doc, %s) || ',' || json_array(%s) || ']'" % (
+            ",".join(paths), ",".join( "json_type(doc, %s)" % (p) for p in paths ))
+
+    def _decode(self, data, keys):
+        if keys is None:
+            return self.loaddoc(data)
+        # with more than one path (the uuid and id are always included)
+        # JSON1 returns an array of the values
+        keys = sorted(keys)
+        values, types = self.loaddoc(data)
+        return dict( (k, v) for k, v, t in zip(keys, values, types) if t is not None )
+
+    def _keys(self, fields, query=None):
+        if fields is None:
+            return None
+        keys = top_level(fields) | set(ALWAYS_FIELDS)
+        if query is not None:
+            keys |= query.keys()
+        for k in keys:
+            # rejects names that can't be quoted into a path
+            json_path(k)
+        return keys
+
+    def _blob_loader(self, id):
+        return functools.partial(self._read_blob, id)
+
+    def _read_blob(self, id, field, ref):
+        row = self._conn().execute("SELECT data FROM blobs WHERE id = ? AND field = ?", (id, field)).fetchone()
+        if row is None:
+            raise Exception("Missing field %s of record %s" % (field, id))
+        return decode_blob(str(row[0]), self.loads)
+
+    def _write_blobs(self, conn, items):
+        """
+        Replace the out of line fields of a batch of (id, blobs) pairs, in
+        the caller's transaction
+        """
+        conn.executemany("DELETE FROM blobs WHERE id = ?", ( (id,) for id, blobs in items ))
+        conn.executemany("INSERT INTO blobs (id, field, data) VALUES (?, ?, ?)",
+            ( (id, field, sqlite3.Binary(data)) for id, blobs in items for field, (ref, data) in blobs.items() ))
+
+    def _write_lineage(self, conn, items):
+        """
+        Replace the lineage edges of a batch of (id, doc) pairs, in the
+        caller's transaction
+        """
+        conn.executemany("DELETE FROM lineage WHERE child = ?", ( (id,) for id, doc in items ))
+        conn.executemany("INSERT INTO lineage (parent, job, child) VALUES (?, ?, ?)",
+            ( (parent, job, id) for id, doc in items for parent, job in lineage_edges(doc) ))
+
+    def get(self, id, fields=None):
+        id = self.cleanid(id)
+        keys = self._keys(fields)
+        row = self._conn().execute("SELECT %s FROM docs WHERE id = ?" % (self._select(keys)), (id,)).fetchone()
+        if row is None:
+            return None
+        doc = self._lazy(id, self._decode(row[0], keys))
+        if fields is not None:
+            doc = project(doc, fields)
+        return TargetDict(doc)
+
+    def _old_docs(self, ids):
+        """
+        What the aggregates need of the current documents, read before they
+        (and their out of line fields) are replaced
+        """
+        if not len(self.aggregates):
+            return {}
+        fields = self.aggregates.fields()
+        return dict( (id, self.get(id, fields=fields)) for id in ids )
+
+    def put(self, id, doc):
+        id = self.cleanid(id)
+        doc = self._with_size(id, doc)
+        with self.aggregates.locked():
+            old_docs = self._old_docs([id])
+            core, blobs = self._spill(doc)
+            conn = self._conn()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO docs (id, doc) VALUES (?, ?)", (id, self.dumpdoc(core)))
+                self._write_blobs(conn, [(id, blobs)])
+                self._write_lineage(conn, [(id, doc)])
+                conn.execute("INSERT INTO changes (op, id) VALUES ('put', ?)", (id,))
+            self._update_aggregates([(old_docs.get(id, None), doc)])
+
+    def ids(self):
+        return list( str(a) for a, in self._conn().execute("SELECT id FROM docs") )
+
+    def get_many(self, ids):
+        ids = list(self.cleanid(id) for id in ids)
+        found = {}
+        conn = self._conn()
+        for i in range(0, len(ids), FETCH_SIZE):
+            chunk = ids[i:i+FETCH_SIZE]
+            rows = conn.execute("SELECT id, doc FROM docs WHERE id IN (%s)" % (",".join("?" for a in chunk)), chunk)
+            for doc_id, data in rows:
+                found[doc_id] = data
+        return list( TargetDict(self._lazy(id, self.loaddoc(found[id]))) if id in found else None for id in ids )
+
+    def put_many(self, items):
+        """
+        Store a batch of documents in a single transaction
+        """
+        items = list( (self.cleanid(id), doc) for id, doc in items )
+        items = list( (id, self._with_size(id, doc)) for id, doc in items )
+        with self.aggregates.locked():
+            old_docs = self._old_docs(id for id, doc in items)
+            spilled = list( (id,) + self._spill(doc) for id, doc in items )
+            conn = self._conn()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO docs (id, doc) VALUES (?, ?)",
+                    ( (id, self.dumpdoc(core)) for id, core, blobs in spilled ))
+                self._write_blobs(conn, list( (id, blobs) for id, core, blobs in spilled ))
+                self._write_lineage(conn, items)
+                conn.executemany("INSERT INTO changes (op, id) VALUES ('put', ?)", ( (id,) for id, core, blobs in spilled ))
+            self._update_aggregates( (old_docs.get(id, None), doc) for id, doc in items )
+
+    def _has_blobs(self):
+        return self._conn().execute("SELECT 1 FROM blobs LIMIT 1").fetchone() is not None
+
+    def _where(self, query):
+        """
+        Translate the query predicates that SQLite can evaluate into SQL, so
+        its expression indexes are used. Anything that can't be expressed
+        is left to the query check on the returned rows.
+        """
+        query = compile_query(query)
+        blobs = self._has_blobs()
+        clauses = []
+        params = []
+        for field, op, arg in query.predicates:
+            try:
+                sql = predicate_sql(field, op, arg)
+            except Exception:
+                continue
+            if sql is None:
+                continue
+            clause, args = sql
+            if blobs and ("." in field or op == "$contains"):
+                # the top level member may be stored out of line, in which
+                # case only the full check can tell
+                clause = "(%s OR json_type(doc, %s) IS NOT NULL)" % (clause, path_literal(field.split(".")[0] + "." + BLOB_KEY))
+            clauses.append(clause)
+            params.extend(args)
+        if len(clauses):
+            return " WHERE " + " AND ".join(clauses), params
+        return "", params
+
+    def filter(self, processes=None, ordered=True, fields=None, query=None, **kwds):
+        """
+        The filter is evaluated by SQLite, so `processes` and `ordered` are
+        accepted for compatibility with FileDocStore but have no effect
+        """
+        q = make_query(query, kwds)
+        where, params = self._where(q)
+        keys = self._keys(fields, q)
+        cur = self._conn().execute("SELECT id, %s FROM docs%s" % (self._select(keys), where), params)
+        while True:
+            rows = cur.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for doc_id, data in rows:
+                meta = self._lazy(doc_id, self._decode(data, keys))
+                if q.match(meta):
+                    if fields is not None:
+                        meta = project(meta, fields)
+                    yield doc_id, TargetDict(meta)
+
+    def explain(self, query=None, **kwds):
+        """
+        The SQL a query is translated to, and SQLite's plan for it
+        """
+        where, params = self._where(make_query(query, kwds))
+        sql = "SELECT id, doc FROM docs" + where
+        plan = self._conn().execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        return {"sql" : sql, "params" : params, "plan" : list( row[-1] for row in plan )}
+
+    def create_index(self, field):
+        path = json_path(field)
+        conn = self._conn()
+        with conn:
+            conn.execute("CREATE INDEX IF NOT EXISTS %s ON docs(%s)" % (index_name(field), path))
+            conn.execute("INSERT OR IGNORE INTO doc_indexes (field) VALUES (?)", (field,))
+
+    def drop_index(self, field):
+        conn = self._conn()
+        with conn:
+            conn.execute("DROP INDEX IF EXISTS %s" % (index_name(field)))
+            conn.execute("DELETE FROM doc_indexes WHERE field = ?", (field,))
+
+    def rebuild_indexes(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("REINDEX")
+
+    def list_indexes(self):
+        return sorted(row[0] for row in self._conn().execute("SELECT field FROM doc_indexes"))
+
+    def last_seq(self):
+        row = self._conn().execute("SELECT max(seq) FROM changes").fetchone()
+        return row[0] or 0
+
+    def changes(self, since=0):
+        cur = self._conn().execute("SELECT seq, op, id FROM changes WHERE seq > ? ORDER BY seq", (since,))
+        while True:
+            rows = cur.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for seq, op, id in rows:
+                yield seq, str(op), str(id)
+
+    def delete(self, obj, **kwds):
+        id = self.cleanid(obj.id)
+        with self.aggregates.locked():
+            old_docs = self._old_docs([id])
+            conn = self._conn()
+            with conn:
+                deleted = conn.execute("DELETE FROM docs WHERE id = ?", (id,)).rowcount
+                if deleted:
+                    conn.execute("INSERT INTO changes (op, id) VALUES ('delete', ?)", (id,))
+                conn.execute("DELETE FROM blobs WHERE id = ?", (id,))
+                conn.execute("DELETE FROM lineage WHERE child = ?", (id,))
+            if deleted:
+                self._update_aggregates([(old_docs.get(id, None), None)])
+        return self.objs.delete(obj, **kwds)
+
+    def create_lineage(self):
+        """
+        The lineage table is kept up to date by every write, this rebuilds
+        it for documents stored before it existed
+        """
+        items = list(self.filter(fields=["provenance"]))
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM lineage")
+            self._write_lineage(conn, items)
+
+    def parents(self, id):
+        rows = self._conn().execute("SELECT parent, job FROM lineage WHERE child = ?", (self.cleanid(id),))
+        return set( (str(a), str(b)) for a, b in rows )
+
+    def children(self, id):
+        rows = self._conn().execute("SELECT child, job FROM lineage WHERE parent = ?", (self.cleanid(id),))
+        return set( (str(a), str(b)) for a, b in rows )
+
+    def get_url(self):
+        return "sqlite://%s" % (self.url)
@@ -1,47 +1,203 @@
-
 import os
-import re
 import json
+import errno
 from urlparse import urlparse
-from glob import glob
+from multiprocessing.pool import ThreadPool
 import logging
 from nebula.target import Target
+from nebula.docstore.fileutil import atomic_write
+from galaxy.util.transfer import transfer_file, AUTO
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# kept in the scanned directory, maps the data files already ingested to
+# the sizes and mtimes their data and metadata files had at the time
+SYNC_STATE_NAME = ".nebula_sync.json"
+META_SUFFIX = ".json"
+# documents of ingested files are written in groups of this many, as their
+# data comes in
+DOC_BATCH = 16
+
+
+def _list_files(path):
+    """
+    (name, size, mtime) of the regular files in a directory, with a single
+    scandir pass where the scandir module is available
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_file():
+                st = entry.stat()
+                yield entry.name, st.st_size, st.st_mtime
+    else:
+        for name in os.listdir(path):
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            if os.path.isfile(os.path.join(path, name)):
+                yield name, st.st_size, st.st_mtime
+
+
+def scan_doc_pairs(path):
+    """
+    (data path, metadata path, stamp) of every data file in `path` that has
+    a <name>.json metadata file next to it, stamp being the sizes and mtimes
+    of the two
+    """
+    files = dict( (name, (size, mtime)) for name, size, mtime in _list_files(path) )
+    for name in sorted(files):
+        if not name.endswith(META_SUFFIX) or name == SYNC_STATE_NAME:
+            continue
+        data_name = name[:-len(META_SUFFIX)]
+        if data_name in files:
+            stamp = list(files[name]) + list(files[data_name])
+            yield os.path.join(path, data_name), os.path.join(path, name), stamp
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as handle:
+            meta = json.loads(handle.read())
+    except (IOError, ValueError):
+        return None
+    if not isinstance(meta, dict) or 'uuid' not in meta:
+        return None
+    return meta
+
 
 def scan_doc_dir(path):
     data_map = {}
-    for meta_path in glob(os.path.join(path, "*.json")):
-        data_path = re.sub(r'.json$', "", meta_path)
-        if os.path.exists(data_path):
-            try:
-                with open(meta_path) as handle:
-                    meta = json.loads(handle.read())
-                    if 'uuid' in meta:
-                        data_map[meta['uuid']] = data_path
-            except:
-                pass
+    for data_path, meta_path, stamp in scan_doc_pairs(path):
+        meta = _read_meta(meta_path)
+        if meta is not None:
+            data_map[meta['uuid']] = data_path
     return data_map
 
 
-def sync_doc_dir(path, docstore, uuid_set=None, filter=None):
-    data_map = scan_doc_dir(path)
-    #print "Scanned", path, data_map
-    for uuid, path in data_map.items():
-        t = Target(uuid)
-        if not docstore.exists(t):
-            copy = True
-            if uuid_set is not None and uuid not in uuid_set:
-                copy = False
-            if filter is not None:
-                with open(path + ".json") as handle:
-                    meta = json.loads(handle.read())
-                if not filter(meta):
-                    copy = False
-            if copy:
-                logging.info("Adding file: %s" % (path))
-                docstore.update_from_file(t, path, create=True)
-                with open(path + ".json") as handle:
-                    meta = json.loads(handle.read())
-                docstore.put(t.id, meta)
+def read_sync_state(state_path):
+    try:
+        with open(state_path) as handle:
+            return json.loads(handle.read())
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        logging.warning("Ignoring unreadable sync state %s" % (state_path))
+    return {}
+
+
+def write_sync_state(state_path, state):
+    try:
+        atomic_write(state_path, json.dumps(state))
+    except (IOError, OSError), e:
+        logging.warning("Unable to record sync state in %s: %s" % (state_path, e))
+
+
+def _ingest(args):
+    docstore, data_path, id, strategy = args
+    t = Target(id)
+    docstore.create(t)
+    used = transfer_file(data_path, docstore.get_filename(t), strategy)
+    # pushes the file on from a cache
+    docstore.update_from_file(t)
+    return id, used, docstore.size(t)
+
+
+def sync_doc_pairs(pairs, docstore, state, uuid_set=None, filter=None, processes=4, strategy=AUTO):
+    """
+    Ingest (data path, metadata path, stamp) pairs (see scan_doc_pairs) of
+    one directory, updating `state`, the sync state of that directory, as
+    they are stored. Returns the ids ingested.
+    """
+    tasks = []
+    metas = {}
+    for data_path, meta_path, stamp in pairs:
+        name = os.path.basename(data_path)
+        old = state.get(name, None)
+        if old is not None and old["stamp"] == stamp:
+            continue
+        meta = _read_meta(meta_path)
+        if meta is None:
+            continue
+        id = meta['uuid']
+        # only skipped once both halves are in: the document is written
+        # after the data, so data that made it in without its document is
+        # ingested again, and a document may be written (for an output
+        # that failed, say) before there is any data
+        if old is None and docstore.exists(Target(id)) and docstore.get(id, fields=["uuid"]) is not None:
+            state[name] = {"stamp" : stamp, "uuid" : id}
+            continue
+        if uuid_set is not None and id not in uuid_set:
+            continue
+        if filter is not None and not filter(meta):
+            continue
+        logging.info("Adding file: %s" % (data_path))
+        metas[id] = (name, stamp, meta)
+        tasks.append( (docstore, data_path, id, strategy) )
+    if not len(tasks):
+        return []
+
+    out = []
+    docs = []
+
+    def flush():
+        docstore.put_many(docs)
+        for id, doc in docs:
+            name, stamp, meta = metas[id]
+            state[name] = {"stamp" : stamp, "uuid" : id}
+            out.append(id)
+        del docs[:]
+
+    pool = ThreadPool(min(processes, len(tasks)))
+    try:
+        for id, used, size in pool.imap_unordered(_ingest, tasks):
+            logging.debug("Stored %s by %s" % (id, used))
+            name, stamp, meta = metas[id]
+            docs.append( (id, dict(meta, file_size=size)) )
+            if len(docs) >= DOC_BATCH:
+                flush()
+    finally:
+        pool.close()
+        pool.join()
+        #including after a failure, for the files that made it
+        flush()
+    return out
+
+
+def sync_doc_dir(path, docstore, uuid_set=None, filter=None, processes=4, strategy=AUTO, state_path=None):
+    """
+    Ingest the data files of `path` that have a <name>.json metadata file,
+    and that aren't in `docstore` yet. By default, data files nobody can
+    write to are hard linked into the store and the others reflinked where
+    the filesystems allow it, else copied (see galaxy.util.transfer), by
+    `processes` threads. The files that have
+    been ingested are recorded in `state_path` (by default SYNC_STATE_NAME
+    in `path`), so a rerun skips the ones that haven't changed since without
+    reading them, and ingests again the ones that have. Returns the number
+    of files ingested.
+    """
+    if state_path is None:
+        state_path = os.path.join(path, SYNC_STATE_NAME)
+    state = read_sync_state(state_path)
+    pairs = list(scan_doc_pairs(path))
+    # forget the files that are gone
+    names = set( os.path.basename(data_path) for data_path, meta_path, stamp in pairs )
+    for name in list(state):
+        if name not in names:
+            del state[name]
+    try:
+        ids = sync_doc_pairs(pairs, docstore, state, uuid_set=uuid_set, filter=filter,
+            processes=processes, strategy=strategy)
+    finally:
+        write_sync_state(state_path, state)
+    return len(ids)
 
 """
         #move the output data into the datastore
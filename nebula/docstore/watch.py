@@ -0,0 +1,336 @@
+"""
+Continuous ingest of drop directories
+
+IngestDaemon watches a set of directories of data files and <name>.json
+metadata files (the layout sync_doc_dir reads) and ingests each pair as
+soon as both halves are complete, instead of waiting for the next full
+sync. Changes are picked up with inotify, through ctypes, where the kernel
+has it, and otherwise by polling the directories, which is a full listing
+every `poll_interval` seconds.
+
+A pair is complete once both of its files exist and their sizes and mtimes
+have stayed the same for `settle` seconds, so files still being written
+(or copied in) are left alone until they are done. Ingest goes through
+sync_doc_pairs, so the documents show up in the store's change log like
+any other put, and the same sync state files are kept, so the daemon and
+sync_doc_dir can be used on the same directories.
+
+A batch that fails to ingest (an unreadable file, a transfer error) is
+logged and doesn't stop the daemon: the pairs of it that weren't stored go
+back to the pending ones, to be tried again after RETRY_DELAY seconds,
+doubling with each failure up to MAX_RETRY_DELAY, and each in a batch of
+its own, so one bad pair doesn't hold up the others.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from galaxy.util.transfer import AUTO
+from nebula.docstore.util import (SYNC_STATE_NAME, META_SUFFIX, scan_doc_pairs,
+    sync_doc_pairs, read_sync_state, write_sync_state)
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+except (OSError, AttributeError, TypeError):
+    _inotify_init1 = None
+
+DEFAULT_SETTLE = 2.0
+DEFAULT_POLL_INTERVAL = 5.0
+RETRY_DELAY = 5.0
+MAX_RETRY_DELAY = 600.0
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_FORMAT = "iIII"
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+# returned by Watcher.wait in place of a name when the events of a
+# directory have been lost, and it has to be listed again
+RESCAN = None
+
+
+class InotifyWatcher(object):
+
+    def __init__(self, paths):
+        if _inotify_init1 is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.dirs = {}
+        try:
+            for path in paths:
+                wd = _inotify_add_watch(self.fd, path, WATCH_MASK)
+                if wd < 0:
+                    e = ctypes.get_errno()
+                    raise OSError(e, "%s: %s" % (path, os.strerror(e)))
+                self.dirs[wd] = path
+        except:
+            self.close()
+            raise
+
+    def wait(self, timeout):
+        """
+        The (directory, name) pairs changed, waiting up to `timeout` seconds
+        for the first one
+        """
+        out = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return out
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return out
+            raise
+        pos = 0
+        while pos + EVENT_SIZE <= len(data):
+            wd, mask, cookie, length = struct.unpack(EVENT_FORMAT, data[pos:pos + EVENT_SIZE])
+            name = data[pos + EVENT_SIZE:pos + EVENT_SIZE + length].rstrip("\0")
+            pos += EVENT_SIZE + length
+            if mask & IN_Q_OVERFLOW:
+                out.update( (path, RESCAN) for path in self.dirs.values() )
+            elif wd in self.dirs and name:
+                out.add( (self.dirs[wd], name) )
+        return out
+
+    def close(self):
+        if self.fd is not None and self.fd >= 0:
+            os.close(self.fd)
+        self.fd = None
+
+
+class PollingWatcher(object):
+    """
+    Finds changes by listing the directories every `interval` seconds
+    """
+
+    def __init__(self, paths, interval=DEFAULT_POLL_INTERVAL):
+        self.interval = interval
+        self.listings = dict( (path, self._list(path)) for path in paths )
+
+    def _list(self, path):
+        out = {}
+        for name in os.listdir(path):
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            out[name] = (st.st_size, st.st_mtime)
+        return out
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        out = set()
+        for path, old in self.listings.items():
+            new = self._list(path)
+            for name in set(old) | set(new):
+                if old.get(name, None) != new.get(name, None):
+                    out.add( (path, name) )
+            self.listings[path] = new
+        return out
+
+    def close(self):
+        pass
+
+
+def open_watcher(paths, method=None, poll_interval=DEFAULT_POLL_INTERVAL):
+    """
+    An InotifyWatcher if `method` is 'inotify' or None and inotify works
+    here, else a PollingWatcher
+    """
+    if method in [None, "inotify"]:
+        try:
+            return InotifyWatcher(paths)
+        except OSError, e:
+            if method == "inotify":
+                raise
+            logging.warning("Falling back to polling for changes: %s" % (e))
+    return PollingWatcher(paths, poll_interval)
+
+
+def _pair(path, data_name):
+    """
+    The (data path, metadata path, stamp) of a pair, or None if one of the
+    two files is missing
+    """
+    data_path = os.path.join(path, data_name)
+    meta_path = data_path + META_SUFFIX
+    try:
+        meta_st = os.stat(meta_path)
+        data_st = os.stat(data_path)
+    except OSError:
+        return None
+    return data_path, meta_path, [meta_st.st_size, meta_st.st_mtime, data_st.st_size, data_st.st_mtime]
+
+
+class IngestDaemon(object):
+
+    def __init__(self, docstore, paths, settle=DEFAULT_SETTLE, poll_interval=DEFAULT_POLL_INTERVAL,
+        method=None, processes=4, strategy=AUTO, uuid_set=None, filter=None, on_ingest=None):
+        self.docstore = docstore
+        self.paths = list( os.path.abspath(p) for p in paths )
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.method = method
+        self.sync_args = {"processes" : processes, "strategy" : strategy, "uuid_set" : uuid_set, "filter" : filter}
+        self.on_ingest = on_ingest
+        self.states = dict( (p, read_sync_state(os.path.join(p, SYNC_STATE_NAME))) for p in self.paths )
+        # (directory, data name) -> (stamp, time the stamp was first seen)
+        self.pending = {}
+        # (directory, data name) -> (stamp, failed attempts at ingesting it)
+        self.failures = {}
+        self.watcher = None
+        self.running = False
+
+    def _touch(self, path, name, now):
+        if name == SYNC_STATE_NAME or name.startswith(SYNC_STATE_NAME + ".tmp"):
+            return
+        if name.endswith(META_SUFFIX):
+            name = name[:-len(META_SUFFIX)]
+        pair = _pair(path, name)
+        if pair is None:
+            # waiting for the other half
+            self.pending.pop( (path, name), None )
+            return
+        old = self.pending.get( (path, name), None )
+        if old is None or old[0] != pair[2]:
+            self.pending[(path, name)] = (pair[2], now)
+
+    def _rescan(self, path, now):
+        state = self.states[path]
+        for data_path, meta_path, stamp in scan_doc_pairs(path):
+            name = os.path.basename(data_path)
+            old = state.get(name, None)
+            if old is None or old["stamp"] != stamp:
+                self._touch(path, name, now)
+
+    def start(self):
+        """
+        Start watching, and queue the pairs that arrived while the daemon
+        wasn't running
+        """
+        self.watcher = open_watcher(self.paths, self.method, self.poll_interval)
+        now = time.time()
+        for path in self.paths:
+            self._rescan(path, now)
+
+    def ingest_ready(self, now=None):
+        """
+        Ingest the pending pairs that have settled, returning their ids
+        """
+        now = time.time() if now is None else now
+        ready = {}
+        for (path, name), (stamp, since) in self.pending.items():
+            if now - since < self.settle:
+                continue
+            pair = _pair(path, name)
+            if pair is None:
+                del self.pending[(path, name)]
+                self.failures.pop( (path, name), None )
+            elif pair[2] != stamp:
+                # still being written
+                self.pending[(path, name)] = (pair[2], now)
+            else:
+                del self.pending[(path, name)]
+                ready.setdefault(path, []).append(pair)
+        ids = []
+        for path, pairs in ready.items():
+            batches = [[]]
+            for pair in pairs:
+                if self._failed(path, pair) > 0:
+                    batches.append([pair])
+                else:
+                    batches[0].append(pair)
+            for batch in batches:
+                if len(batch):
+                    ids.extend(self._ingest(path, batch, now))
+        if len(ids):
+            logging.info("Ingested %d files" % (len(ids)))
+            if self.on_ingest is not None:
+                self.on_ingest(ids)
+        return ids
+
+    def _failed(self, path, pair):
+        """
+        How many times the current version of `pair` has failed to ingest
+        """
+        stamp, count = self.failures.get( (path, os.path.basename(pair[0])), (None, 0) )
+        return count if stamp == pair[2] else 0
+
+    def _ingest(self, path, pairs, now):
+        state = self.states[path]
+        try:
+            return sync_doc_pairs(pairs, self.docstore, state, **self.sync_args)
+        except Exception:
+            logging.exception("Failed to ingest %d files from %s" % (len(pairs), path))
+            for pair in pairs:
+                name = os.path.basename(pair[0])
+                if name in state and state[name]["stamp"] == pair[2]:
+                    continue
+                count = self._failed(path, pair) + 1
+                self.failures[(path, name)] = (pair[2], count)
+                delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (count - 1))
+                # settles again `delay` seconds from now
+                self.pending[(path, name)] = (pair[2], now + delay - self.settle)
+            return []
+        finally:
+            write_sync_state(os.path.join(path, SYNC_STATE_NAME), state)
+            for pair in pairs:
+                name = os.path.basename(pair[0])
+                if name in state and state[name]["stamp"] == pair[2]:
+                    self.failures.pop( (path, name), None )
+
+    def run_once(self, timeout=None):
+        """
+        Wait for changes (up to `timeout` seconds, or until the next pending
+        pair settles) and ingest whatever is ready
+        """
+        if self.watcher is None:
+            self.start()
+        if timeout is None:
+            timeout = self.poll_interval
+        now = time.time()
+        for stamp, since in self.pending.values():
+            timeout = min(timeout, max(0, since + self.settle - now))
+        for path, name in self.watcher.wait(timeout):
+            if name is RESCAN:
+                self._rescan(path, time.time())
+            else:
+                self._touch(path, name, time.time())
+        return self.ingest_ready()
+
+    def run(self):
+        self.running = True
+        try:
+            while self.running:
+                self.run_once()
+        finally:
+            self.close()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
@@ -87,10 +87,9 @@ class Service(Thread):
                 logging.info("Status check %s %s" % (status, i))
                 if status in ['ok'] and i.job_id not in collected:
                     logging.info("Collecting outputs of %s" % (i.job_id))
-                    meta_collect_count = 0
-                    for name, dataset in i.get_outputs(all=True).items():
-                        self.store_meta(dataset, self.docstore)
-                        meta_collect_count += 1
+                    outputs = i.get_outputs(all=True).values()
+                    self.store_meta_many(outputs, self.docstore)
+                    meta_collect_count = len(outputs)
                     #only store data for non-hiddent results
                     data_collect_count = 0
                     for name, dataset in i.get_outputs().items():
@@ -100,8 +99,7 @@ class Service(Thread):
                     logging.info("Collected: %d meta %d data" % (meta_collect_count, data_collect_count))
                 if status in ['error'] and i.job_id not in collected:
                     logging.info("Collecting error output of %s" % (i.job_id))
-                    for name, dataset in i.get_outputs(all=True).items():
-                        self.store_meta(dataset, self.docstore)
+                    self.store_meta_many(i.get_outputs(all=True).values(), self.docstore)
                     collected.append(i.job_id)
                 if status not in ['ok', 'error', 'unknown']:
                     waiting = True
@@ -137,6 +135,10 @@ class Service(Thread):
     def store_meta(self, data, object_store):
         raise NotImplementedException()
 
+    def store_meta_many(self, data_list, object_store):
+        for data in data_list:
+            self.store_meta(data, object_store)
+
 
 class ServiceConfig:
     def __init__(self, **kwds):
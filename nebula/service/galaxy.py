@@ -10,6 +10,9 @@ from nebula.target import Target
 from nebula.warpdrive import run_up, run_add, run_down
 from nebula.galaxy import GalaxyWorkflow
 
+#seconds the cached inputs of a job are kept, should it never finish
+PIN_LEASE = 7 * 24 * 3600
+
 class HDATarget(Target):
     def __init__(self, meta):
         self.meta = meta
@@ -56,6 +59,8 @@ class GalaxyService(Service):
         self.docstore = docstore
         self.rg = None
         self.ready = False
+        #cached inputs of the running jobs, kept from being evicted
+        self.pinned = {}
 
     def to_dict(self):
         return {
@@ -76,6 +81,15 @@ class GalaxyService(Service):
     def is_ready(self):
         return self.ready
 
+    def run(self):
+        try:
+            super(GalaxyService, self).run()
+        finally:
+            #the jobs still running won't be finished by this service
+            with self.queue_lock:
+                for job_id in list(self.pinned):
+                    self._unpin_inputs(job_id)
+
     def runService(self):
         #FIXME: the 'file_path' value is specific to the DiskObjectStore
         docstore_path = self.docstore.file_path
@@ -100,6 +114,8 @@ class GalaxyService(Service):
                     job_id, job = req
                     wids = []
                     for k, v in job.get_inputs().items():
+                        self.docstore.pin(Target(v.id), lease=PIN_LEASE)
+                        self.pinned.setdefault(job_id, []).append(Target(v.id))
                         file_path = self.docstore.get_filename(Target(v.id))
                         file_meta = self.docstore.get(v.id)
                         file_name = v.id
@@ -167,6 +183,7 @@ class GalaxyService(Service):
             if self.rg is not None:
                 job = self.get_job(job_id)
                 if job.state == 'error':
+                    self._unpin_inputs(job_id)
                     return "error"
                 ready = True
                 for outputname, data in job.get_outputs(all=True).items():
@@ -177,10 +194,17 @@ class GalaxyService(Service):
                         ready = False
                 if ready:
                     job.state = "ok"
+                if job.state in ["ok", "error"]:
+                    self._unpin_inputs(job_id)
                 return job.state
             return "waiting"
         return s
 
+    def _unpin_inputs(self, job_id):
+        with self.queue_lock:
+            for t in self.pinned.pop(job_id, []):
+                self.docstore.unpin(t)
+
     def store_data(self, object, doc_store):
         meta = self.rg.get_dataset(object['id'], object['src'])
         meta['id'] = meta['uuid'] #use the glocal id
@@ -203,6 +227,10 @@ class GalaxyService(Service):
         meta = self.get_meta(object)
         doc_store.put(meta['uuid'], meta)
 
+    def store_meta_many(self, objects, doc_store):
+        metas = list(self.get_meta(o) for o in objects)
+        doc_store.put_many( (meta['uuid'], meta) for meta in metas )
+
     def get_meta(self, object):
         meta = self.rg.get_dataset(object['id'], object['src'])
         prov = self.rg.get_provenance(meta['history_id'], object['id'])
@@ -3,16 +3,28 @@
 import os
 import re
 import json
+import time
 import argparse
 import subprocess
 import shutil
 from nebula.target import Target, TargetFile
-from nebula.docstore import FileDocStore
+from nebula.docstore import from_url
+from nebula.docstore.project import get_path
+from nebula.docstore import codec
+from nebula.docstore.archive import export_archive, import_archive
+from nebula.docstore.columns import export_columns
+from nebula.docstore.watch import IngestDaemon
+from galaxy.util.transfer import AUTO, STRATEGIES
+
+# -f field=value matches the string value, the other operators take JSON
+# values (ie -f 'job.exit_code!=0' -f 'file_size>1e9' -f 'tags~=rna')
+FILTER_RE = re.compile(r'^([^!<>=^~]+)(!=|>=|<=|\^=|~=|>|<|=)(.*)$')
+FILTER_OPS = {"!=" : "$ne", ">" : "$gt", ">=" : "$gte", "<" : "$lt", "<=" : "$lte", "^=" : "$prefix", "~=" : "$contains"}
 
 def run_copy(docstore, out_docstore):
-    doc = FileDocStore(file_path=docstore)
+    doc = from_url(docstore)
 
-    out_doc = FileDocStore(file_path=out_docstore)
+    out_doc = from_url(out_docstore)
 
     for id, entry in doc.filter():
         if out_doc.get(id) is None:
@@ -30,10 +42,34 @@ def run_copy(docstore, out_docstore):
                 print "mismatch", id
 
 
-def run_errors(docstore):
-    doc = FileDocStore(file_path=docstore)
+def run_export(docstore, archive, processes=4, compression="zlib"):
+    doc = from_url(docstore)
+    count = export_archive(doc, archive, processes=processes, compression=compression)
+    print "Exported %d documents" % (count)
 
-    for id, entry in doc.filter():
+def run_import(docstore, archive, processes=4, state=None):
+    doc = from_url(docstore)
+    count = import_archive(archive, doc, processes=processes, state_path=state)
+    print "Imported %d documents" % (count)
+
+def run_export_columns(docstore, output, fields, format="csv", processes=None, full=False):
+    doc = from_url(docstore)
+    count = export_columns(doc, output, fields, format=format, processes=processes, refresh=not full)
+    print "Wrote %d documents" % (count)
+
+def run_watch(docstore, dirs, settle=2.0, poll_interval=5.0, method=None, processes=4, strategy=AUTO):
+    doc = from_url(docstore)
+    daemon = IngestDaemon(doc, dirs, settle=settle, poll_interval=poll_interval,
+        method=method, processes=processes, strategy=strategy)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+
+def run_errors(docstore, processes=None):
+    doc = from_url(docstore)
+
+    for id, entry in doc.filter(processes=processes, ordered=False, state='error'):
         if entry.get('state', '') == 'error':
             print "Dataset", id, entry.get("tags", "")
             if 'provenance' in entry:
@@ -45,33 +81,50 @@ def run_errors(docstore):
             print "-=-=-=-=-=-=-"
 
 
-def run_ls(docstore, size=False, extra=[]):
-    doc = FileDocStore(file_path=docstore)
+def run_ls(docstore, size=False, extra=[], processes=None):
+    doc = from_url(docstore)
 
-    for id, entry in doc.filter():
+    for id, entry in doc.filter(processes=processes):
         #if doc.size(entry) > 0:
             extra = []
             for e in args.extra:
                 extra.append( str(entry.get(e,"")) )
             if size:
-                print id, entry.get('name', id), doc.size(entry), " ".join(extra)
+                #the size recorded when the file was stored saves a stat
+                file_size = entry.get('file_size', None)
+                if file_size is None:
+                    file_size = doc.size(entry)
+                print id, entry.get('name', id), file_size, " ".join(extra)
             else:
                 print id, entry.get('name', id), " ".join(extra)
 
-def run_query(docstore, fields, size, filters):
-    doc = FileDocStore(file_path=docstore)
+def run_query(docstore, fields, size, filters, processes=None):
+    doc = from_url(docstore)
 
     filter = {}
     for k in filters:
-        tmp=k.split("=")
-        filter[tmp[0]] = tmp[1]
+        m = FILTER_RE.match(k)
+        if m is None:
+            raise Exception("Can't parse filter %s" % (k))
+        field, op, value = m.groups()
+        if op == "=":
+            filter[field] = value
+        else:
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+            filter.setdefault(field, {})[FILTER_OPS[op]] = value
 
-    for id, entry in doc.filter(**filter):
+    if fields is None or len(fields) == 0:
+        fields = None
 
-        if fields is None or len(fields) == 0:
+    for id, entry in doc.filter(processes=processes, fields=fields, query=filter):
+
+        if fields is None:
             line = entry
         else:
-            line = dict( (i, entry.get(i, "")) for i in fields )
+            line = dict( (i, get_path(entry, i, "")) for i in fields )
 
         if size:
             size_value = doc.size(Target(uuid=entry['uuid']))
@@ -81,13 +134,86 @@ def run_query(docstore, fields, size, filters):
         print size_value, json.dumps(line)
 
 def run_get(docstore, uuid, outpath):
-    doc = FileDocStore(file_path=docstore)
+    doc = from_url(docstore)
     print doc.get_filename(Target(uuid=uuid))
 
 
-def run_timing(docstore):
-    doc = FileDocStore(file_path=docstore)
-    for id, entry in doc.filter():
+def run_index(docstore, fields, drop, rebuild):
+    doc = from_url(docstore)
+    for field in fields:
+        if drop:
+            doc.drop_index(field)
+        elif field not in doc.list_indexes():
+            doc.create_index(field)
+    if rebuild:
+        doc.rebuild_indexes()
+    print " ".join(doc.list_indexes())
+
+def run_migrate(docstore, storage):
+    doc = from_url(docstore)
+    doc.migrate_storage(storage)
+
+def run_reshard(docstore, depth, width):
+    doc = from_url(docstore)
+    moved = doc.reshard(depth, width)
+    print "Moved %d entries" % (moved)
+
+def run_bloom(docstore, create, drop, capacity=None, error_rate=0.01):
+    doc = from_url(docstore)
+    if drop:
+        doc.drop_bloom()
+        return
+    if create:
+        if not doc.create_bloom(capacity=capacity, error_rate=error_rate):
+            raise Exception("%s doesn't keep Bloom filters" % (docstore))
+    for name, stats in sorted(doc.bloom_stats().items()):
+        print name, json.dumps(stats, sort_keys=True)
+
+def run_lineage(docstore, uuid, descendants=False, depth=None, create=False):
+    doc = from_url(docstore)
+    if create:
+        doc.create_lineage()
+    if uuid is None:
+        return
+    if descendants:
+        ids = doc.descendants(uuid, max_depth=depth)
+    else:
+        ids = doc.ancestors(uuid, max_depth=depth)
+    for id in sorted(ids):
+        print id
+
+def run_compact(docstore):
+    doc = from_url(docstore)
+    doc.compact()
+
+def run_aggregate(docstore, group_by, metrics, declare, drop, processes=None):
+    doc = from_url(docstore)
+    if not metrics:
+        metrics = ["count"]
+    if drop:
+        doc.drop_aggregate(group_by, metrics)
+        return
+    if declare:
+        doc.create_aggregate(group_by, metrics)
+    out = doc.aggregate(group_by, metrics, processes=processes)
+    for group, values in sorted(out.items()):
+        print json.dumps(group), json.dumps(values, sort_keys=True)
+
+def run_changes(docstore, since=0, follow=False):
+    doc = from_url(docstore)
+    changes = list(doc.changes(since))
+    while True:
+        for seq, op, id in changes:
+            print seq, op, id
+        if not follow:
+            break
+        if len(changes):
+            since = changes[-1][0]
+        changes = doc.wait_for_changes(since, timeout=60)
+
+def run_timing(docstore, processes=None):
+    doc = from_url(docstore)
+    for id, entry in doc.filter(processes=processes, ordered=False):
         if 'job' in entry and 'job_metrics' in entry['job']:
             timing = None
             for met in entry['job']['job_metrics']:
@@ -96,6 +222,34 @@ def run_timing(docstore):
             if timing is not None:
                 print id, entry["name"], timing
 
+def run_codecs(docstore, count=1000, rounds=5):
+    """
+    Time encoding and decoding a sample of the store's documents with each
+    of the available codecs
+    """
+    doc = from_url(docstore)
+    docs = []
+    for id, entry in doc.filter(ordered=False):
+        docs.append(entry.copy())
+        if len(docs) >= count:
+            break
+    codecs = list( (name, codec.get_codec(name)) for name in codec.available_codecs() )
+    print "%d documents, best of %d rounds" % (len(docs), rounds)
+    print "%-20s %12s %12s %12s" % ("codec", "bytes", "dumps ms", "loads ms")
+    for name, c in codecs:
+        dump_time = load_time = None
+        for i in range(rounds):
+            start = time.time()
+            data = list( c.dumps(a) for a in docs )
+            elapsed = time.time() - start
+            dump_time = elapsed if dump_time is None else min(dump_time, elapsed)
+            start = time.time()
+            for a in data:
+                c.loads(a)
+            elapsed = time.time() - start
+            load_time = elapsed if load_time is None else min(load_time, elapsed)
+        print "%-20s %12d %12.1f %12.1f" % (name, sum(len(a) for a in data), dump_time * 1000, load_time * 1000)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--docstore", help="DocStore", required=True)
@@ -105,21 +259,116 @@ if __name__ == "__main__":
     parser_query.set_defaults(func=run_copy)
     parser_query.add_argument("out_docstore", help="DocStore")
 
+    parser_export = subparsers.add_parser('export',
+        help="write the docstore to an archive directory, rerun to resume")
+    parser_export.set_defaults(func=run_export)
+    parser_export.add_argument("-p", "--processes", type=int, default=4)
+    parser_export.add_argument("-c", "--compression", choices=["zlib", "none"], default="zlib")
+    parser_export.add_argument("archive")
+
+    parser_import = subparsers.add_parser('import',
+        help="load an archive directory into the docstore, rerun to resume")
+    parser_import.set_defaults(func=run_import)
+    parser_import.add_argument("-p", "--processes", type=int, default=4)
+    parser_import.add_argument("--state", default=None, help="import progress file")
+    parser_import.add_argument("archive")
+
+    parser_columns = subparsers.add_parser('export-columns',
+        help="write document fields to a csv or npz table, refreshing an earlier export")
+    parser_columns.set_defaults(func=run_export_columns)
+    parser_columns.add_argument("-p", "--processes", type=int, default=None)
+    parser_columns.add_argument("-o", "--output", required=True)
+    parser_columns.add_argument("--format", choices=["csv", "npz"], default="csv")
+    parser_columns.add_argument("--full", action="store_true", default=False,
+        help="rewrite the table from a full scan rather than refreshing it")
+    parser_columns.add_argument("fields", nargs="+")
+
+    parser_watch = subparsers.add_parser('watch',
+        help="ingest data/metadata pairs from directories as they arrive")
+    parser_watch.set_defaults(func=run_watch)
+    parser_watch.add_argument("-p", "--processes", type=int, default=4)
+    parser_watch.add_argument("--settle", type=float, default=2.0,
+        help="seconds a pair has to stay unchanged before it is ingested")
+    parser_watch.add_argument("--poll-interval", type=float, default=5.0)
+    parser_watch.add_argument("--method", choices=["inotify", "poll"], default=None)
+    parser_watch.add_argument("--strategy", choices=[AUTO] + STRATEGIES, default=AUTO,
+        help="how data files are moved into the store, by default sources that can be written to are not linked")
+    parser_watch.add_argument("dirs", nargs="+")
+
     parser_query = subparsers.add_parser('errors')
+    parser_query.add_argument("-p", "--processes", type=int, default=None)
     parser_query.set_defaults(func=run_errors)
 
     parser_ls = subparsers.add_parser('ls')
+    parser_ls.add_argument("-p", "--processes", type=int, default=None)
     parser_ls.add_argument("-s", "--size", action="store_true", default=False)
     parser_ls.add_argument("-e", "--extra", action="append", default=[])
     parser_ls.set_defaults(func=run_ls)
 
     parser_query = subparsers.add_parser('query')
+    parser_query.add_argument("-p", "--processes", type=int, default=None)
     parser_query.set_defaults(func=run_query)
     parser_query.add_argument("--size", action="store_true", default=False)
     parser_query.add_argument("-f", "--filter", dest="filters", action="append", default=[])
     parser_query.add_argument("fields", nargs="*", default=None)
 
+    parser_index = subparsers.add_parser('index')
+    parser_index.set_defaults(func=run_index)
+    parser_index.add_argument("--drop", action="store_true", default=False)
+    parser_index.add_argument("--rebuild", action="store_true", default=False)
+    parser_index.add_argument("fields", nargs="*", default=[])
+
+    parser_migrate = subparsers.add_parser('migrate')
+    parser_migrate.set_defaults(func=run_migrate)
+    parser_migrate.add_argument("storage", choices=["files", "segment"])
+
+    parser_reshard = subparsers.add_parser('reshard')
+    parser_reshard.set_defaults(func=run_reshard)
+    parser_reshard.add_argument("--depth", type=int, default=2)
+    parser_reshard.add_argument("--width", type=int, default=2)
+
+    parser_bloom = subparsers.add_parser('bloom')
+    parser_bloom.set_defaults(func=run_bloom)
+    parser_bloom.add_argument("--create", action="store_true", default=False,
+        help="build the filters, or rebuild them from a scan")
+    parser_bloom.add_argument("--drop", action="store_true", default=False)
+    parser_bloom.add_argument("--capacity", type=int, default=None)
+    parser_bloom.add_argument("--error-rate", dest="error_rate", type=float, default=0.01)
+
+    parser_lineage = subparsers.add_parser('lineage')
+    parser_lineage.set_defaults(func=run_lineage)
+    parser_lineage.add_argument("--create", action="store_true", default=False,
+        help="build the lineage index from the stored provenance")
+    parser_lineage.add_argument("--descendants", action="store_true", default=False,
+        help="list the datasets derived from uuid, rather than its ancestors")
+    parser_lineage.add_argument("--depth", type=int, default=None)
+    parser_lineage.add_argument("uuid", nargs="?", default=None)
+
+    parser_compact = subparsers.add_parser('compact')
+    parser_compact.set_defaults(func=run_compact)
+
+    parser_aggregate = subparsers.add_parser('aggregate')
+    parser_aggregate.set_defaults(func=run_aggregate)
+    parser_aggregate.add_argument("-p", "--processes", type=int, default=None)
+    parser_aggregate.add_argument("-g", "--group-by", dest="group_by", action="append", default=[])
+    parser_aggregate.add_argument("-m", "--metric", dest="metrics", action="append", default=[],
+        help="count, sum:<field> or hist:<field>")
+    parser_aggregate.add_argument("--declare", action="store_true", default=False,
+        help="maintain the aggregate from now on")
+    parser_aggregate.add_argument("--drop", action="store_true", default=False)
+
+    parser_changes = subparsers.add_parser('changes')
+    parser_changes.set_defaults(func=run_changes)
+    parser_changes.add_argument("-s", "--since", type=int, default=0)
+    parser_changes.add_argument("-f", "--follow", action="store_true", default=False)
+
+    parser_codecs = subparsers.add_parser('codecs')
+    parser_codecs.set_defaults(func=run_codecs)
+    parser_codecs.add_argument("-n", "--count", type=int, default=1000)
+    parser_codecs.add_argument("-r", "--rounds", type=int, default=5)
+
     parser_timing = subparsers.add_parser('timing')
+    parser_timing.add_argument("-p", "--processes", type=int, default=None)
     parser_timing.set_defaults(func=run_timing)
 
     args = parser.parse_args()
@@ -0,0 +1,253 @@
+
+import unittest
+
+import os
+import uuid
+import stat
+import time
+import shutil
+import threading
+import nebula.docstore
+import galaxy.objectstore.local_cache
+import galaxy.util.transfer
+from nebula.target import Target
+from galaxy.objectstore.cache_index import CacheIndex
+from galaxy.util.transfer import transfer_file, transfer_stats
+
+def get_abspath(path):
+    return os.path.join(os.path.dirname(__file__), path)
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        if not os.path.exists(get_abspath("../test_tmp")):
+            os.mkdir(get_abspath("../test_tmp"))
+
+    def tearDown(self):
+        for a in ["../test_tmp/docstore", "../test_tmp/cache_1", "../test_tmp/cache_2"]:
+            if os.path.exists(get_abspath(a)):
+                shutil.rmtree(get_abspath(a))
+
+    def make_store(self, cache_path="../test_tmp/cache_1", cache_size=None):
+        return nebula.docstore.FileDocStore(get_abspath("../test_tmp/docstore"),
+            cache_path=get_abspath(cache_path), cache_size=cache_size)
+
+    def add_objects(self, docstore, count, size):
+        out = []
+        src = get_abspath("../test_tmp/docstore/src.dat")
+        for i in range(count):
+            t = Target(str(uuid.uuid4()))
+            with open(src, "w") as handle:
+                handle.write("x" * size)
+            docstore.update_from_file(t, src, create=True)
+            out.append(t)
+        return out
+
+    def testEviction(self):
+        docstore = self.make_store(cache_size=2500)
+        targets = self.add_objects(docstore, 5, 1000)
+        paths = list( docstore.get_filename(t) for t in targets[:3] )
+        #the least recently used copy went to make room for the third
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[2]))
+        docstore.get_filename(targets[1])
+        docstore.pin(targets[2])
+        docstore.get_filename(targets[3])
+        docstore.get_filename(targets[4])
+        #the pinned copy stays, even though it is the oldest
+        self.assertTrue(os.path.exists(paths[2]))
+        self.assertFalse(os.path.exists(paths[1]))
+        stats = docstore.object_cache_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 5)
+        self.assertEqual(stats['evictions'], 3)
+        self.assertEqual(stats['bytes'], 2000)
+        docstore.unpin(targets[2])
+
+        #the access order survives a restart, and is shared between processes
+        docstore = self.make_store(cache_size=2500)
+        self.assertEqual(docstore.object_cache_stats()['entries'], 2)
+        docstore.get_filename(targets[0])
+        self.assertFalse(os.path.exists(paths[2]))
+        self.assertTrue(os.path.exists(docstore.get_filename(targets[4])))
+        self.assertEqual(docstore.object_cache_stats()['hits'], 1)
+
+    def testSharedPins(self):
+        path = get_abspath("../test_tmp/cache_1")
+        os.makedirs(os.path.join(path, "00"))
+        index = CacheIndex(path, max_bytes=2500)
+        other = CacheIndex(path, max_bytes=2500)
+        def add(name):
+            with open(os.path.join(path, name), "w") as handle:
+                handle.write("x" * 1000)
+            index.add(name, 1000)
+        add("00/a")
+        add("00/b")
+        #a file pinned by another process isn't evicted
+        other.pin("00/a")
+        other.pin("00/a")
+        add("00/c")
+        self.assertEqual(sorted(os.listdir(os.path.join(path, "00"))), ["a", "a.pin", "c"])
+        other.unpin("00/a")
+        add("00/d")
+        self.assertTrue(os.path.exists(os.path.join(path, "00/a")))
+        self.assertFalse(os.path.exists(os.path.join(path, "00/c")))
+        other.unpin("00/a")
+        self.assertFalse(os.path.exists(os.path.join(path, "00/a.pin")))
+        add("00/e")
+        self.assertEqual(sorted(os.listdir(os.path.join(path, "00"))), ["d", "e"])
+        self.assertEqual(index.reconcile(), 0)
+
+    def testPinLeases(self):
+        path = get_abspath("../test_tmp/cache_1")
+        os.makedirs(os.path.join(path, "00"))
+        index = CacheIndex(path, max_bytes=10000)
+        other = CacheIndex(path, max_bytes=10000)
+        for name in ["a", "b", "c", "d"]:
+            with open(os.path.join(path, "00", name), "w") as handle:
+                handle.write("x" * 1000)
+            index.add("00/" + name, 1000)
+        #a pin whose lease has run out is dropped by reconcile
+        other.pin("00/a", lease=0)
+        other.pin("00/b", lease=0)
+        other.pin("00/b")
+        other.pin("00/c", lease=3600)
+        other.reconcile()
+        self.assertEqual(sorted(other.pins.keys()), ["00/b", "00/c"])
+        self.assertFalse(os.path.exists(os.path.join(path, "00/a.pin")))
+        #and by evict
+        index.pin("00/d", lease=0)
+        index.max_bytes = 1000
+        self.assertEqual(index.evict(), ["00/a", "00/d"])
+        self.assertEqual(index.stats()["pinned"], 0)
+
+    def testHits(self):
+        path = get_abspath("../test_tmp/cache_1")
+        os.mkdir(path)
+        index = CacheIndex(path)
+        for i in range(8):
+            index.add("file_%d" % (i), 10)
+        size = os.path.getsize(index.path)
+        #hits on the most recently used files don't move them far enough
+        #to be written down
+        for i in range(5):
+            index.hit("file_7")
+            index.hit("file_6")
+        self.assertEqual(os.path.getsize(index.path), size)
+        self.assertEqual(index.stats()["hits"], 10)
+        index.hit("file_0")
+        self.assertTrue(os.path.getsize(index.path) > size)
+        self.assertEqual(list(CacheIndex(path).entries)[-1], "file_0")
+
+    def testCompaction(self):
+        os.mkdir(get_abspath("../test_tmp/cache_1"))
+        index = CacheIndex(get_abspath("../test_tmp/cache_1"))
+        other = CacheIndex(get_abspath("../test_tmp/cache_1"))
+        for i in range(3000):
+            index.add("file_%d" % (i % 10), i)
+        other.add("file_x", 5)
+        with open(index.path) as handle:
+            self.assertTrue(len(handle.readlines()) < 1000)
+        expected = list( "file_%d" % (i) for i in range(10) ) + ["file_x"]
+        self.assertEqual(index.stats()['entries'], 11)
+        self.assertEqual(list(index.entries), expected)
+        self.assertEqual(other.stats()['bytes'], index.stats()['bytes'])
+        self.assertEqual(list(other.entries), expected)
+        self.assertEqual(CacheIndex(get_abspath("../test_tmp/cache_1")).entries, index.entries)
+
+    def testTransfer(self):
+        docstore = self.make_store()
+        src = get_abspath("../test_tmp/docstore/src.dat")
+        dst = get_abspath("../test_tmp/docstore/dst.dat")
+        with open(src, "w") as handle:
+            handle.write("0123456789" * 1000)
+        for strategy in ["copy_range", "sendfile", "copy"]:
+            transfer_file(src, dst, strategy)
+            with open(dst) as handle:
+                self.assertEqual(handle.read(), "0123456789" * 1000)
+
+        #a kernel copy that stops short falls back to the next strategy
+        #rather than leaving a truncated file
+        def short(fd_out, fd_in, count):
+            if os.lseek(fd_in, 0, os.SEEK_CUR) >= 500:
+                return 0
+            return os.write(fd_out, os.read(fd_in, 100))
+        copy_file_range, sendfile = galaxy.util.transfer._copy_file_range, galaxy.util.transfer._sendfile
+        galaxy.util.transfer._copy_file_range = lambda fd_in, off_in, fd_out, off_out, count, flags: short(fd_out, fd_in, count)
+        galaxy.util.transfer._sendfile = lambda fd_out, fd_in, offset, count: short(fd_out, fd_in, count)
+        try:
+            self.assertEqual(transfer_file(src, dst, "copy_range"), "copy")
+        finally:
+            galaxy.util.transfer._copy_file_range, galaxy.util.transfer._sendfile = copy_file_range, sendfile
+        with open(dst) as handle:
+            self.assertEqual(handle.read(), "0123456789" * 1000)
+        self.assertEqual(list(n for n in os.listdir(os.path.dirname(dst)) if ".tmp." in n), [])
+
+        #files that can be written are never shared with the copy
+        t = Target(str(uuid.uuid4()))
+        docstore.update_from_file(t, src, create=True)
+        path = docstore.objs.disk.get_filename(t)
+        self.assertNotEqual(os.stat(path).st_ino, os.stat(src).st_ino)
+        self.assertNotEqual(os.stat(docstore.get_filename(t)).st_ino, os.stat(path).st_ino)
+
+        #read only ones are linked into the store and the cache
+        os.chmod(src, 0o444)
+        before = transfer_stats().get("link", {}).get("count", 0)
+        t = Target(str(uuid.uuid4()))
+        docstore.update_from_file(t, src, create=True)
+        path = docstore.objs.disk.get_filename(t)
+        self.assertEqual(os.stat(path).st_ino, os.stat(src).st_ino)
+        self.assertEqual(os.stat(docstore.get_filename(t)).st_ino, os.stat(src).st_ino)
+        self.assertEqual(docstore.object_cache_stats()['transfers']['link']['count'], before + 2)
+
+    def testOpenPerms(self):
+        os.makedirs(get_abspath("../test_tmp/docstore"))
+        store = galaxy.objectstore.local_cache.CachedDiskObjectStore(nebula.docstore.DiskObjectStoreConfig(),
+            cache_path=get_abspath("../test_tmp/cache_1"), file_path=get_abspath("../test_tmp/docstore"), open_perms=True)
+        src = get_abspath("../test_tmp/docstore/src.dat")
+        modes = []
+        for mode in [0o644, 0o444]:
+            with open(src, "w") as handle:
+                handle.write("data")
+            os.chmod(src, mode)
+            t = Target(str(uuid.uuid4()))
+            store.update_from_file(t, src, create=True)
+            modes.append( (stat.S_IMODE(os.stat(store.get_filename(t)).st_mode),
+                stat.S_IMODE(os.stat(store.disk.get_filename(t)).st_mode)) )
+            os.unlink(src)
+        #copies are opened up, but a copy linked to the stored object
+        #leaves its mode alone
+        self.assertEqual(modes, [(0o777, 0o644), (0o444, 0o444)])
+
+    def testConcurrentFill(self):
+        docstore = self.make_store()
+        t = self.add_objects(docstore, 1, 100000)[0]
+        local_path = docstore.objs._cache_path(t)
+        os.makedirs(os.path.dirname(local_path))
+        stale = local_path + ".tmp.1.1"
+        with open(stale, "w") as handle:
+            handle.write("partial")
+        os.utime(stale, (time.time() - 3600, time.time() - 3600))
+
+        transfer_file = galaxy.objectstore.local_cache.transfer_file
+        def slow_transfer(src, dst, strategy):
+            time.sleep(0.2)
+            return transfer_file(src, dst, strategy)
+        galaxy.objectstore.local_cache.transfer_file = slow_transfer
+        try:
+            stores = list( self.make_store() for i in range(4) )
+            sizes = []
+            def read(store):
+                sizes.append(os.path.getsize(store.get_filename(t)))
+            threads = list( threading.Thread(target=read, args=(s,)) for s in stores )
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            galaxy.objectstore.local_cache.transfer_file = transfer_file
+        #one of them made the copy, the others waited for it
+        self.assertEqual(sizes, [100000] * 4)
+        self.assertEqual(sum(s.object_cache_stats()['misses'] for s in stores), 1)
+        self.assertEqual(sum(s.object_cache_stats()['hits'] for s in stores), 3)
+        self.assertEqual(os.listdir(os.path.dirname(local_path)), [os.path.basename(local_path)])
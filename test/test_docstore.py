@@ -0,0 +1,1247 @@
+
+import unittest
+
+import os
+import uuid
+import copy
+import json
+import shutil
+import logging
+import threading
+import time
+from glob import glob
+import nebula.docstore
+import nebula.docstore.query
+import nebula.docstore.index
+import nebula.docstore.bloom
+import nebula.docstore.segment
+import nebula.docstore.archive
+import nebula.docstore.columns
+import nebula.docstore.util
+from nebula.docstore.util import sync_doc_dir
+from nebula.docstore.watch import IngestDaemon
+from nebula.docstore.project import decode_fields
+from nebula.target import Target
+
+def get_abspath(path):
+    return os.path.join(os.path.dirname(__file__), path)
+
+def store_urls():
+    """
+    A FileDocStore and a SQLiteDocStore under test_tmp/docstore, for the
+    tests run against both
+    """
+    return [get_abspath("../test_tmp/docstore/file"), "sqlite://" + os.path.abspath(get_abspath("../test_tmp/docstore/sqlite"))]
+
+def make_docs(count):
+    out = []
+    for i in range(count):
+        id = str(uuid.uuid4())
+        out.append( (id, {
+            "uuid" : id,
+            "name" : "file_%d" % (i),
+            "state" : "error" if i % 3 == 0 else "ok",
+            "tags" : ["batch:%d" % (i % 2)],
+            "job" : {
+                "exit_code" : i % 3,
+                "stdout" : "line \"%d\" {[\n" % (i) * 100,
+                "stderr" : ""
+            }
+        }) )
+    return out
+
+class FileDocStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        if not os.path.exists(get_abspath("../test_tmp")):
+            os.mkdir(get_abspath("../test_tmp"))
+
+    def tearDown(self):
+        if os.path.exists(get_abspath("../test_tmp/docstore")):
+            shutil.rmtree(get_abspath("../test_tmp/docstore"))
+
+    def testIndexedFilter(self):
+        doc = nebula.docstore.FileDocStore(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(30)
+        for id, meta in docs[:15]:
+            doc.put(id, meta)
+        doc.create_index("state")
+        for id, meta in docs[15:]:
+            doc.put(id, meta)
+
+        doc = nebula.docstore.FileDocStore(get_abspath("../test_tmp/docstore"), indexes=["state", "name"])
+        self.assertEqual(doc.indexes.fields(), ["name", "state"])
+        expected = sorted(id for id, meta in docs if meta['state'] == 'error')
+        self.assertEqual(sorted(id for id, meta in doc.filter(state="error")), expected)
+        self.assertEqual(len(list(doc.filter(state=["ok", "error"]))), 30)
+        self.assertEqual(len(list(doc.filter(state="error", name="file_3"))), 1)
+
+        #changing and deleting documents should update the postings
+        id, meta = docs[0]
+        meta['state'] = 'ok'
+        doc.put(id, meta)
+        doc.delete(Target(docs[3][0]))
+        expected = sorted(set(expected) - set([id, docs[3][0]]))
+        self.assertEqual(sorted(i for i, m in doc.filter(state="error")), expected)
+
+        doc.rebuild_indexes()
+        self.assertEqual(sorted(i for i, m in doc.filter(state="error")), expected)
+
+    def testIndexedFilterEdgeCases(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(12)
+        del docs[0][1]['tags']
+        del docs[1][1]['job']
+        docs[2][1]['name'] = u"caf\xe9"
+        docs[3][1]['tags'] = []
+        indexed = nebula.docstore.FileDocStore(get_abspath("../test_tmp/docstore/indexed"),
+            indexes=["name", "tags", "job.exit_code"])
+        plain = nebula.docstore.FileDocStore(get_abspath("../test_tmp/docstore/plain"))
+        indexed.put_many(docs)
+        plain.put_many(docs)
+        #missing and nested fields, lists, unicode, numbers given as floats
+        #and values nothing has match as an unindexed scan does
+        for query in [{"name" : u"caf\xe9"}, {"name" : "nothing"}, {"name" : {"$prefix" : "file_1"}},
+            {"tags" : {"$contains" : "batch:0"}}, {"tags" : []}, {"job.exit_code" : 1}, {"job.exit_code" : 1.0},
+            {"job.exit_code" : [0, 2]}, {"job.exit_code" : {"$gte" : 1}},
+            {"name" : {"$in" : ["file_4", "file_5"]}, "job.exit_code" : 2}]:
+            self.assertEqual(sorted(id for id, meta in indexed.filter(query=query)),
+                sorted(id for id, meta in plain.filter(query=query)), query)
+        self.assertEqual(len(list(indexed.filter(query={"name" : u"caf\xe9"}))), 1)
+
+    def testIndexPostings(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        doc = nebula.docstore.FileDocStore(get_abspath("../test_tmp/docstore/indexed"), indexes=["state"])
+        docs = make_docs(4)
+        doc.put_many(docs)
+        id, meta = docs[0]
+        index = doc.indexes.indexes["state"]
+
+        #a crash before the document is written leaves an extra posting,
+        #one after it leaves the old one, neither loses the document
+        def crash(*args, **kwds):
+            raise IOError("crash")
+        for step, target in [("blooms", "add"), ("self", "_invalidate")]:
+            obj = doc if step == "self" else doc.blooms
+            setattr(obj, target, crash)
+            meta['state'] = "crash_" + target
+            self.assertRaises(IOError, doc.put, id, meta)
+            delattr(obj, target)
+        self.assertEqual(list(i for i, m in doc.filter(query={"state" : "crash_add"})), [])
+        self.assertEqual(list(i for i, m in doc.filter(query={"state" : "crash__invalidate"})), [id])
+        self.assertIn(id, index.lookup("crash_add"))
+
+        #postings that are mostly dead entries are compacted when read,
+        #and dropped along with their value once they are empty
+        old_dead = nebula.docstore.index.COMPACT_DEAD
+        nebula.docstore.index.COMPACT_DEAD = 4
+        try:
+            for i in range(6):
+                for state in ["running", "queued"]:
+                    meta['state'] = state
+                    doc.put(id, meta)
+            path = index._posting_path("=" + nebula.docstore.index.index_key("running"))
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(index.lookup("running"), set())
+            self.assertFalse(os.path.exists(path))
+            self.assertNotIn("running", list(v for k, v in index.values()))
+            for i in range(6):
+                for state in ["ok", "queued"]:
+                    docs[1][1]['state'] = state
+                    doc.put(docs[1][0], docs[1][1])
+            path = index._posting_path("=" + nebula.docstore.index.index_key("ok"))
+            self.assertEqual(index.lookup("ok"), set([docs[2][0]]))
+            with open(path) as handle:
+                self.assertEqual(len(handle.readlines()), 2)
+            meta['state'] = "running"
+            doc.put(id, meta)
+            self.assertEqual(list(i for i, m in doc.filter(query={"state" : "running"})), [id])
+        finally:
+            nebula.docstore.index.COMPACT_DEAD = old_dead
+
+    def testSegmentStorage(self):
+        path = get_abspath("../test_tmp/docstore")
+        doc = nebula.docstore.FileDocStore(path)
+        docs = make_docs(40)
+        doc.put_many(docs[:20])
+        doc.migrate_storage("segment")
+        self.assertEqual(len(doc._doclist()), 0)
+        for id, meta in docs[20:30]:
+            doc.put(id, meta)
+        doc.put_many(docs[30:])
+
+        #a second handle on the store sees the appends of the first
+        other = nebula.docstore.FileDocStore(path, indexes=["state"])
+        self.assertEqual(other.storage, "segment")
+        self.assertEqual(other.get(docs[35][0])['name'], "file_35")
+        for id, meta in docs[:10]:
+            meta['state'] = "deleted"
+            doc.put(id, meta)
+        doc.delete(Target(docs[10][0]))
+        self.assertIsNone(other.get(docs[10][0]))
+        self.assertEqual(len(list(other.filter())), 39)
+        self.assertEqual(len(list(other.filter(state="deleted"))), 10)
+        self.assertTrue(doc.segments.garbage_ratio() > 0)
+
+        doc.compact()
+        self.assertEqual(doc.segments.garbage_ratio(), 0)
+        self.assertEqual(other.get(docs[0][0])['state'], "deleted")
+        self.assertEqual(len(list(other.filter(state="deleted"))), 10)
+        doc.put(docs[10][0], docs[10][1])
+        doc.shutdown()
+
+        doc = nebula.docstore.FileDocStore(path)
+        self.assertEqual(len(list(doc.filter())), 40)
+        doc.migrate_storage("files")
+        doc = nebula.docstore.FileDocStore(path)
+        self.assertEqual(doc.storage, "files")
+        self.assertEqual(len(doc._doclist()), 40)
+
+    def testSegmentCompaction(self):
+        path = get_abspath("../test_tmp/docstore")
+        segment = nebula.docstore.segment
+        old_base = segment.TIER_BASE
+        segment.TIER_BASE = 1000
+        try:
+            store = segment.SegmentStore(path, max_segment_size=2000)
+            #a large first segment, that the small ones are merged without
+            data = dict( ("id%03d" % i, "x" * 200 + str(i)) for i in range(50) )
+            store.put_many(sorted(data.items()))
+            for i in range(50, 160):
+                data["id%03d" % i] = "x" * 200 + str(i)
+                store.put("id%03d" % i, data["id%03d" % i])
+                if i in (100, 140):
+                    for j in range(i - 95, i - 85):
+                        store.delete("id%03d" % j)
+                        del data["id%03d" % j]
+            for j in range(0, 160, 7):
+                if "id%03d" % j in data:
+                    data["id%03d" % j] += "updated"
+                    store.put("id%03d" % j, data["id%03d" % j])
+            count = len(store.segments)
+            self.assertTrue(count > segment.MERGE_MAX)
+
+            #a scan that loses its segments to a compaction elsewhere
+            #carries on from the merged ones
+            scan = store.scan()
+            first = [scan.next()]
+            other = segment.SegmentStore(path, max_segment_size=2000)
+            merged = other.compact()
+            self.assertTrue(0 < merged <= segment.MERGE_MAX)
+            rest = list(scan)
+            self.assertEqual(sorted(i for i, d in first + rest), sorted(data.keys()))
+
+            #each merge takes a bounded number of segments, and tombstones
+            #outlive the records they delete, whether the store is opened
+            #from the snapshot or replayed
+            while True:
+                for snapshot in [True, False]:
+                    if not snapshot:
+                        os.unlink(os.path.join(path, segment.SNAPSHOT_NAME))
+                    reader = segment.SegmentStore(path)
+                    self.assertEqual(dict(reader.scan()), data)
+                    self.assertEqual(reader.get("id010"), None)
+                    self.assertEqual(reader.get("id000"), data["id000"])
+                    reader.save_snapshot()
+                if not merged:
+                    break
+                merged = other.compact(threshold=0)
+                self.assertTrue(merged <= segment.MERGE_MAX)
+            self.assertTrue(len(other.segments) < count)
+            self.assertEqual(dict(store.scan()), data)
+        finally:
+            segment.TIER_BASE = old_base
+
+    def testParallelFilter(self):
+        path = get_abspath("../test_tmp/docstore")
+        doc = nebula.docstore.FileDocStore(path)
+        docs = make_docs(60)
+        doc.put_many(docs)
+        expected = sorted(id for id, meta in docs if meta['state'] == 'error')
+        serial = list(i for i, m in doc.filter(state="error"))
+        self.assertEqual(sorted(serial), expected)
+        ordered = list(i for i, m in doc.filter(processes=3, state="error"))
+        self.assertEqual(sorted(ordered), expected)
+        #ordered results come back shard by shard
+        self.assertEqual(list(a[:2] for a in ordered), sorted(a[:2] for a in ordered))
+        unordered = list(i for i, m in doc.filter(processes=3, ordered=False, state="error"))
+        self.assertEqual(sorted(unordered), expected)
+
+        doc.migrate_storage("segment")
+        doc.segments.max_segment_size = 1024
+        for id, meta in docs[:30]:
+            meta['state'] = 'error'
+            doc.put(id, meta)
+        expected = sorted(id for id, meta in docs if meta['state'] == 'error')
+        self.assertTrue(len(doc.segments.segments) > 2)
+        self.assertEqual(sorted(i for i, m in doc.filter(processes=3, state="error")), expected)
+        self.assertEqual(len(list(doc.filter(processes=3, ordered=False))), 60)
+
+    def testProjection(self):
+        docs = make_docs(3)
+        data = nebula.docstore.DocStore(None).dumpdoc(docs[0][1])
+        self.assertEqual(decode_fields(data, ["name", "state"]), {"name" : "file_0", "state" : "error"})
+        self.assertEqual(decode_fields(data, ["job"]), {"job" : docs[0][1]["job"]})
+        self.assertEqual(decode_fields(data, ["missing"]), {})
+        self.assertEqual(decode_fields(' { "a" : [1, {"b" : "}"}], "c":null } ', ["c"]), {"c" : None})
+
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        for url in store_urls():
+            doc = nebula.docstore.from_url(url)
+            doc.put_many(docs)
+            out = doc.get(docs[1][0], fields=["name", "job.exit_code"])
+            self.assertEqual(out, {"uuid" : docs[1][0], "name" : "file_1", "job" : {"exit_code" : 1}})
+            self.assertEqual(out.uuid, docs[1][0])
+            for processes in [None, 2]:
+                out = list(doc.filter(processes=processes, fields=["name"], state="error"))
+                self.assertEqual(out, [(docs[0][0], {"uuid" : docs[0][0], "name" : "file_0"})])
+
+    def testDocCache(self):
+        path = get_abspath("../test_tmp/docstore")
+        doc = nebula.docstore.FileDocStore(path, doc_cache_entries=5)
+        docs = make_docs(10)
+        doc.put_many(docs)
+        id = docs[0][0]
+        first = doc.get(id)
+        first['job']['exit_code'] = 10
+        first['tags'].append("changed")
+        #hits are not decoded again
+        decode = doc._decode
+        def fail(*args, **kwds):
+            raise Exception("decoded a cached document")
+        doc._decode = fail
+        self.assertEqual(doc.get(id), docs[0][1])
+        self.assertEqual(doc.get(id, fields=["job.exit_code"]), {"uuid" : id, "job" : {"exit_code" : 0}})
+        doc._decode = decode
+        stats = doc.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+        #a write from another handle changes the stat of the file
+        other = nebula.docstore.FileDocStore(path, doc_cache_entries=0)
+        meta = dict(docs[0][1], state="changed", name="a much longer name")
+        other.put(id, meta)
+        self.assertEqual(doc.get(id)['state'], "changed")
+        self.assertEqual(doc.cache_stats()['misses'], 2)
+        #even one of the same size, in the same tick of the mtime
+        tick = int(time.time())
+        os.utime(doc._docpath(id), (tick, tick))
+        self.assertEqual(doc.get(id)['state'], "changed")
+        other.put(id, dict(meta, state="CHANGED"))
+        os.utime(doc._docpath(id), (tick, tick))
+        self.assertEqual(doc.get(id)['state'], "CHANGED")
+
+        for i, m in docs:
+            doc.get(i)
+        stats = doc.cache_stats()
+        self.assertEqual(stats['entries'], 5)
+        self.assertTrue(stats['evictions'] > 0)
+        doc.put(docs[9][0], dict(docs[9][1], state="local"))
+        self.assertEqual(doc.get(docs[9][0])['state'], "local")
+
+    def testBlobs(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(10)
+        for url, kwds in [
+            (get_abspath("../test_tmp/docstore/file"), {}),
+            (get_abspath("../test_tmp/docstore/segment"), {"storage" : "segment"}),
+            ("sqlite://" + os.path.abspath(get_abspath("../test_tmp/docstore/sqlite")), {})]:
+            doc = nebula.docstore.from_url(url, blob_threshold=1000, **kwds)
+            doc.put_many(docs[:5])
+            for id, meta in docs[5:]:
+                doc.put(id, meta)
+            id, meta = docs[1]
+            if url.startswith("sqlite"):
+                core = doc._conn().execute("SELECT doc FROM docs WHERE id = ?", (id,)).fetchone()[0]
+            else:
+                core = doc._read_raw(id)
+            self.assertIn("__blob__", doc.loaddoc(core)['job'])
+            out = doc.get(id)
+            self.assertEqual(out, meta)
+            self.assertEqual(out['job']['exit_code'], 1)
+            self.assertEqual(json.loads(json.dumps(doc.get(id))), meta)
+            for processes in [None, 2]:
+                found = dict(doc.filter(processes=processes, job=[docs[4][1]['job']]))
+                self.assertEqual(found.keys(), [docs[4][0]])
+
+            #copies are transparent
+            doc.put(id, dict(doc.get(id), state="copied"))
+            held = nebula.docstore.from_url(url).get(id)
+            held_deleted = nebula.docstore.from_url(url).get(docs[2][0])
+            new_meta = dict(meta, job={"exit_code" : 0})
+            doc.put(id, new_meta)
+            self.assertEqual(doc.get(id), new_meta)
+            doc.delete(Target(docs[2][0]))
+            if url.startswith("sqlite"):
+                count = doc._conn().execute("SELECT count(*) FROM blobs").fetchone()[0]
+            else:
+                #a reader that loaded the documents before they changed can
+                #still use them, until compaction removes the unused blobs
+                self.assertEqual(held['job'], meta['job'])
+                self.assertEqual(held_deleted['job'], docs[2][1]['job'])
+                doc.compact()
+                self.assertEqual(len(glob(os.path.join(doc.file_path, "*", "*.blob.z"))), 10)
+                doc.compact(blob_grace=0)
+                count = len(glob(os.path.join(doc.file_path, "*", "*.blob.z")))
+            self.assertEqual(count, 8)
+            self.assertEqual(doc.get(docs[3][0]), docs[3][1])
+
+    def testBlobsCopy(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(3)
+        for url, kwds in [(get_abspath("../test_tmp/docstore/segment"), {"storage" : "segment"})] + list( (u, {}) for u in store_urls() ):
+            doc = nebula.docstore.from_url(url, blob_threshold=1000, **kwds)
+            doc.put_many(docs)
+            id, meta = docs[0]
+            #the C level copies of a dict see the spilled fields too
+            read = [doc.get(id), doc.get_many([id])[0], dict(doc.filter(name="file_0"))[id],
+                dict(doc.filter(processes=2, name="file_0"))[id]]
+            for d in read + [doc.get(id)]:
+                out = {}
+                out.update(d)
+                self.assertEqual(out, meta)
+                self.assertEqual(dict(d), meta)
+                self.assertEqual(dict.__getitem__(copy.copy(d), "job"), meta['job'])
+                self.assertEqual((lambda **kwds: kwds)(**d), meta)
+            #and a copy written back keeps them
+            doc.put(id, dict(doc.get(id)))
+            self.assertEqual(dict(doc.get(id)), meta)
+
+    def testReshard(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(20)
+        data_path = get_abspath("../test_tmp/docstore/data.txt")
+        with open(data_path, "w") as handle:
+            handle.write("x" * 100)
+        for storage in ["files", "segment"]:
+            path = get_abspath("../test_tmp/docstore/%s" % (storage))
+            doc = nebula.docstore.from_url(path, storage=storage, blob_threshold=1000)
+            doc.put_many(docs)
+            for id, meta in docs[:5]:
+                doc.update_from_file(Target(id), file_name=data_path, create=True)
+                meta['file_size'] = 100
+
+            #interrupt the move half way, the store stays readable from both layouts
+            move_entry = nebula.docstore.move_entry
+            calls = []
+            def failing_move(src, dst):
+                calls.append(src)
+                if len(calls) > 20:
+                    raise OSError("interrupted")
+                return move_entry(src, dst)
+            nebula.docstore.move_entry = failing_move
+            try:
+                self.assertRaises(OSError, doc.reshard, 2, 2)
+            finally:
+                nebula.docstore.move_entry = move_entry
+            doc = nebula.docstore.from_url(path)
+            self.assertEqual(doc.previous_layout, (1, 2))
+            for id, meta in docs:
+                self.assertEqual(doc.get(id), meta)
+            self.assertEqual(sorted(i for i, m in doc.filter(processes=2, state="error")),
+                sorted(i for i, m in docs if m['state'] == "error"))
+            id, meta = docs[-1]
+            doc.put(id, dict(meta, state="moved"))
+            self.assertTrue(os.path.exists(doc.objs.get_filename(Target(docs[4][0]))))
+
+            self.assertTrue(doc.reshard(2, 2) > 0)
+            doc = nebula.docstore.from_url(path)
+            self.assertEqual( (doc.layout, doc.previous_layout), ((2, 2), None) )
+            self.assertEqual(glob(os.path.join(path, "??", "dataset_*")), [])
+            self.assertEqual(len(list(doc.filter())), 20)
+            self.assertEqual(doc.get(id)['state'], "moved")
+            self.assertEqual(doc.get(docs[0][0]), docs[0][1])
+            obj_path = doc.objs.get_filename(Target(docs[4][0]))
+            self.assertEqual(os.path.relpath(obj_path, path).split(os.sep)[:2], [docs[4][0][:2], docs[4][0][2:4]])
+            self.assertEqual(os.path.getsize(obj_path), 100)
+            self.assertRaises(Exception, nebula.docstore.from_url, path, hash_depth=1)
+
+    def testCodec(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(20)
+        for storage in ["files", "segment"]:
+            path = get_abspath("../test_tmp/docstore/%s" % (storage))
+            doc = nebula.docstore.from_url(path, storage=storage, codec="marshal", blob_threshold=1000)
+            doc.put_many(docs[:10])
+            self.assertTrue(doc._read_raw(docs[0][0]).startswith(nebula.docstore.codec.MarshalCodec.magic))
+
+            #the codec is recorded with the store, and the documents are
+            #read back in whichever format they were written in
+            self.assertRaises(Exception, nebula.docstore.from_url, path, codec="json")
+            doc = nebula.docstore.from_url(path)
+            self.assertEqual(doc.codec.name, "marshal")
+            other = nebula.docstore.from_url(path)
+            doc.set_codec("json")
+            other.put_many(docs[10:])
+            self.assertEqual(other.codec.name, "json")
+            self.assertEqual(doc._read_raw(docs[10][0])[:1], "{")
+            for id, meta in docs:
+                self.assertEqual(doc.get(id), meta)
+            self.assertEqual(doc.get(docs[0][0], fields=["job.exit_code"])['job'], {"exit_code" : 0})
+            for processes in [None, 2]:
+                self.assertEqual(sorted(i for i, m in doc.filter(processes=processes, state="error")),
+                    sorted(i for i, m in docs if m['state'] == "error"))
+        self.assertRaises(Exception, nebula.docstore.from_url, get_abspath("../test_tmp/docstore/files"), codec="xml")
+        #a store that was written without naming a codec is plain json, with
+        #the standard library whatever else is installed
+        path = get_abspath("../test_tmp/docstore/default")
+        nebula.docstore.from_url(path).put_many(docs[:1])
+        self.assertIs(nebula.docstore.from_url(path).codec.module, json)
+        self.assertRaises(Exception, nebula.docstore.from_url, path, codec="marshal")
+        #which is decided from docstore.json alone, without listing the documents
+        self.assertEqual(json.load(open(os.path.join(path, "docstore.json")))['codec'], "json")
+        def no_listing(self):
+            raise AssertionError("the documents were listed")
+        old_ids = nebula.docstore.FileDocStore.ids
+        nebula.docstore.FileDocStore.ids = no_listing
+        try:
+            self.assertRaises(Exception, nebula.docstore.from_url, path, codec="marshal")
+            self.assertEqual(nebula.docstore.from_url(path, codec="json").codec.name, "json")
+            self.assertEqual(nebula.docstore.from_url(get_abspath("../test_tmp/docstore/new"), codec="marshal").codec.name, "marshal")
+        finally:
+            nebula.docstore.FileDocStore.ids = old_ids
+        #stores that predate it are taken to be json
+        os.unlink(os.path.join(path, "docstore.json"))
+        self.assertRaises(Exception, nebula.docstore.from_url, path, codec="marshal")
+        #json is read back with simplejson when it is there, never with ujson
+        self.assertIs(nebula.docstore.codec.json_loads,
+            nebula.docstore.codec.simplejson.loads if nebula.docstore.codec.simplejson else json.loads)
+
+    def testBloom(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(30)
+        data_path = get_abspath("../test_tmp/docstore/data.txt")
+        with open(data_path, "w") as handle:
+            handle.write("x" * 100)
+        for storage in ["files", "segment"]:
+            path = get_abspath("../test_tmp/docstore/%s" % (storage))
+            doc = nebula.docstore.from_url(path, storage=storage)
+            other = nebula.docstore.from_url(path)
+            doc.put_many(docs[:10])
+            for id, meta in docs[:5]:
+                doc.update_from_file(Target(id), file_name=data_path, create=True)
+                meta['file_size'] = 100
+            stats = doc.create_bloom(capacity=1000)
+            self.assertEqual(sorted(stats.keys()), ["docs", "objects"])
+            self.assertTrue(stats["docs"]["fp_rate"] < 0.01)
+
+            #ids the filters don't know are answered without looking
+            def fail(*args, **kwds):
+                raise Exception("filesystem access")
+            read_doc, objs_exists = doc._read_doc, doc.objs.exists
+            doc._read_doc, doc.objs.exists = fail, fail
+            missing = list( str(uuid.uuid4()) for i in range(20) )
+            self.assertEqual(doc.get_many(missing), [None] * 20)
+            self.assertFalse(any(doc.exists(Target(a)) for a in missing))
+            doc._read_doc, doc.objs.exists = read_doc, objs_exists
+            for id, meta in docs[:10]:
+                self.assertEqual(doc.get(id), meta)
+            self.assertTrue(doc.exists(Target(docs[4][0])))
+            self.assertFalse(doc.exists(Target(docs[5][0])))
+
+            #a store opened before the filters were built keeps them up to date
+            other.put_many(docs[10:20])
+            other.put(docs[20][0], docs[20][1])
+            other.create(Target(docs[20][0]))
+            for id, meta in docs[10:21]:
+                self.assertEqual(doc.get(id), meta)
+            self.assertTrue(doc.exists(Target(docs[20][0])))
+
+            #rebuilds are picked up by the other processes
+            doc.create_bloom(capacity=5000)
+            doc.put_many(docs[21:])
+            self.assertEqual(other.bloom_stats()["docs"]["bits"], doc.bloom_stats()["docs"]["bits"])
+            self.assertTrue(all(other.get(id) == meta for id, meta in docs))
+            doc.drop_bloom()
+            self.assertEqual(other.bloom_stats(), {})
+            self.assertEqual(other.get(docs[0][0]), docs[0][1])
+
+    def testBloomWrites(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(6)
+        for storage in ["files", "segment"]:
+            path = get_abspath("../test_tmp/docstore/%s" % (storage))
+            doc = nebula.docstore.from_url(path, storage=storage)
+            doc.create_bloom(capacity=1000)
+            other = nebula.docstore.from_url(path)
+            #the bits are set before the document is written, so no reader
+            #is ever told it's missing once it is there
+            seen = []
+            dumpdoc = doc.dumpdoc
+            def check(core):
+                seen.append(other.blooms.might_contain("docs", core['uuid']))
+                return dumpdoc(core)
+            doc.dumpdoc = check
+            doc.put(docs[0][0], docs[0][1])
+            doc.put_many(docs[1:3])
+            self.assertEqual(seen, [True] * 3)
+
+            #a rebuild that scans the store before the document is written
+            #doesn't lose it
+            def rebuild(core):
+                other.create_bloom(capacity=1000)
+                return dumpdoc(core)
+            doc.dumpdoc = rebuild
+            doc.put(docs[3][0], docs[3][1])
+            doc.put_many(docs[4:5])
+            del doc.dumpdoc
+            for id, meta in docs[:5]:
+                self.assertEqual(other.get(id), meta)
+
+            #ids are hashed as utf-8
+            doc.blooms.add("objects", [u"caf\xe9", u"plain"])
+            self.assertTrue(other.blooms.might_contain("objects", u"caf\xe9"))
+            self.assertTrue(other.blooms.might_contain("objects", "caf\xc3\xa9"))
+            self.assertTrue(other.blooms.might_contain("objects", "plain"))
+
+    def testBloomReload(self):
+        path = get_abspath("../test_tmp/docstore")
+        doc = nebula.docstore.from_url(path)
+        other = nebula.docstore.from_url(path)
+        old_interval = nebula.docstore.bloom.RELOAD_INTERVAL
+        nebula.docstore.bloom.RELOAD_INTERVAL = 0
+        try:
+            #filters built or dropped by another process are picked up by
+            #lookups, not only by writes
+            missing = str(uuid.uuid4())
+            self.assertTrue(other.blooms.might_contain("objects", missing))
+            doc.create_bloom(capacity=1000)
+            self.assertFalse(other.blooms.might_contain("objects", missing))
+            self.assertFalse(other.exists(Target(missing)))
+            doc.drop_bloom()
+            self.assertTrue(other.blooms.might_contain("objects", missing))
+            doc.create_bloom(capacity=1000)
+            self.assertFalse(other.blooms.might_contain("objects", missing))
+
+            #an object written to the path get_filename gives is found
+            t = Target(str(uuid.uuid4()))
+            file_name = doc.get_filename(t)
+            if not os.path.exists(os.path.dirname(file_name)):
+                os.makedirs(os.path.dirname(file_name))
+            with open(file_name, "w") as handle:
+                handle.write("data")
+            self.assertTrue(other.exists(t))
+        finally:
+            nebula.docstore.bloom.RELOAD_INTERVAL = old_interval
+
+    def testLineage(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(6)
+        a, b, c, d, e, f = list(id for id, meta in docs)
+        def derive(i, job, inputs):
+            docs[i][1]['provenance'] = {
+                "job_id" : job,
+                "tool_id" : "cat",
+                "parameters" : dict( ("input%d" % (n), {"id" : "x", "uuid" : id}) for n, id in enumerate(inputs) )
+            }
+        derive(1, "job1", [a])
+        derive(2, "job1", [a])
+        derive(3, "job2", [b])
+        derive(4, "job3", [d, c])
+        for url in store_urls():
+            doc = nebula.docstore.from_url(url)
+            doc.put_many(docs[:3])
+            doc.create_lineage()
+            doc.put_many(docs[3:5])
+            self.assertEqual(doc.parents(e), set([(d, "job3"), (c, "job3")]))
+            self.assertEqual(doc.children(a), set([(b, "job1"), (c, "job1")]))
+            self.assertEqual(doc.ancestors(e), set([a, b, c, d]))
+            self.assertEqual(doc.ancestors(e, max_depth=1), set([c, d]))
+            self.assertEqual(doc.descendants(a), set([b, c, d, e]))
+            self.assertEqual(doc.descendants(e), set())
+
+            #rewriting and deleting documents updates their edges
+            id, meta = docs[3]
+            doc.put(id, dict(meta, provenance=dict(meta['provenance'], parameters={"input" : [{"uuid" : f}]})))
+            self.assertEqual(doc.descendants(a), set([b, c, e]))
+            self.assertEqual(doc.ancestors(e), set([a, c, d, f]))
+            doc.delete(Target(e))
+            self.assertEqual(doc.descendants(c), set())
+            self.assertEqual(doc.descendants(f), set([d]))
+
+    def testLineageWrites(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(8)
+        ids = list(id for id, meta in docs)
+        def derive(i, inputs):
+            return dict(docs[i][1], provenance={
+                "job_id" : "job%d" % (i),
+                "tool_id" : "cat",
+                "parameters" : dict( ("input%d" % (n), {"uuid" : id}) for n, id in enumerate(inputs) )
+            })
+        path = get_abspath("../test_tmp/docstore/file")
+        doc = nebula.docstore.from_url(path)
+        doc.put_many(docs[:4])
+        doc.create_lineage()
+        other = nebula.docstore.from_url(path)
+
+        #a document written while the index is rebuilt keeps its edges
+        writer = threading.Thread(target=other.put, args=(ids[4], derive(4, [ids[0]])))
+        def scan():
+            for i, (id, meta) in enumerate(doc.filter(fields=["provenance"])):
+                if i == 0:
+                    writer.start()
+                    writer.join(0.5)
+                yield id, meta
+        doc.lineage.build(scan())
+        writer.join()
+        self.assertEqual(doc.parents(ids[4]), set([(ids[0], "job4")]))
+        self.assertEqual(doc.children(ids[0]), set([(ids[4], "job4")]))
+        self.assertEqual(glob(path + "/_lineage.*"), [path + "/_lineage.lock"])
+
+        #concurrent rewrites of a document leave it with one set of inputs
+        versions = list( derive(5, ids[i:i + 2]) for i in range(4) )
+        threads = list( threading.Thread(target=(doc, other)[i % 2].put, args=(ids[5], meta))
+            for i, meta in enumerate(versions) )
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        parents = doc.parents(ids[5])
+        self.assertIn(parents, list( set( (p, "job5") for p in ids[i:i + 2] ) for i in range(4) ))
+        for id in ids[:5]:
+            self.assertEqual((id, "job5") in parents, (ids[5], "job5") in doc.children(id))
+
+        doc.drop_lineage()
+        self.assertEqual(glob(path + "/_lineage*"), [])
+        other.put(ids[6], derive(6, [ids[0]]))
+        self.assertEqual(glob(path + "/_lineage*"), [])
+
+    def testArchive(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(40)
+        src = nebula.docstore.from_url(get_abspath("../test_tmp/docstore/src"), blob_threshold=1000)
+        src.put_many(docs)
+        data_path = get_abspath("../test_tmp/docstore/data.txt")
+        for i, (id, meta) in enumerate(docs[:10]):
+            with open(data_path, "w") as handle:
+                handle.write("data %d\n" % (i) * 1000)
+            src.update_from_file(Target(id), file_name=data_path, create=True)
+            meta['file_size'] = os.path.getsize(data_path)
+        archive = get_abspath("../test_tmp/docstore/archive")
+        self.assertEqual(nebula.docstore.archive.export_archive(src, archive, processes=2, prefix_len=1), 40)
+
+        #cut a chunk short, as an interrupted export would, and resume
+        name = sorted(glob(os.path.join(archive, "*.idx")), key=os.path.getsize)[-1]
+        with open(name) as handle:
+            lines = handle.readlines()
+        with open(name, "w") as handle:
+            handle.write("".join(lines[:-2]) + lines[-2][:10])
+        self.assertEqual(nebula.docstore.archive.export_archive(src, archive, processes=2), 1)
+
+        for url in store_urls():
+            doc = nebula.docstore.from_url(url)
+            self.assertEqual(nebula.docstore.archive.import_archive(archive, doc, processes=2), 40)
+            self.assertEqual(nebula.docstore.archive.import_archive(archive, doc, processes=2), 0)
+            for id, meta in docs:
+                self.assertEqual(doc.get(id), meta)
+            for id, meta in docs[:10]:
+                with open(doc.get_filename(Target(id))) as handle:
+                    with open(src.get_filename(Target(id))) as src_handle:
+                        self.assertEqual(handle.read(), src_handle.read())
+            self.assertFalse(doc.exists(Target(docs[10][0])))
+
+        #damaged records are caught
+        name = os.path.join(archive, sorted(a for a in os.listdir(archive) if a.endswith(".dat"))[0])
+        with open(name, "r+b") as handle:
+            handle.seek(20)
+            c = handle.read(1)
+            handle.seek(20)
+            handle.write(chr(ord(c) ^ 1))
+        doc = nebula.docstore.from_url(get_abspath("../test_tmp/docstore/other"))
+        self.assertRaises(Exception, nebula.docstore.archive.import_archive, archive, doc)
+
+    def testArchiveRerun(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(4)
+        src = nebula.docstore.from_url(get_abspath("../test_tmp/docstore/src"))
+        src.put_many(docs[:3])
+        data_path = get_abspath("../test_tmp/docstore/data.txt")
+        with open(data_path, "w") as handle:
+            handle.write("data\n" * 1000)
+        src.update_from_file(Target(docs[0][0]), file_name=data_path, create=True)
+        archive = get_abspath("../test_tmp/docstore/archive")
+        self.assertEqual(nebula.docstore.archive.export_archive(src, archive, prefix_len=0), 3)
+
+        #documents added to a finished chunk aren't exported silently
+        warnings = []
+        class Collect(logging.Handler):
+            def emit(self, record):
+                warnings.append(record.getMessage())
+        handler = Collect(logging.WARNING)
+        logging.getLogger().addHandler(handler)
+        try:
+            self.assertEqual(nebula.docstore.archive.export_archive(src, archive), 0)
+            self.assertEqual(warnings, [])
+            src.put(docs[3][0], docs[3][1])
+            self.assertEqual(nebula.docstore.archive.export_archive(src, archive), 0)
+            self.assertEqual(len(warnings), 1)
+            self.assertIn("1 of its documents", warnings[0])
+        finally:
+            logging.getLogger().removeHandler(handler)
+
+        #a damaged object file leaves nothing behind
+        name = glob(os.path.join(archive, "*.idx"))[0]
+        with open(name) as handle:
+            rec = list( r for r in map(json.loads, handle) if r.get("type") == "data" )[0]
+        with open(name[:-len(".idx")] + ".dat", "r+b") as handle:
+            handle.seek(rec["offset"] + rec["size"] // 2)
+            c = handle.read(1)
+            handle.seek(rec["offset"] + rec["size"] // 2)
+            handle.write(chr(ord(c) ^ 1))
+        path = get_abspath("../test_tmp/docstore/dest")
+        doc = nebula.docstore.from_url(path)
+        self.assertRaises(nebula.docstore.archive.ArchiveError, nebula.docstore.archive.import_archive, archive, doc)
+        self.assertFalse(doc.exists(Target(rec["id"])))
+        for root, dirs, files in os.walk(path):
+            self.assertEqual(list(f for f in files if f.startswith("tmp")), [])
+
+    def testExportColumns(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(20)
+        for i, (id, meta) in enumerate(docs):
+            meta['file_size'] = i * 100
+            meta['job']['job_metrics'] = [{"name" : "runtime_seconds", "raw_value" : i * 1.5}]
+        del docs[0][1]['tags']
+        fields = ["name", "file_size", "job.exit_code", "runtime_seconds", "tags"]
+        out = get_abspath("../test_tmp/docstore/columns.csv")
+        doc = nebula.docstore.from_url(get_abspath("../test_tmp/docstore/file"))
+        doc.put_many(docs)
+        self.assertEqual(nebula.docstore.columns.export_columns(doc, out, fields, processes=2), 20)
+        with open(out) as handle:
+            header = handle.readline().strip()
+        self.assertEqual(header, "uuid:str,name:str,file_size:int,job.exit_code:int,runtime_seconds:float,tags:str")
+        names, rows = nebula.docstore.columns.read_csv(out)
+        self.assertEqual(rows[docs[3][0]], ["file_3", 300, 0, 4.5, '["batch:1"]'])
+        self.assertEqual(rows[docs[0][0]][4], None)
+
+        #a refresh only reads what changed since the watermark
+        id, meta = docs[5]
+        doc.put(id, dict(meta, file_size=12345))
+        doc.delete(Target(docs[6][0]))
+        self.assertEqual(nebula.docstore.columns.export_columns(doc, out, fields), 1)
+        names, rows = nebula.docstore.columns.read_csv(out)
+        self.assertEqual(len(rows), 19)
+        self.assertEqual(rows[id][1], 12345)
+        self.assertEqual(nebula.docstore.columns.export_columns(doc, out, fields), 0)
+        self.assertEqual(nebula.docstore.columns.export_columns(doc, out, fields, refresh=False), 19)
+
+    def testExportColumnsStrings(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(5)
+        names = ["", "\\", "\\x", u"caf\xe9", None]
+        for (id, meta), name in zip(docs, names):
+            if name is None:
+                del meta['name']
+            else:
+                meta['name'] = name
+        out = get_abspath("../test_tmp/docstore/columns.csv")
+        doc = nebula.docstore.from_url(get_abspath("../test_tmp/docstore/file"))
+        doc.put_many(docs)
+        self.assertEqual(nebula.docstore.columns.export_columns(doc, out, ["name"]), 5)
+        #empty strings and missing values read back as themselves, also
+        #across a refresh
+        for i in range(2):
+            fields, rows = nebula.docstore.columns.read_csv(out)
+            self.assertEqual(list( rows[id][0] for id, meta in docs ), names)
+            doc.put(docs[0][0], docs[0][1])
+            self.assertEqual(nebula.docstore.columns.export_columns(doc, out, ["name"]), 1)
+
+    def testSyncDocDir(self):
+        src = get_abspath("../test_tmp/docstore/incoming")
+        os.makedirs(src)
+        docs = make_docs(6)
+        for i, (id, meta) in enumerate(docs):
+            with open(os.path.join(src, "file_%d" % (i)), "w") as handle:
+                handle.write("data %d\n" % (i))
+            with open(os.path.join(src, "file_%d.json" % (i)), "w") as handle:
+                handle.write(json.dumps(meta))
+        with open(os.path.join(src, "orphan.json"), "w") as handle:
+            handle.write(json.dumps(docs[0][1]))
+        doc = nebula.docstore.from_url(get_abspath("../test_tmp/docstore/file"))
+        self.assertEqual(sync_doc_dir(src, doc, filter=lambda m: m['name'] != "file_5", strategy="link"), 5)
+        for i, (id, meta) in enumerate(docs[:5]):
+            self.assertEqual(doc.get(id)['name'], meta['name'])
+            self.assertEqual(doc.get(id)['file_size'], len("data %d\n" % (i)))
+            with open(doc.get_filename(Target(id))) as handle:
+                self.assertEqual(handle.read(), "data %d\n" % (i))
+        self.assertEqual(doc.get(docs[5][0]), None)
+        #same filesystem, so the data is linked rather than copied
+        self.assertEqual(os.stat(doc.get_filename(Target(docs[0][0]))).st_ino,
+            os.stat(os.path.join(src, "file_0")).st_ino)
+
+        #unchanged files are skipped, changed ones are ingested again, and
+        #by default a source that can still be written isn't linked
+        self.assertEqual(sync_doc_dir(src, doc), 1)
+        self.assertNotEqual(os.stat(doc.get_filename(Target(docs[5][0]))).st_ino,
+            os.stat(os.path.join(src, "file_5")).st_ino)
+        self.assertEqual(sync_doc_dir(src, doc), 0)
+        with open(os.path.join(src, "file_2.new"), "w") as handle:
+            handle.write("new data\n")
+        os.rename(os.path.join(src, "file_2.new"), os.path.join(src, "file_2"))
+        self.assertEqual(sync_doc_dir(src, doc, strategy="copy"), 1)
+        with open(doc.get_filename(Target(docs[2][0]))) as handle:
+            self.assertEqual(handle.read(), "new data\n")
+        self.assertEqual(doc.get(docs[2][0])['file_size'], len("new data\n"))
+
+    def testSyncDocDirInterrupted(self):
+        src = get_abspath("../test_tmp/docstore/incoming")
+        os.makedirs(src)
+        docs = make_docs(3)
+        for i, (id, meta) in enumerate(docs):
+            with open(os.path.join(src, "file_%d" % (i)), "w") as handle:
+                handle.write("data %d\n" % (i))
+            with open(os.path.join(src, "file_%d.json" % (i)), "w") as handle:
+                handle.write(json.dumps(meta))
+        doc = nebula.docstore.from_url(get_abspath("../test_tmp/docstore/file"))
+        #the process dies once the data is in, before the documents are
+        #written or the sync state is saved
+        def crash(items):
+            raise KeyboardInterrupt()
+        doc.put_many = crash
+        self.assertRaises(KeyboardInterrupt, sync_doc_dir, src, doc)
+        del doc.put_many
+        os.unlink(os.path.join(src, ".nebula_sync.json"))
+        self.assertTrue(all(doc.exists(Target(id)) for id, meta in docs))
+
+        #the files are ingested again, as their documents are missing
+        self.assertEqual(sync_doc_dir(src, doc), 3)
+        for i, (id, meta) in enumerate(docs):
+            self.assertEqual(doc.get(id)['file_size'], len("data %d\n" % (i)))
+
+    def testSyncDocDirMissingData(self):
+        src = get_abspath("../test_tmp/docstore/incoming")
+        os.makedirs(src)
+        docs = make_docs(2)
+        doc = nebula.docstore.from_url(get_abspath("../test_tmp/docstore/file"))
+        #documents written ahead of their data, as the service does for
+        #outputs that have none yet
+        doc.put_many(docs)
+        for i, (id, meta) in enumerate(docs):
+            with open(os.path.join(src, "file_%d" % (i)), "w") as handle:
+                handle.write("data %d\n" % (i))
+            with open(os.path.join(src, "file_%d.json" % (i)), "w") as handle:
+                handle.write(json.dumps(meta))
+        self.assertFalse(doc.exists(Target(docs[0][0])))
+        self.assertEqual(sync_doc_dir(src, doc), 2)
+        for i, (id, meta) in enumerate(docs):
+            with open(doc.get_filename(Target(id))) as handle:
+                self.assertEqual(handle.read(), "data %d\n" % (i))
+            self.assertEqual(doc.get(id)['file_size'], len("data %d\n" % (i)))
+        os.unlink(os.path.join(src, ".nebula_sync.json"))
+        #with both halves in, a rerun without its state skips them
+        self.assertEqual(sync_doc_dir(src, doc), 0)
+
+    def testWatch(self):
+        src = get_abspath("../test_tmp/docstore/incoming")
+        os.makedirs(src)
+        docs = make_docs(3)
+        doc = nebula.docstore.from_url(get_abspath("../test_tmp/docstore/file"))
+        for method in ["inotify", "poll"]:
+            try:
+                daemon = IngestDaemon(doc, [src], settle=0.2, poll_interval=0.05, method=method)
+                daemon.start()
+            except OSError:
+                continue
+            id, meta = docs.pop()
+            with open(os.path.join(src, id), "w") as handle:
+                handle.write("data")
+            self.assertEqual(daemon.run_once(0.3), [])
+            with open(os.path.join(src, id + ".json"), "w") as handle:
+                handle.write(json.dumps(meta))
+            #nothing is ingested until the pair has settled
+            daemon.run_once(0.05)
+            self.assertEqual(daemon.ingest_ready(), [])
+            self.assertEqual(doc.get(id), None)
+            ids = []
+            for i in range(20):
+                ids.extend(daemon.run_once(0.1))
+                if len(ids):
+                    break
+            daemon.close()
+            self.assertEqual(ids, [id])
+            self.assertEqual(doc.get(id)['name'], meta['name'])
+            self.assertEqual(doc.get(id)['file_size'], 4)
+            self.assertEqual(list(c[2] for c in doc.changes())[-1], id)
+        #the sync state is shared with sync_doc_dir
+        self.assertEqual(sync_doc_dir(src, doc), 0)
+
+    def testWatchFailures(self):
+        src = os.path.abspath(get_abspath("../test_tmp/docstore/incoming"))
+        os.makedirs(src)
+        docs = make_docs(2)
+        for i, (id, meta) in enumerate(docs):
+            with open(os.path.join(src, "file_%d" % (i)), "w") as handle:
+                handle.write("data %d\n" % (i))
+            with open(os.path.join(src, "file_%d.json" % (i)), "w") as handle:
+                handle.write(json.dumps(meta))
+        doc = nebula.docstore.from_url(get_abspath("../test_tmp/docstore/file"))
+        daemon = IngestDaemon(doc, [src], settle=0, method="poll")
+        daemon.start()
+        transfer_file = nebula.docstore.util.transfer_file
+        def failing_transfer(src, dst, strategy):
+            if os.path.basename(src) == "file_0":
+                raise IOError("Input/output error")
+            return transfer_file(src, dst, strategy)
+        nebula.docstore.util.transfer_file = failing_transfer
+        logger = logging.getLogger()
+        level = logger.level
+        logger.setLevel(logging.CRITICAL)
+        try:
+            #a failing file doesn't stop the daemon, and is tried again on
+            #its own, later each time
+            now = time.time()
+            daemon.ingest_ready(now)
+            self.assertEqual(daemon.failures[(src, "file_0")][1], 1)
+            self.assertEqual(daemon.ingest_ready(now + 1), [])
+            daemon.ingest_ready(now + 5)
+            self.assertEqual(doc.get(docs[1][0])['name'], "file_1")
+            self.assertEqual(doc.get(docs[0][0]), None)
+            self.assertEqual(daemon.pending[(src, "file_0")][1], now + 15)
+            self.assertEqual(daemon.ingest_ready(now + 14), [])
+        finally:
+            nebula.docstore.util.transfer_file = transfer_file
+            logger.setLevel(level)
+        self.assertEqual(daemon.ingest_ready(now + 15), [docs[0][0]])
+        self.assertEqual(daemon.pending, {})
+        self.assertEqual(daemon.failures, {})
+        daemon.close()
+        self.assertEqual(sync_doc_dir(src, doc), 0)
+
+    def testChanges(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        for url in store_urls():
+            doc = nebula.docstore.from_url(url)
+            docs = make_docs(5)
+            self.assertEqual(doc.last_seq(), 0)
+            doc.put_many(docs[:3])
+            doc.put(docs[3][0], docs[3][1])
+            doc.delete(Target(docs[0][0]))
+            doc.delete(Target(str(uuid.uuid4())))
+            changes = list(doc.changes())
+            self.assertEqual(changes[-2:], [(4, "put", docs[3][0]), (5, "delete", docs[0][0])])
+            self.assertEqual(list(a[2] for a in changes[:3]), list(a[0] for a in docs[:3]))
+            self.assertEqual(doc.last_seq(), 5)
+            self.assertEqual(list(doc.changes(since=4)), changes[-1:])
+            self.assertEqual(doc.wait_for_changes(5, timeout=0.2), [])
+
+            other = nebula.docstore.from_url(url)
+            timer = threading.Timer(0.2, other.put, docs[4])
+            timer.start()
+            self.assertEqual(doc.wait_for_changes(5, timeout=10), [(6, "put", docs[4][0])])
+            timer.join()
+
+    def testBatch(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        for storage in ["files", "segment"]:
+            path = get_abspath("../test_tmp/docstore/%s" % (storage))
+            doc = nebula.docstore.from_url(path, storage=storage, indexes=["state"])
+            docs = make_docs(10)
+            doc.put_many(docs[:5])
+            #a batch mixing new and stored documents, with an id given twice
+            id, meta = docs[0]
+            doc.put_many(docs[3:] + [(id, dict(meta, state="ok")), (id, dict(meta, state="running"))])
+            missing = str(uuid.uuid4())
+            out = doc.get_many([docs[7][0], missing, id])
+            self.assertEqual(out[0]['name'], "file_7")
+            self.assertIsNone(out[1])
+            self.assertEqual(out[2]['state'], "running")
+            self.assertEqual(doc.get_many([]), [])
+            self.assertEqual(len(doc.ids()), 10)
+            self.assertEqual(list( i for i, meta in doc.filter(state="running") ), [id])
+
+            #a batch that fails part way stores none of it, and leaves no temp files
+            seq = doc.last_seq()
+            new = make_docs(3)
+            new[1][1]['bad'] = object()
+            self.assertRaises(TypeError, doc.put_many, [docs[1]] + new)
+            self.assertEqual(doc.get_many(list( i for i, meta in new )), [None] * 3)
+            self.assertEqual(doc.last_seq(), seq)
+            self.assertEqual(len(doc.ids()), 10)
+            for dir, dirs, files in os.walk(path):
+                self.assertEqual(list( f for f in files if ".tmp." in f ), [])
+
+            #threads of one process writing the same document
+            errors = []
+            def write(state):
+                try:
+                    for i in range(20):
+                        doc.put_many([(id, dict(meta, state=state))])
+                except Exception, e:
+                    errors.append(e)
+            threads = list( threading.Thread(target=write, args=(state,)) for state in ["ok", "error", "queued"] )
+            for a in threads:
+                a.start()
+            for a in threads:
+                a.join()
+            self.assertEqual(errors, [])
+            self.assertIn(doc.get(id)['state'], ["ok", "error", "queued"])
+
+    def testQuery(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(30)
+        for i, (id, meta) in enumerate(docs):
+            meta['size'] = i * 100
+        del docs[0][1]['tags']
+        for url in store_urls():
+            doc = nebula.docstore.from_url(url, indexes=["name", "job.exit_code", "size"])
+            doc.put_many(docs)
+            def ids(**kwds):
+                return sorted(i for i, m in doc.filter(**kwds))
+            def expected(func):
+                return sorted(i for i, m in docs if func(m))
+            self.assertEqual(ids(query={"job.exit_code" : {"$ne" : 0}}), expected(lambda m: m['job']['exit_code'] != 0))
+            self.assertEqual(ids(size={"$gt" : 1000, "$lte" : 2000}), expected(lambda m: 1000 < m['size'] <= 2000))
+            self.assertEqual(ids(size={"$gte" : "a"}), [])
+            self.assertEqual(ids(name={"$prefix" : "file_2"}), expected(lambda m: m['name'].startswith("file_2")))
+            self.assertEqual(ids(tags={"$contains" : "batch:1"}), expected(lambda m: "batch:1" in m.get('tags', [])))
+            self.assertEqual(ids(tags={"$exists" : False}), [docs[0][0]])
+            self.assertEqual(ids(query={"job.exit_code" : {"$in" : [1, 2]}}, state="ok"), expected(lambda m: m['job']['exit_code'] in [1, 2]))
+            self.assertEqual(ids(name={"$contains" : "_1"}, processes=2), expected(lambda m: "_1" in m['name']))
+            self.assertRaises(nebula.docstore.query.QueryError, ids, size={"$between" : 1})
+
+            plan = doc.explain(query={"job.exit_code" : 1, "size" : {"$lt" : 300}})
+            if url.startswith("sqlite"):
+                self.assertTrue(any("doc_idx_" in a for a in plan['plan']))
+            else:
+                self.assertEqual(plan['index'], ("size", "$lt"))
+                self.assertEqual(plan['residual'], [("job.exit_code", "$eq")])
+                self.assertTrue(doc.explain(state="ok")['scan'])
+
+    def testAggregate(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        docs = make_docs(30)
+        for i, (id, meta) in enumerate(docs):
+            meta['size'] = i * 100
+            meta['job']['job_metrics'] = [{"name" : "runtime_seconds", "raw_value" : "%d.0000000" % (i)}]
+        metrics = ["count", "sum:size", "hist:runtime_seconds"]
+        for url in store_urls():
+            doc = nebula.docstore.from_url(url)
+            doc.put_many(docs[:20])
+            doc.create_aggregate(group_by="state", metrics=metrics)
+            doc.create_aggregate()
+            doc.put_many(docs[20:])
+            id, meta = docs[3]
+            doc.put(id, dict(meta, state="ok", size=5))
+            doc.delete(Target(docs[0][0]))
+
+            doc = nebula.docstore.from_url(url)
+            self.assertEqual(sorted(doc.list_aggregates()), [([], ["count"]), (["state"], sorted(metrics))])
+            out = doc.aggregate("state", metrics)
+            #scanning gives the same answer
+            self.assertEqual(out, doc.aggregate("state", metrics, query={"uuid" : {"$exists" : True}}))
+            self.assertEqual(out["error"]["count"], 8)
+            self.assertEqual(out["ok"]["count"], 21)
+            self.assertEqual(out["error"]["sum:size"], sum(i * 100 for i in range(6, 30, 3)))
+            self.assertEqual(out["ok"]["hist:runtime_seconds"][16], len(list(i for i in range(16, 30) if i % 3)))
+            self.assertEqual(doc.aggregate(), {None : {"count" : 29}})
+            self.assertEqual(doc.aggregate("state", ["count"], state="error"), {"error" : {"count" : 8}})
+
+            #the size of the stored data is added to the document
+            data_path = get_abspath("../test_tmp/docstore/data.txt")
+            with open(data_path, "w") as handle:
+                handle.write("x" * 1234)
+            t = Target(str(uuid.uuid4()))
+            doc.update_from_file(t, file_name=data_path, create=True)
+            doc.put(t.id, {"uuid" : t.id, "state" : "ok"})
+            doc.update_from_file(Target(docs[1][0]), file_name=data_path, create=True)
+            self.assertEqual(doc.get(t.id)['file_size'], 1234)
+            self.assertEqual(doc.get(docs[1][0])['file_size'], 1234)
+            self.assertEqual(doc.aggregate("state", ["count"])["ok"]["count"], 22)
+
+            #the recorded size wins, and put doesn't stat the object
+            t = Target(str(uuid.uuid4()))
+            doc.update_from_file(t, file_name=data_path, create=True)
+            size = doc.objs.size
+            doc.objs.size = None
+            try:
+                doc.put_many([(t.id, {"uuid" : t.id, "file_size" : 1})])
+            finally:
+                doc.objs.size = size
+            self.assertEqual(doc.get(t.id)['file_size'], 1234)
+            #and a document that already has it isn't written again
+            seq = doc.last_seq()
+            doc.update_from_file(t, file_name=data_path)
+            self.assertEqual(doc.last_seq(), seq)
+
+            #writers of the same document don't both count its old version
+            id, meta = docs[5]
+            out = doc.aggregate("state", ["count"])
+            def flip(state):
+                for i in range(20):
+                    nebula.docstore.from_url(url).put(id, dict(meta, state=state))
+            threads = list( threading.Thread(target=flip, args=(state,)) for state in ["ok", "error"] )
+            for a in threads:
+                a.start()
+            for a in threads:
+                a.join()
+            state = doc.get(id)['state']
+            other = "ok" if state == "error" else "error"
+            self.assertEqual(doc.aggregate("state", ["count"])[state]["count"], out[state]["count"] + (meta['state'] != state))
+            self.assertEqual(doc.aggregate("state", ["count"])[other]["count"], out[other]["count"] - (meta['state'] != state))
+
+
+class SQLiteDocStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        if not os.path.exists(get_abspath("../test_tmp")):
+            os.mkdir(get_abspath("../test_tmp"))
+
+    def tearDown(self):
+        if os.path.exists(get_abspath("../test_tmp/docstore")):
+            shutil.rmtree(get_abspath("../test_tmp/docstore"))
+
+    def testFilter(self):
+        url = "sqlite://" + os.path.abspath(get_abspath("../test_tmp/docstore"))
+        doc = nebula.docstore.from_url(url, indexes=["state"])
+        self.assertEqual(doc.get_url(), url)
+        docs = make_docs(30)
+        for id, meta in docs:
+            doc.put(id, meta)
+        self.assertEqual(doc.get(docs[4][0])['name'], "file_4")
+        self.assertIsNone(doc.get(str(uuid.uuid4())))
+
+        doc = nebula.docstore.from_url(url)
+        self.assertEqual(doc.list_indexes(), ["state"])
+        plan = doc._conn().execute("EXPLAIN QUERY PLAN SELECT id, doc FROM docs" + doc._where({"state" : "error"})[0], ["error"]).fetchall()
+        self.assertIn("doc_idx_state", str(plan))
+
+        expected = sorted(id for id, meta in docs if meta['state'] == 'error')
+        self.assertEqual(sorted(id for id, meta in doc.filter(state="error")), expected)
+        self.assertEqual(len(list(doc.filter(state=["ok", "error"]))), 30)
+        self.assertEqual(len(list(doc.filter(tags=[["batch:1"]]))), 15)
+
+        doc.delete(Target(docs[0][0]))
+        self.assertEqual(len(list(doc.filter())), 29)
+
+    def testProjectionNulls(self):
+        url = "sqlite://" + os.path.abspath(get_abspath("../test_tmp/docstore"))
+        doc = nebula.docstore.from_url(url)
+        docs = make_docs(2)
+        docs[0][1]['note'] = None
+        doc.put_many(docs)
+        #a null member is returned, a missing one isn't
+        out = doc.get(docs[0][0], fields=["note", "name"])
+        self.assertEqual(out, {"uuid" : docs[0][0], "name" : "file_0", "note" : None})
+        self.assertNotIn("note", doc.get(docs[1][0], fields=["note", "name"]))
+        out = dict(doc.filter(fields=["note"], name="file_0"))
+        self.assertEqual(out[docs[0][0]]['note'], None)
+
+    def testBloomUnsupported(self):
+        url = "sqlite://" + os.path.abspath(get_abspath("../test_tmp/docstore"))
+        doc = nebula.docstore.from_url(url)
+        self.assertEqual(doc.create_bloom(), {})
+        self.assertEqual(doc.bloom_stats(), {})
+        doc.drop_bloom()
+
+    def testBatch(self):
+        os.mkdir(get_abspath("../test_tmp/docstore"))
+        for url in store_urls():
+            doc = nebula.docstore.from_url(url, indexes=["state"])
+            docs = make_docs(20)
+            doc.put_many(docs)
+            missing = str(uuid.uuid4())
+            out = doc.get_many([docs[5][0], missing, docs[0][0]])
+            self.assertEqual(out[0]['name'], "file_5")
+            self.assertIsNone(out[1])
+            self.assertEqual(out[2]['name'], "file_0")
+            self.assertEqual(len(list(doc.filter(state="error"))), 7)
@@ -0,0 +1,410 @@
+
+import unittest
+
+import os
+import uuid
+import shutil
+import hashlib
+from xml.etree import ElementTree
+from nebula.target import Target
+import galaxy.objectstore.s3_download
+import galaxy.objectstore.s3_multipart_upload
+from galaxy.objectstore.s3_download import DownloadError, ObjectChanged
+from galaxy.objectstore.s3_multipart_upload import multipart_upload, UploadError
+from galaxy.objectstore.s3 import S3ObjectStore
+
+def get_abspath(path):
+    return os.path.join(os.path.dirname(__file__), path)
+
+
+def etag_of(data):
+    return '"%s"' % (hashlib.md5(data).hexdigest())
+
+
+class LocalResponseError(Exception):
+    def __init__(self, status, reason):
+        Exception.__init__(self, "%d %s" % (status, reason))
+        self.status = status
+
+
+class LocalResponse(object):
+    """
+    In-process stand-in for the HTTPResponse of an open boto Key, failing
+    after `fail_at` bytes if set
+    """
+
+    def __init__(self, status, headers, data, fail_at=None):
+        self.status = status
+        self.headers = headers
+        self.data = data
+        self.pos = 0
+        self.fail_at = fail_at
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self, size=0):
+        end = len(self.data) if size == 0 else self.pos + size
+        if self.fail_at is not None and end > self.fail_at:
+            if self.pos >= self.fail_at:
+                raise IOError("Connection reset")
+            end = self.fail_at
+        out = self.data[self.pos:end]
+        self.pos += len(out)
+        return out
+
+
+class LocalKey(object):
+    """
+    In-process stand-in for a boto Key
+    """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.etag = None
+        self.resp = None
+
+    @property
+    def size(self):
+        return len(self.bucket.data[self.name])
+
+    def exists(self):
+        return self.name in self.bucket.data
+
+    def set_contents_from_string(self, data, reduced_redundancy=False):
+        self.bucket.data[self.name] = data
+
+    def set_contents_from_filename(self, file_name, reduced_redundancy=False, cb=None, num_cb=10):
+        with open(file_name, "rb") as handle:
+            self.bucket.data[self.name] = handle.read()
+
+    def get_contents_to_filename(self, file_name, cb=None, num_cb=10):
+        with open(file_name, "wb") as handle:
+            handle.write(self.bucket.data[self.name])
+
+    def open_read(self, headers=None):
+        if self.resp is not None:
+            return
+        headers = headers or {}
+        self.bucket.requests.append(headers)
+        if self.bucket.before_read is not None:
+            self.bucket.before_read(self)
+        data = self.bucket.data[self.name]
+        etag = etag_of(data)
+        if "If-Match" in headers and headers["If-Match"] != etag:
+            raise LocalResponseError(412, "Precondition Failed")
+        if "Range" not in headers or self.bucket.ignore_ranges:
+            self.resp = LocalResponse(200, {"etag" : etag}, data)
+            return
+        start, end = list( int(a) for a in headers["Range"][len("bytes="):].split("-") )
+        self.bucket.ranges.append( (start, end) )
+        end = min(end, len(data) - 1)
+        fail_at = None
+        if self.bucket.fail_ranges > 0:
+            self.bucket.fail_ranges -= 1
+            fail_at = (end - start + 1) / 2
+        self.resp = LocalResponse(206, {"etag" : etag, "content-range" : "bytes %d-%d/%d" % (start, end, len(data))},
+            data[start:end + 1], fail_at)
+
+    def read(self, size=0):
+        self.open_read()
+        data = self.resp.read(size)
+        if not data:
+            self.close()
+        return data
+
+    def close(self, fast=False):
+        self.resp = None
+
+    def get_contents_to_file(self, fp, headers=None, cb=None, num_cb=10):
+        self.open_read(headers)
+        try:
+            fp.write(self.resp.read())
+        finally:
+            self.close()
+
+    def delete(self):
+        del self.bucket.data[self.name]
+
+    def generate_url(self, expires_in):
+        return "local://%s/%s" % (self.bucket.name, self.name)
+
+
+class LocalPart(object):
+    def __init__(self, part_number, data):
+        self.part_number = part_number
+        self.size = len(data)
+        self.etag = etag_of(data)
+        self.data = data
+
+
+class LocalMultiPartUpload(object):
+    """
+    In-process stand-in for a boto MultiPartUpload
+    """
+
+    def __init__(self, bucket, key_name):
+        self.bucket = bucket
+        self.bucket_name = bucket.name
+        self.key_name = key_name
+        self.id = str(uuid.uuid4())
+        self.initiated = "%08d" % (len(bucket.uploads))
+        self.parts = {}
+
+    def __iter__(self):
+        return iter(list( self.parts[n] for n in sorted(self.parts) ))
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        data = fp.read(size)
+        self.bucket.part_log.append(part_num)
+        if self.bucket.fail_parts.get(part_num, 0) > 0:
+            self.bucket.fail_parts[part_num] -= 1
+            raise IOError("Connection reset")
+        self.parts[part_num] = LocalPart(part_num, data)
+
+    def complete_upload(self):
+        self.bucket.data[self.key_name] = "".join(self.parts[n].data for n in sorted(self.parts))
+        self.bucket.uploads.remove(self)
+
+    def cancel_upload(self):
+        self.bucket.uploads.remove(self)
+
+
+class LocalBucket(object):
+    """
+    In-process stand-in for a boto Bucket
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.data = {}
+        self.ranges = []
+        self.requests = []
+        self.fail_ranges = 0
+        self.ignore_ranges = False
+        self.before_read = None
+        self.uploads = []
+        self.part_log = []
+        self.fail_parts = {}
+
+    def new_key(self, name):
+        return LocalKey(self, name)
+
+    def get_key(self, name):
+        if name in self.data:
+            key = LocalKey(self, name)
+            key.etag = etag_of(self.data[name])
+            return key
+        return None
+
+    def get_all_keys(self, prefix=""):
+        return list( LocalKey(self, k) for k in sorted(self.data) if k.startswith(prefix) )
+
+    def initiate_multipart_upload(self, key_name, reduced_redundancy=False):
+        mp = LocalMultiPartUpload(self, key_name)
+        self.uploads.append(mp)
+        return mp
+
+    def get_all_multipart_uploads(self, prefix=""):
+        return list( mp for mp in self.uploads if mp.key_name.startswith(prefix) )
+
+
+class LocalS3ObjectStore(S3ObjectStore):
+
+    def _configure_connection(self):
+        self.conn = None
+
+    def _get_bucket(self, bucket_name):
+        return LocalBucket(bucket_name)
+
+
+class Config(object):
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.umask = 077
+        self.gid = None
+
+
+def make_store(cache_path, cache_bytes=-1, part_bytes=None):
+    size = -1 if cache_bytes == -1 else cache_bytes / 1073741824.0
+    download = "" if part_bytes is None else '<download part_size="%r" threads="4"/>' % (part_bytes / 1048576.0)
+    config_xml = ElementTree.fromstring(
+        '<object_store type="s3">'
+        '<auth access_key="access" secret_key="secret"/>'
+        '<bucket name="test"/>'
+        '<cache path="%s" size="%r"/>'
+        '%s'
+        '</object_store>' % (cache_path, size, download))
+    return LocalS3ObjectStore(Config(cache_path), config_xml)
+
+
+class S3Test(unittest.TestCase):
+
+    def setUp(self):
+        if not os.path.exists(get_abspath("../test_tmp")):
+            os.mkdir(get_abspath("../test_tmp"))
+        os.mkdir(get_abspath("../test_tmp/s3"))
+        self.store = None
+
+    def tearDown(self):
+        if self.store is not None:
+            self.store.shutdown()
+        if os.path.exists(get_abspath("../test_tmp/s3")):
+            shutil.rmtree(get_abspath("../test_tmp/s3"))
+
+    def add_objects(self, count, size):
+        out = []
+        src = get_abspath("../test_tmp/s3/src.dat")
+        for i in range(count):
+            t = Target(str(uuid.uuid4()))
+            with open(src, "w") as handle:
+                handle.write(str(i) * size)
+            self.store.update_from_file(t, file_name=src, create=True)
+            out.append(t)
+        return out
+
+    def testCacheAccounting(self):
+        cache_path = get_abspath("../test_tmp/s3/cache")
+        os.mkdir(cache_path)
+        self.store = make_store(cache_path, 10000)
+        targets = self.add_objects(5, 3000)
+        #evicted from the cache as new files came in, at 90% of its size
+        self.assertEqual(self.store.cache_index.total, 9000)
+        paths = list( self.store._get_cache_path(self.store._construct_path(t)) for t in targets )
+        self.assertEqual(list(os.path.exists(p) for p in paths), [False, False, True, True, True])
+
+        #reads bring a file back, and refresh its place
+        self.store.get_filename(targets[2])
+        with open(self.store.get_filename(targets[0])) as handle:
+            self.assertEqual(handle.read(), "0" * 3000)
+        self.assertEqual(list(os.path.exists(p) for p in paths), [True, False, True, False, True])
+        self.assertEqual(self.store.cache_index.counters['evictions'], 3)
+
+        #files added or removed behind the index's back are picked up by
+        #reconciling it with the disk
+        os.unlink(paths[4])
+        os.makedirs(os.path.join(cache_path, "zz"))
+        with open(os.path.join(cache_path, "zz", "dataset_other.dat"), "w") as handle:
+            handle.write("x" * 1000)
+        self.assertEqual(self.store.cache_index.reconcile(), 2)
+        self.assertEqual(list(self.store.cache_index.entries)[0], os.path.join("zz", "dataset_other.dat"))
+        self.assertEqual(self.store.cache_index.total, 7000)
+
+    def testParallelDownload(self):
+        cache_path = get_abspath("../test_tmp/s3/cache")
+        os.mkdir(cache_path)
+        self.store = make_store(cache_path, part_bytes=30000)
+        t = Target(str(uuid.uuid4()))
+        src = get_abspath("../test_tmp/s3/src.dat")
+        with open(src, "w") as handle:
+            handle.write("".join("%07d\n" % (i) for i in range(12500)))
+        self.store.update_from_file(t, file_name=src, create=True)
+        os.unlink(self.store.get_filename(t))
+
+        #failed parts are fetched again on their own
+        self.store.bucket.fail_ranges = 2
+        retry_delay = galaxy.objectstore.s3_download.RETRY_DELAY
+        galaxy.objectstore.s3_download.RETRY_DELAY = 0.01
+        try:
+            path = self.store.get_filename(t)
+        finally:
+            galaxy.objectstore.s3_download.RETRY_DELAY = retry_delay
+        with open(path) as handle, open(src) as expected:
+            self.assertEqual(handle.read(), expected.read())
+        ranges = self.store.bucket.ranges
+        self.assertEqual(sorted(set(ranges)), [(0, 29999), (30000, 59999), (60000, 89999), (90000, 99999)])
+        self.assertEqual(len(ranges), 6)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+    def testDownloadChecks(self):
+        bucket = LocalBucket("test")
+        data = "".join("%07d\n" % (i) for i in range(12500))
+        bucket.data["big.dat"] = data
+        path = get_abspath("../test_tmp/s3/big.dat")
+        download = galaxy.objectstore.s3_download.parallel_download
+        retry_delay = galaxy.objectstore.s3_download.RETRY_DELAY
+        galaxy.objectstore.s3_download.RETRY_DELAY = 0.01
+        try:
+            #every part is asked for with the ETag of the key
+            download(bucket.get_key("big.dat"), path, part_size=30000, threads=4)
+            with open(path) as handle:
+                self.assertEqual(handle.read(), data)
+            self.assertEqual(len(bucket.requests), 4)
+            self.assertEqual(set( h["If-Match"] for h in bucket.requests ), set([etag_of(data)]))
+            os.unlink(path)
+
+            #the whole object, sent when a range was asked for, isn't written
+            bucket.ignore_ranges = True
+            self.assertRaises(DownloadError, download, bucket.get_key("big.dat"), path,
+                part_size=30000, threads=4, retries=1)
+            bucket.ignore_ranges = False
+
+            #an object replaced during the download fails it, without retries
+            bucket.requests = []
+            def replace(key):
+                if len(bucket.requests) == 2:
+                    bucket.data["big.dat"] = data.upper() + "x"
+            bucket.before_read = replace
+            self.assertRaises(ObjectChanged, download, bucket.get_key("big.dat"), path,
+                part_size=30000, threads=1, retries=3)
+            ranges = list( h["Range"] for h in bucket.requests )
+            self.assertEqual(len(ranges), len(set(ranges)))
+        finally:
+            galaxy.objectstore.s3_download.RETRY_DELAY = retry_delay
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+    def testMultipartUpload(self):
+        bucket = LocalBucket("test")
+        s3server = {'max_chunk_size' : 250, 'use_rr' : False}
+        src = get_abspath("../test_tmp/s3/src.dat")
+        with open(src, "w") as handle:
+            handle.write("".join("%07d\n" % (i) for i in range(12500)))
+        retry_delay = galaxy.objectstore.s3_multipart_upload.RETRY_DELAY
+        galaxy.objectstore.s3_multipart_upload.RETRY_DELAY = 0.01
+        try:
+            #part 3 goes through on its retry, part 2 never does
+            bucket.fail_parts = {2 : 2, 3 : 1}
+            with self.assertRaises(UploadError):
+                multipart_upload(s3server, bucket, "big.dat", src, 0.1, part_size=30000, threads=4, retries=1)
+            self.assertEqual(sorted(bucket.part_log), [1, 2, 2, 3, 3, 4])
+            self.assertEqual(len(bucket.uploads), 1)
+            self.assertFalse("big.dat" in bucket.data)
+
+            #the next attempt only sends what is missing
+            bucket.part_log = []
+            multipart_upload(s3server, bucket, "big.dat", src, 0.1, part_size=30000, threads=4, retries=1)
+        finally:
+            galaxy.objectstore.s3_multipart_upload.RETRY_DELAY = retry_delay
+        self.assertEqual(bucket.part_log, [2])
+        self.assertEqual(bucket.uploads, [])
+        with open(src) as handle:
+            self.assertEqual(bucket.data["big.dat"], handle.read())
+        self.assertEqual(os.listdir(os.path.dirname(src)), ["src.dat"])
+
+    def testMultipartResumeLayout(self):
+        bucket = LocalBucket("test")
+        s3server = {'max_chunk_size' : 250, 'use_rr' : False}
+        src = get_abspath("../test_tmp/s3/src.dat")
+        with open(src, "w") as handle:
+            handle.write("".join("%07d\n" % (i) for i in range(12500)))
+        retry_delay = galaxy.objectstore.s3_multipart_upload.RETRY_DELAY
+        galaxy.objectstore.s3_multipart_upload.RETRY_DELAY = 0.01
+        try:
+            bucket.fail_parts = {2 : 1}
+            with self.assertRaises(UploadError):
+                multipart_upload(s3server, bucket, "big.dat", src, 0.1, part_size=20000, threads=4, retries=0)
+            stale = bucket.uploads[0]
+            self.assertEqual(sorted(stale.parts), [1, 3, 4, 5])
+
+            #a resume with another part size starts over, rather than
+            #completing with the old part 5 after the new last part
+            bucket.part_log = []
+            multipart_upload(s3server, bucket, "big.dat", src, 0.1, part_size=30000, threads=4, retries=0)
+        finally:
+            galaxy.objectstore.s3_multipart_upload.RETRY_DELAY = retry_delay
+        self.assertEqual(sorted(bucket.part_log), [1, 2, 3, 4])
+        self.assertEqual(bucket.uploads, [])
+        with open(src) as handle:
+            self.assertEqual(bucket.data["big.dat"], handle.read())
+